@@ -0,0 +1,218 @@
+"""
+Local stand-in for the Strava API: synthetic paginated /athlete/activities, /activities/{id} and /oauth/token, with
+configurable latency and rate limits. Activities are generated on the fly from their id, so the server holds no
+state beyond the number of activities of each athlete.
+"""
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from geo.polyline import encode_polyline
+
+FIRST_START_DATE = 1577865600  # 2020-01-01T08:00:00Z
+ACTIVITY_INTERVAL = 12 * 3600
+ROUTE_POINTS = 300
+ACTIVITIES_PER_ATHLETE = 100_000  # activity id = athlete id * ACTIVITIES_PER_ATHLETE + index
+
+_ACTIVITY_PATH = re.compile(r"/activities/(\d+)$")
+
+
+def _iso(epoch: int) -> str:
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def synthetic_route(activity_id: int) -> np.ndarray:
+    """
+    Noisy loop of ROUTE_POINTS points around Annecy, in 1e-5 degrees, different for every activity
+    """
+    rng = np.random.default_rng(activity_id)
+    center = np.array([4590000, 613000]) + rng.integers(-20000, 20000, size=2)
+    angles = np.linspace(0, 2 * np.pi, ROUTE_POINTS)
+    radius = rng.integers(2000, 15000)
+    loop = np.stack([np.sin(angles), np.cos(angles)], axis=1) * radius
+    return (center + loop + rng.normal(0, 30, size=loop.shape).cumsum(axis=0)).astype(np.int32)
+
+
+def synthetic_activity(athlete_id: int, activity_id: int, detailed: bool = False) -> dict:
+    index = activity_id % ACTIVITIES_PER_ATHLETE
+    start = FIRST_START_DATE + index * ACTIVITY_INTERVAL
+    route = synthetic_route(activity_id)
+    polyline = encode_polyline(route)
+    activity = {
+        "resource_state": 3 if detailed else 2,
+        "athlete": {"id": athlete_id, "resource_state": 1},
+        "name": f"Ride {index}",
+        "distance": 20000.0 + index % 50 * 1000,
+        "moving_time": 3600 + index % 30 * 60,
+        "elapsed_time": 4000 + index % 30 * 60,
+        "total_elevation_gain": 200.0 + index % 20 * 25,
+        "elev_high": 1200.0,
+        "elev_low": 450.0,
+        "type": "Ride",
+        "sport_type": "Ride" if index % 4 else "Run",
+        "workout_type": None,
+        "id": activity_id,
+        "start_date": _iso(start),
+        "start_date_local": _iso(start + 3600),
+        "timezone": "(GMT+01:00) Europe/Paris",
+        "utc_offset": 3600.0,
+        "start_latlng": (route[0] / 1e5).tolist(),
+        "end_latlng": (route[-1] / 1e5).tolist(),
+        "trainer": False,
+        "commute": index % 7 == 0,
+        "manual": False,
+        "private": False,
+        "visibility": "everyone",
+        "flagged": False,
+        "gear_id": "b1",
+        "average_speed": 5.5,
+        "max_speed": 14.2,
+        "hide_from_home": False,
+    }
+    if detailed:
+        activity["map"] = {"id": f"a{activity_id}", "polyline": polyline, "resource_state": 3}
+        activity["gear"] = {"id": "b1", "primary": True, "name": "Bike", "distance": 1000000}
+    else:
+        activity["map"] = {"id": f"a{activity_id}", "summary_polyline": polyline, "resource_state": 2}
+    return activity
+
+
+def athlete_profile(athlete_id: int) -> dict:
+    return {"id": athlete_id, "username": f"bench{athlete_id}", "firstname": "Bench", "lastname": str(athlete_id),
+            "bio": "", "city": "Annecy", "state": "", "country": "France", "sex": "M",
+            "created_at": "2020-01-01T00:00:00Z", "updated_at": "2020-01-01T00:00:00Z", "profile_medium": "",
+            "weight": 70.0}
+
+
+class RateLimits:
+    """
+    Strava style quota: a 15-minute and a daily window, reported in X-RateLimit-Limit / X-RateLimit-Usage
+    """
+
+    def __init__(self, short_limit: int, daily_limit: int):
+        self.short_limit = short_limit
+        self.daily_limit = daily_limit
+        self._lock = threading.Lock()
+        self._short_window = self._daily_window = None
+        self._short_used = self._daily_used = 0
+
+    def take(self) -> Tuple[bool, Dict[str, str]]:
+        now = time.time()
+        with self._lock:
+            if self._short_window != int(now // 900):
+                self._short_window, self._short_used = int(now // 900), 0
+            if self._daily_window != int(now // 86400):
+                self._daily_window, self._daily_used = int(now // 86400), 0
+            allowed = self._short_used < self.short_limit and self._daily_used < self.daily_limit
+            if allowed:
+                self._short_used += 1
+                self._daily_used += 1
+            headers = {"X-RateLimit-Limit": f"{self.short_limit},{self.daily_limit}",
+                       "X-RateLimit-Usage": f"{self._short_used},{self._daily_used}"}
+        return allowed, headers
+
+
+class FakeStrava:
+    def __init__(self, latency: float = 0.0, short_limit: int = 10 ** 9, daily_limit: int = 10 ** 9):
+        self.latency = latency
+        self.rate_limits = RateLimits(short_limit, daily_limit)
+        self.activity_counts: Dict[int, int] = {}
+        self.requests = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add_athlete(self, athlete_id: int, activities: int):
+        self.activity_counts[athlete_id] = activities
+
+    def start(self) -> str:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            def do_POST(self):
+                fake.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-strava", daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        allowed, headers = self.rate_limits.take()
+        if not allowed:
+            return self._send(request, 429, {"message": "Rate Limit Exceeded"}, headers)
+
+        url = urlsplit(request.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path.endswith("/oauth/token"):
+            return self._send(request, 200, self._token(params), headers)
+
+        athlete_id = self._athlete_from_token(request.headers.get("Authorization", ""))
+        if athlete_id is None:
+            return self._send(request, 401, {"message": "Authorization Error"}, headers)
+        if url.path.endswith("/athlete/activities"):
+            return self._send(request, 200, self._activities_page(athlete_id, params), headers)
+        match = _ACTIVITY_PATH.search(url.path)
+        if match and int(match.group(1)) // ACTIVITIES_PER_ATHLETE == athlete_id:
+            return self._send(request, 200, synthetic_activity(athlete_id, int(match.group(1)), detailed=True),
+                              headers)
+        return self._send(request, 404, {"message": "Record Not Found"}, headers)
+
+    @staticmethod
+    def _send(request: BaseHTTPRequestHandler, status: int, payload, headers: Dict[str, str]):
+        body = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+    @staticmethod
+    def _athlete_from_token(authorization: str) -> Optional[int]:
+        match = re.fullmatch(r"Bearer token-(\d+)", authorization)
+        return int(match.group(1)) if match else None
+
+    @staticmethod
+    def _token(params: Dict[str, str]) -> dict:
+        # The authorization code and refresh token carry the athlete id: "athlete-<id>", "refresh-<id>"
+        athlete_id = int((params.get("code") or params.get("refresh_token", "")).split("-")[-1])
+        return {"token_type": "Bearer", "expires_at": int(time.time()) + 21600, "expires_in": 21600,
+                "refresh_token": f"refresh-{athlete_id}", "access_token": f"token-{athlete_id}",
+                "athlete": athlete_profile(athlete_id)}
+
+    def _activities_page(self, athlete_id: int, params: Dict[str, str]) -> list:
+        """
+        Activities started after `after`, oldest first, like Strava does when `after` is given
+        """
+        page, per_page = int(params.get("page", 1)), int(params.get("per_page", 30))
+        after = int(params.get("after", 0))
+        first = max(0, (after - FIRST_START_DATE) // ACTIVITY_INTERVAL + 1)
+        start = first + (page - 1) * per_page
+        end = min(self.activity_counts.get(athlete_id, 0), start + per_page)
+        return [synthetic_activity(athlete_id, athlete_id * ACTIVITIES_PER_ATHLETE + index)
+                for index in range(start, end)]
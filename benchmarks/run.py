@@ -0,0 +1,212 @@
+"""
+Benchmarks of the hot paths against a local Strava stand-in (fake_strava.py):
+
+- back_populate: activities imported per second by the sync worker, from login to a finished job
+- webhooks: events per second accepted by POST /webhook and applied by the webhook worker, sent in bursts of
+  several events per activity
+- routes / activity: p50 / p99 latency of /routes/ and /activity/{id}, uncached and served from the response cache
+
+Each size is a new athlete with that many activities, so one run covers 100 to 10k activities per athlete:
+
+    python benchmarks/run.py --sizes 100,1000,10000 --output bench.json
+    python benchmarks/run.py --database-url postgresql://localhost/explore_bench --latency 0.05
+
+Without --database-url a throwaway SQLite file is used (needs aiosqlite). Results are written as JSON, tagged with
+the current commit, so runs can be compared across commits.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import List, Dict, Any
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_DIR), "src"))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000", help="activities per athlete, comma separated")
+    parser.add_argument("--database-url", help="SQLAlchemy URL of the database to run against")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every Strava response")
+    parser.add_argument("--short-limit", type=int, default=10 ** 9, help="Strava 15-minute request quota")
+    parser.add_argument("--daily-limit", type=int, default=10 ** 9, help="Strava daily request quota")
+    parser.add_argument("--requests", type=int, default=200, help="requests per latency measurement")
+    parser.add_argument("--webhook-events", type=int, default=1000, help="webhook events per size")
+    parser.add_argument("--burst", type=int, default=5, help="webhook events per activity in a burst")
+    parser.add_argument("--output", help="file the JSON results are written to, stdout otherwise")
+    return parser.parse_args()
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCHMARKS_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _latency_summary(durations: List[float]) -> Dict[str, float]:
+    durations = sorted(durations)
+    return {
+        "requests": len(durations),
+        "p50_ms": round(durations[len(durations) // 2] * 1000, 3),
+        "p99_ms": round(durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000, 3),
+        "mean_ms": round(statistics.fmean(durations) * 1000, 3),
+    }
+
+
+def _timed_get(client, url: str) -> float:
+    start = time.perf_counter()
+    response = client.get(url)
+    duration = time.perf_counter() - start
+    response.raise_for_status()
+    return duration
+
+
+def bench_back_populate(client, fake, athlete_id: int, size: int) -> Dict[str, Any]:
+    from services.importer import run_next_sync_job
+
+    fake.add_athlete(athlete_id, size)
+    strava_requests = fake.requests
+    start = time.perf_counter()
+    response = client.post("/exchange_token", json={"code": f"athlete-{athlete_id}", "scope": "read,activity:read_all"})
+    response.raise_for_status()
+    while run_next_sync_job():
+        pass
+    duration = time.perf_counter() - start
+    job = client.get("/backpopulate").json()
+    return {
+        "status": job["status"],
+        "activities": job["activities"],
+        "seconds": round(duration, 3),
+        "activities_per_second": round(job["activities"] / duration, 1),
+        "strava_requests": fake.requests - strava_requests,
+    }
+
+
+def bench_queries(client, activity_ids: List[int], requests: int) -> Dict[str, Any]:
+    from fake_strava import FIRST_START_DATE, ACTIVITY_INTERVAL
+
+    rng = random.Random(0)
+    # Distinct query strings and ids, so every request misses the response cache
+    befores = rng.sample(range(len(activity_ids)), min(requests, len(activity_ids)))
+    routes = [_timed_get(client, "/routes/?limit=50&before="
+                         + datetime.utcfromtimestamp(FIRST_START_DATE + index * ACTIVITY_INTERVAL).isoformat())
+              for index in befores]
+    routes_zoomed = [_timed_get(client, "/routes/?limit=50&zoom=12&before="
+                                + datetime.utcfromtimestamp(FIRST_START_DATE + index * ACTIVITY_INTERVAL).isoformat())
+                     for index in befores]
+    activities = [_timed_get(client, f"/activity/{activity_id}")
+                  for activity_id in rng.sample(activity_ids, min(requests, len(activity_ids)))]
+    routes_cached = [_timed_get(client, "/routes/?limit=50") for _ in range(requests)]
+    activity_cached = [_timed_get(client, f"/activity/{activity_ids[0]}") for _ in range(requests)]
+    return {
+        "routes": _latency_summary(routes),
+        "routes_zoomed": _latency_summary(routes_zoomed),
+        "routes_cached": _latency_summary(routes_cached),
+        "activity": _latency_summary(activities),
+        "activity_cached": _latency_summary(activity_cached),
+    }
+
+
+def bench_webhooks(client, athlete_id: int, activity_ids: List[int], events: int, burst: int) -> Dict[str, Any]:
+    """
+    Bursts of updates on existing activities, with a create of a new activity every 10 bursts and a delete every 25
+    """
+    from fake_strava import ACTIVITIES_PER_ATHLETE
+    from services.webhooks import process_webhook_batch
+
+    payloads = []
+    new_activity_id = athlete_id * ACTIVITIES_PER_ATHLETE + len(activity_ids)
+    for group in range(events // burst):
+        if group % 10 == 9:
+            object_id, aspect_types = new_activity_id + group, ["create"] + ["update"] * (burst - 1)
+        elif group % 25 == 24:
+            object_id, aspect_types = activity_ids[group % len(activity_ids)], ["update"] * (burst - 1) + ["delete"]
+        else:
+            object_id, aspect_types = activity_ids[group % len(activity_ids)], ["update"] * burst
+        for position, aspect_type in enumerate(aspect_types):
+            payloads.append({"object_type": "activity", "object_id": object_id, "aspect_type": aspect_type,
+                             "updates": {"title": f"Renamed {position}"} if aspect_type == "update" else {},
+                             "owner_id": athlete_id, "subscription_id": 1,
+                             "event_time": int(time.time()) + position})
+
+    start = time.perf_counter()
+    for payload in payloads:
+        client.post("/webhook", json=payload).raise_for_status()
+    ingest_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    processed = 0
+    while handled := process_webhook_batch():
+        processed += handled
+    process_duration = time.perf_counter() - start
+    return {
+        "events": len(payloads),
+        "ingest_seconds": round(ingest_duration, 3),
+        "ingest_events_per_second": round(len(payloads) / ingest_duration, 1),
+        "processed": processed,
+        "process_seconds": round(process_duration, 3),
+        "process_events_per_second": round(processed / process_duration, 1) if process_duration else None,
+    }
+
+
+def main():
+    args = _parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    from fake_strava import FakeStrava, ACTIVITIES_PER_ATHLETE
+
+    fake = FakeStrava(latency=args.latency, short_limit=args.short_limit, daily_limit=args.daily_limit)
+    os.environ["STRAVA_API_URL"] = fake.start()
+    database_url = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    os.environ["SQLALCHEMY_URL"] = database_url
+    os.environ.setdefault("SESSION_KEY", "benchmark")
+
+    from fastapi.testclient import TestClient
+    import main as app_main
+    from migrate import migrate
+
+    migrate()
+
+    results = {
+        "commit": _git_commit(),
+        "started_at": datetime.utcnow().isoformat(),
+        "database": database_url.split(":", 1)[0],
+        "python": sys.version.split()[0],
+        "config": {key: value for key, value in vars(args).items() if key not in ("database_url", "output")},
+        "sizes": {},
+    }
+    # Athlete ids unique to this run, so a persistent database can be reused
+    run_id = int(time.time()) % 10 ** 6 * 100
+    try:
+        for position, size in enumerate(sizes):
+            athlete_id = run_id + position
+            activity_ids = [athlete_id * ACTIVITIES_PER_ATHLETE + index for index in range(size)]
+            # Not entered as a context manager: the background workers stay off, the benchmark drives them
+            client = TestClient(app_main.app)
+            print(f"Benchmarking {size} activities", file=sys.stderr)
+            results["sizes"][str(size)] = {
+                "back_populate": bench_back_populate(client, fake, athlete_id, size),
+                **bench_queries(client, activity_ids, args.requests),
+                "webhooks": bench_webhooks(client, athlete_id, activity_ids, args.webhook_events, args.burst),
+            }
+    finally:
+        fake.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Time from process start to the first successful /ping, the delay before a new container takes traffic:
+
+    python benchmarks/startup.py --runs 10 --output startup.json
+
+Each run starts `uvicorn main:app` in src/ and polls /ping until it answers. The import time of main is measured
+separately, in a fresh interpreter. Results are written as JSON, tagged with the current commit.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from run import _git_commit, BENCHMARKS_DIR
+
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "src")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _environment(database_url: str) -> dict:
+    return {**os.environ, "SQLALCHEMY_URL": database_url, "SESSION_KEY": "benchmark",
+            "RUN_BACKGROUND_WORKERS": "false"}
+
+
+def time_to_first_ping(env: dict, timeout: float) -> float:
+    port = _free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)], cwd=SRC_DIR,
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/ping", timeout=0.5).status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            if process.poll() is not None:
+                raise RuntimeError("uvicorn exited before answering /ping")
+            time.sleep(0.005)
+        raise TimeoutError(f"No answer to /ping after {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def import_time(env: dict) -> float:
+    output = subprocess.check_output(
+        [sys.executable, "-c", "import time; start = time.perf_counter(); import main; "
+                               "print(time.perf_counter() - start)"], cwd=SRC_DIR, env=env, text=True)
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--database-url", help="the app does not connect to it before the first query")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--output", help="file the JSON results are written to, stdout otherwise")
+    args = parser.parse_args()
+
+    env = _environment(args.database_url or f"sqlite:///{tempfile.mkdtemp()}/startup.db")
+    # First run warms the bytecode cache, as in a built image
+    import_time(env)
+    pings = [time_to_first_ping(env, args.timeout) for _ in range(args.runs)]
+    imports = [import_time(env) for _ in range(args.runs)]
+    results = {
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "time_to_first_ping_ms": {"p50": round(statistics.median(pings) * 1000, 1),
+                                  "max": round(max(pings) * 1000, 1)},
+        "import_main_ms": {"p50": round(statistics.median(imports) * 1000, 1),
+                           "max": round(max(imports) * 1000, 1)},
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
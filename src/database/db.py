@@ -3,17 +3,140 @@ Access to Supabase database
 """
 
 import os
+from functools import lru_cache
+from typing import Dict, Any, Union, Callable
+
 from dotenv import load_dotenv
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, BigInteger, Integer
+from sqlalchemy.engine import make_url, URL, Engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import NullPool
 
 load_dotenv()
 
-engine = create_engine(os.getenv("SQLALCHEMY_URL"))
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+# Below the idle timeout of Supabase / PgBouncer, so the pool never hands out a connection closed on the other side
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 0))  # 0 disables the timeout
+# PgBouncer in transaction mode (Supabase port 6543) pools the connections itself and breaks prepared statements
+DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', 'false').lower() == 'true'
+
+
+def _async_url(url: Union[str, URL]) -> URL:
+    parsed_url = make_url(url)
+    return parsed_url.set(drivername=ASYNC_DRIVERS.get(parsed_url.get_backend_name(), parsed_url.drivername))
+
+
+def _engine_options(url: URL) -> Dict[str, Any]:
+    """
+    Pool and connection settings for the engine of `url`
+    """
+    if url.get_backend_name() != "postgresql":
+        return {}
+
+    options: Dict[str, Any] = {}
+    if DB_PGBOUNCER:
+        options['poolclass'] = NullPool
+    else:
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                       pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING)
+
+    connect_args: Dict[str, Any] = {}
+    is_asyncpg = url.get_driver_name() == "asyncpg"
+    # PgBouncer rejects startup parameters, the timeout has to be set on the database role instead
+    if DB_STATEMENT_TIMEOUT_MS and not DB_PGBOUNCER:
+        if is_asyncpg:
+            connect_args['server_settings'] = {'statement_timeout': str(DB_STATEMENT_TIMEOUT_MS)}
+        else:
+            connect_args['options'] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    if DB_PGBOUNCER and is_asyncpg:
+        connect_args['statement_cache_size'] = 0
+        connect_args['prepared_statement_cache_size'] = 0
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+@lru_cache(maxsize=None)
+def get_engine() -> Engine:
+    """
+    Engine of the background workers, created on first use so importing the app opens nothing
+    """
+    url = make_url(os.getenv("SQLALCHEMY_URL"))
+    return create_engine(url, **_engine_options(url))
+
+
+@lru_cache(maxsize=None)
+def get_async_engine() -> AsyncEngine:
+    """
+    Engine of the request handlers
+    """
+    url = _async_url(os.getenv("SQLALCHEMY_URL"))
+    return create_async_engine(url, **_engine_options(url))
+
+
+def has_replica() -> bool:
+    return bool(os.getenv("SQLALCHEMY_REPLICA_URL"))
+
+
+@lru_cache(maxsize=None)
+def get_replica_async_engine() -> AsyncEngine:
+    """
+    Read-only endpoints go to the replica when there is one. It may lag behind the primary by a few seconds.
+    """
+    if not has_replica():
+        return get_async_engine()
+    url = _async_url(os.getenv("SQLALCHEMY_REPLICA_URL"))
+    return create_async_engine(url, **_engine_options(url))
+
+
+class _LazySessionmaker(sessionmaker):
+    def __init__(self, get_bind: Callable[[], Engine], **kwargs):
+        super().__init__(**kwargs)
+        self._get_bind = get_bind
+
+    def __call__(self, **local_kw) -> Session:
+        local_kw.setdefault("bind", self._get_bind())
+        return super().__call__(**local_kw)
+
+
+class _LazyAsyncSessionmaker(async_sessionmaker):
+    def __init__(self, get_bind: Callable[[], AsyncEngine], **kwargs):
+        super().__init__(**kwargs)
+        self._get_bind = get_bind
+
+    def __call__(self, **local_kw) -> AsyncSession:
+        local_kw.setdefault("bind", self._get_bind())
+        return super().__call__(**local_kw)
+
+
+SessionLocal = _LazySessionmaker(get_engine, autocommit=False, autoflush=False)
+
+AsyncSessionLocal = _LazyAsyncSessionmaker(get_async_engine, autoflush=False, expire_on_commit=False)
+
+AsyncReadSessionLocal = _LazyAsyncSessionmaker(get_replica_async_engine, autoflush=False, expire_on_commit=False)
+
+
+def __getattr__(name: str):
+    # `engine`, `async_engine` and `replica_async_engine` stay importable, they are created when first accessed
+    engines = {"engine": get_engine, "async_engine": get_async_engine, "replica_async_engine": get_replica_async_engine}
+    if name in engines:
+        return engines[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+# Type of the generated primary keys: only INTEGER PRIMARY KEY columns autoincrement in SQLite
+BigIntegerId = BigInteger().with_variant(Integer, "sqlite")
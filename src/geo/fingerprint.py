@@ -0,0 +1,123 @@
+"""
+Route fingerprints: MinHash signatures of the map cells a route goes through, and an LSH index grouping near-identical
+routes without comparing every pair
+"""
+from typing import Dict, Tuple, List, Iterable, Optional
+
+import numpy as np
+
+from geo.tiles import to_global_pixels, densify
+
+# Pixels at zoom 11 are ~75 m wide at the equator, ~55 m at 45° of latitude: GPS noise stays in the same cells
+FINGERPRINT_ZOOM = 11
+NUM_HASHES = 64
+BANDS = 16  # of NUM_HASHES // BANDS hashes, routes sharing a whole band are compared
+_ROWS = NUM_HASHES // BANDS
+
+# Fixed seed: the stored fingerprints must stay comparable across processes and releases
+_random = np.random.default_rng(20231015)
+_MULTIPLIERS = _random.integers(0, 2 ** 63, NUM_HASHES, dtype=np.uint64) << np.uint64(1) | np.uint64(1)
+_OFFSETS = _random.integers(0, 2 ** 63, NUM_HASHES, dtype=np.uint64)
+_BAND_MULTIPLIERS = _random.integers(0, 2 ** 63, _ROWS, dtype=np.uint64) << np.uint64(1) | np.uint64(1)
+
+
+def visited_cells(coordinates: np.ndarray) -> np.ndarray:
+    """
+    Distinct cells crossed by the route, as uint64 keys
+    """
+    pixels = np.floor(densify(to_global_pixels(coordinates, FINGERPRINT_ZOOM))).astype(np.int64)
+    world_size = 256 * 2 ** FINGERPRINT_ZOOM
+    return np.unique(pixels[:, 0] * world_size + pixels[:, 1]).astype(np.uint64)
+
+
+def route_fingerprint(coordinates: np.ndarray) -> Optional[bytes]:
+    """
+    MinHash signature of the route cells: the share of equal values between two fingerprints estimates the Jaccard
+    similarity of their cells. None for activities without a route.
+    """
+    if len(coordinates) == 0:
+        return None
+    cells = visited_cells(coordinates)
+    # Multiply-shift hashing, the uint64 products wrap around on purpose
+    with np.errstate(over="ignore"):
+        hashes = (cells[:, None] * _MULTIPLIERS + _OFFSETS) >> np.uint64(32)
+    return hashes.min(axis=0).astype("<u4").tobytes()
+
+
+def unpack_fingerprint(fingerprint: bytes) -> np.ndarray:
+    return np.frombuffer(fingerprint, dtype="<u4")
+
+
+class SimilarityIndex:
+    """
+    Locality sensitive hashing over the fingerprints: routes are bucketed by each band of their signature and only
+    routes sharing a bucket are compared. Routes above ~50% similarity share a bucket with high probability.
+    """
+
+    def __init__(self, ids: Iterable[int], fingerprints: Iterable[np.ndarray]):
+        self._ids = np.fromiter(ids, dtype=np.int64)
+        self._signatures = np.array(list(fingerprints), dtype=np.uint32).reshape(-1, NUM_HASHES)
+        self._positions = {int(activity_id): position for position, activity_id in enumerate(self._ids)}
+        self._buckets: Dict[Tuple[int, int], np.ndarray] = {}
+
+        with np.errstate(over="ignore"):
+            band_keys = (self._signatures.reshape(-1, BANDS, _ROWS).astype(np.uint64) * _BAND_MULTIPLIERS).sum(axis=2)
+        for band in range(BANDS):
+            order = np.argsort(band_keys[:, band], kind="stable")
+            keys = band_keys[order, band]
+            boundaries = np.flatnonzero(np.diff(keys)) + 1
+            for key, members in zip(keys[np.concatenate(([0], boundaries))], np.split(order, boundaries)):
+                if len(members) > 1:
+                    self._buckets[(band, int(key))] = members
+        self._band_keys = band_keys
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _similarities(self, position: int, others: np.ndarray) -> np.ndarray:
+        return (self._signatures[others] == self._signatures[position]).mean(axis=1)
+
+    def similar(self, activity_id: int, threshold: float) -> List[Tuple[int, float]]:
+        """
+        (id, estimated similarity) of the other routes at least `threshold` similar to this one, most similar first
+        """
+        position = self._positions.get(activity_id)
+        if position is None:
+            return []
+        buckets = [self._buckets.get((band, int(self._band_keys[position, band]))) for band in range(BANDS)]
+        candidates = [members for members in buckets if members is not None]
+        if not candidates:
+            return []
+        candidates = np.unique(np.concatenate(candidates))
+        candidates = candidates[candidates != position]
+        similarities = self._similarities(position, candidates)
+        matches = np.flatnonzero(similarities >= threshold)
+        matches = matches[np.argsort(-similarities[matches], kind="stable")]
+        return [(int(self._ids[candidates[match]]), float(similarities[match])) for match in matches]
+
+    def clusters(self, threshold: float) -> List[List[int]]:
+        """
+        Groups of near-identical routes: a route joins a group when it is at least `threshold` similar to one of its
+        routes. Routes without a match are groups of one.
+        """
+        parents = np.arange(len(self._ids))
+
+        def root(position: int) -> int:
+            while parents[position] != position:
+                parents[position] = parents[parents[position]]
+                position = parents[position]
+            return position
+
+        for members in self._buckets.values():
+            # Each route is compared to the first one left, the routes it matches leave the bucket
+            while len(members) > 1:
+                first, others = members[0], members[1:]
+                matched = self._similarities(first, others) >= threshold
+                for other in others[matched]:
+                    parents[root(other)] = root(first)
+                members = others[~matched]
+
+        groups: Dict[int, List[int]] = {}
+        for position, activity_id in enumerate(self._ids):
+            groups.setdefault(root(position), []).append(int(activity_id))
+        return list(groups.values())
@@ -0,0 +1,56 @@
+"""
+In-memory spatial index of activity bounding boxes
+"""
+import math
+from typing import Dict, Tuple, List, Iterable
+
+import numpy as np
+
+BoundingBox = Tuple[float, float, float, float]  # min_lat, min_lng, max_lat, max_lng
+
+
+class GridIndex:
+    """
+    Uniform grid over lat/lng: every box is registered in the cells it overlaps. Queries covering more cells than
+    there are boxes fall back to a vectorized scan.
+    """
+
+    def __init__(self, ids: Iterable[int], boxes: Iterable[BoundingBox], cell_size: float = 0.25):
+        self._cell_size = cell_size
+        self._ids = np.fromiter(ids, dtype=np.int64)
+        self._boxes = np.array(list(boxes), dtype=np.float64).reshape(-1, 4)
+        self._cells: Dict[Tuple[int, int], List[int]] = {}
+        for position, box in enumerate(self._boxes):
+            for cell in self._cells_for(box):
+                self._cells.setdefault(cell, []).append(position)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _cell_range(self, box: BoundingBox) -> Tuple[range, range]:
+        min_lat, min_lng, max_lat, max_lng = box
+        return (range(math.floor(min_lat / self._cell_size), math.floor(max_lat / self._cell_size) + 1),
+                range(math.floor(min_lng / self._cell_size), math.floor(max_lng / self._cell_size) + 1))
+
+    def _cells_for(self, box: BoundingBox) -> Iterable[Tuple[int, int]]:
+        latitude_cells, longitude_cells = self._cell_range(box)
+        return ((lat_cell, lng_cell) for lat_cell in latitude_cells for lng_cell in longitude_cells)
+
+    def query(self, box: BoundingBox) -> np.ndarray:
+        """
+        Ids of the boxes intersecting `box`
+        """
+        latitude_cells, longitude_cells = self._cell_range(box)
+        if len(latitude_cells) * len(longitude_cells) > len(self._ids):
+            candidates = np.arange(len(self._ids))
+        else:
+            positions = set()
+            for cell in self._cells_for(box):
+                positions.update(self._cells.get(cell, ()))
+            candidates = np.fromiter(positions, dtype=np.int64)
+
+        min_lat, min_lng, max_lat, max_lng = box
+        boxes = self._boxes[candidates]
+        intersects = ((boxes[:, 2] >= min_lat) & (boxes[:, 0] <= max_lat) &
+                      (boxes[:, 3] >= min_lng) & (boxes[:, 1] <= max_lng))
+        return self._ids[candidates[intersects]]
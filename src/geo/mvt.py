@@ -0,0 +1,109 @@
+"""
+Minimal Mapbox Vector Tile (spec 2.1) encoder for line layers, the protobuf messages are written by hand.
+Geometries are in tile units: 0 to `extent` over the tile, outside values reach into the neighbouring tiles.
+"""
+from typing import List, Dict, Tuple, Iterable, Union
+
+import numpy as np
+
+EXTENT = 4096
+
+_LINESTRING = 2
+_MOVE_TO = 1
+_LINE_TO = 2
+
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+
+Property = Union[str, int, float, bool]
+Feature = Tuple[int, List[np.ndarray], Dict[str, Property]]  # id, parts, properties
+
+
+def _varints(values: np.ndarray) -> bytes:
+    """
+    Protobuf base 128 varints of non-negative integers, all encoded at once
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) < 16:
+        return b"".join(_varint(int(value)) for value in values)
+    shifts = np.arange(10, dtype=np.uint64) * np.uint64(7)
+    groups = ((values[:, None] >> shifts) & np.uint64(0x7f)).astype(np.uint8)
+    lengths = 1 + (values[:, None] >= (np.uint64(1) << shifts[1:])).sum(axis=1)
+    position = np.arange(10)
+    groups[position < (lengths - 1)[:, None]] |= 0x80
+    return groups[position < lengths[:, None]].tobytes()
+
+
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def _field(number: int, wire_type: int) -> bytes:
+    return _varint(number << 3 | wire_type)
+
+
+def _message(number: int, payload: bytes) -> bytes:
+    return _field(number, _LENGTH_DELIMITED) + _varint(len(payload)) + payload
+
+
+def _value(value: Property) -> bytes:
+    if isinstance(value, bool):
+        return _field(7, _VARINT) + _varint(int(value))
+    if isinstance(value, int):
+        return _field(6, _VARINT) + _varint(value << 1 ^ value >> 63)  # sint_value, zigzag
+    if isinstance(value, float):
+        return _field(3, _FIXED64) + np.array([value], dtype="<f8").tobytes()  # double_value
+    return _message(1, str(value).encode())  # string_value
+
+
+def line_geometry(parts: List[np.ndarray]) -> np.ndarray:
+    """
+    Command integers of a (multi) line string, each part an (N, 2) int array of at least two points
+    """
+    commands = []
+    cursor = np.zeros(2, dtype=np.int64)
+    for part in parts:
+        part = part.astype(np.int64)
+        deltas = _zigzag(np.diff(part, axis=0, prepend=cursor[None, :])).reshape(-1, 2)
+        commands.append(np.array([_MOVE_TO | 1 << 3], dtype=np.uint64))
+        commands.append(deltas[0])
+        commands.append(np.array([_LINE_TO | (len(part) - 1) << 3], dtype=np.uint64))
+        commands.append(deltas[1:].ravel())
+        cursor = part[-1]
+    return np.concatenate(commands) if commands else np.empty(0, dtype=np.uint64)
+
+
+def encode_layer(name: str, features: Iterable[Feature], extent: int = EXTENT) -> bytes:
+    keys: Dict[str, int] = {}
+    values: Dict[Tuple[type, Property], int] = {}
+    encoded_features = []
+    for feature_id, parts, properties in features:
+        tags = []
+        for key, value in properties.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        encoded_features.append(_message(2, _field(1, _VARINT) + _varint(feature_id)
+                                         + _message(2, _varints(np.array(tags)))
+                                         + _field(3, _VARINT) + _varint(_LINESTRING)
+                                         + _message(4, _varints(line_geometry(parts)))))
+    return (_field(15, _VARINT) + _varint(2)
+            + _message(1, name.encode())
+            + b"".join(encoded_features)
+            + b"".join(_message(3, key.encode()) for key in keys)
+            + b"".join(_message(4, _value(value)) for _, value in values)
+            + _field(5, _VARINT) + _varint(extent))
+
+
+def encode_tile(layers: Iterable[bytes]) -> bytes:
+    return b"".join(_message(3, layer) for layer in layers)
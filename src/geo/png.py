@@ -0,0 +1,27 @@
+"""
+Minimal PNG writer for map tiles
+"""
+import struct
+import zlib
+
+import numpy as np
+
+_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (struct.pack(">I", len(data)) + chunk_type + data
+            + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def encode_rgba(image: np.ndarray) -> bytes:
+    """
+    Encode a (height, width, 4) uint8 array as an 8-bit RGBA PNG
+    """
+    height, width, _ = image.shape
+    # Every scanline starts with its filter type, 0 (none)
+    scanlines = np.concatenate([np.zeros((height, 1), dtype=np.uint8),
+                                image.astype(np.uint8).reshape(height, width * 4)], axis=1)
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (_SIGNATURE + _chunk(b"IHDR", header) + _chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6))
+            + _chunk(b"IEND", b""))
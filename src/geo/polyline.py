@@ -0,0 +1,59 @@
+"""
+Vectorized codec for Google encoded polylines (the format used by Strava) and the compact binary form stored in DB.
+Coordinates are kept as (N, 2) int32 arrays of [lat, lng] in 1e-5 degrees, the polyline precision, so the round
+trip is lossless.
+"""
+import numpy as np
+
+PRECISION = 1e5
+# A zigzag encoded int32 delta needs at most 33 bits, i.e. 7 chunks of 5 bits
+_CHUNK_SHIFTS = np.arange(7, dtype=np.int64) * 5
+
+
+def decode_polyline(encoded: str) -> np.ndarray:
+    if not encoded:
+        return np.empty((0, 2), dtype=np.int32)
+    data = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+
+    # Each value is a run of 5 bit chunks, least significant first, all but the last flagged with 0x20
+    ends = (data & 0x20) == 0
+    starts = np.concatenate(([0], np.flatnonzero(ends)[:-1] + 1))
+    value_index = np.concatenate(([0], np.cumsum(ends)[:-1]))
+    chunk_position = np.arange(len(data)) - starts[value_index]
+    values = np.add.reduceat((data & 0x1f) << (5 * chunk_position), starts)
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+
+    values = values[:len(values) - len(values) % 2]
+    return values.reshape(-1, 2).cumsum(axis=0).astype(np.int32)
+
+
+def encode_polyline(coordinates: np.ndarray) -> str:
+    if len(coordinates) == 0:
+        return ""
+    deltas = np.diff(coordinates.astype(np.int64), axis=0, prepend=[[0, 0]]).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    chunks = (values[:, None] >> _CHUNK_SHIFTS) & 0x1f
+    chunk_count = 1 + ((values[:, None] >> _CHUNK_SHIFTS[1:]) > 0).sum(axis=1)
+    chunk_index = np.arange(len(_CHUNK_SHIFTS))
+    used = chunk_index < chunk_count[:, None]
+    continued = chunk_index < (chunk_count - 1)[:, None]
+    characters = (chunks | np.where(continued, 0x20, 0)) + 63
+    return characters[used].astype(np.uint8).tobytes().decode("ascii")
+
+
+def pack_coordinates(coordinates: np.ndarray) -> bytes:
+    """
+    First point followed by the deltas between consecutive points, as little-endian int32.
+    """
+    return np.diff(coordinates.astype(np.int32), axis=0, prepend=[[0, 0]]).astype("<i4").tobytes()
+
+
+def unpack_coordinates(packed: bytes) -> np.ndarray:
+    if not packed:
+        return np.empty((0, 2), dtype=np.int32)
+    return np.frombuffer(packed, dtype="<i4").reshape(-1, 2).cumsum(axis=0, dtype=np.int32)
+
+
+def to_degrees(coordinates: np.ndarray) -> np.ndarray:
+    return coordinates / PRECISION
@@ -0,0 +1,48 @@
+"""
+Douglas-Peucker simplification of decoded routes
+"""
+import numpy as np
+
+from geo.polyline import PRECISION
+
+TILE_SIZE = 256
+
+
+def tolerance_for_zoom(zoom: int, pixels: float = 0.5) -> float:
+    """
+    Tolerance, in polyline units (1e-5 degrees), matching `pixels` on a web map tile at this zoom level.
+    """
+    degrees_per_pixel = 360 / (TILE_SIZE * 2 ** zoom)
+    return degrees_per_pixel * pixels * PRECISION
+
+
+def simplify(coordinates: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Keep the points that are further than `tolerance` from the simplified line, first and last always kept.
+    """
+    count = len(coordinates)
+    if count < 3 or tolerance <= 0:
+        return coordinates
+
+    points = coordinates.astype(np.float64)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment_start, segment = points[start], points[end] - points[start]
+        inner = points[start + 1:end] - segment_start
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return coordinates[keep]
@@ -0,0 +1,106 @@
+"""
+Web mercator (slippy map) tile maths and route rasterization
+"""
+from typing import Dict, Tuple, List
+
+import numpy as np
+
+from geo.polyline import to_degrees
+
+TILE_SIZE = 256
+
+
+def to_global_pixels(coordinates: np.ndarray, zoom: int) -> np.ndarray:
+    """
+    Polyline coordinates to (N, 2) float [x, y] pixel positions on the whole world map at this zoom level
+    """
+    latitudes, longitudes = to_degrees(coordinates).T
+    latitudes = np.radians(np.clip(latitudes, -85.05112878, 85.05112878))
+    world_size = TILE_SIZE * 2 ** zoom
+    x = (longitudes + 180) / 360 * world_size
+    y = (1 - np.log(np.tan(latitudes) + 1 / np.cos(latitudes)) / np.pi) / 2 * world_size
+    return np.stack([x, y], axis=1)
+
+
+def tile_bounds(zoom: int, x: int, y: int, buffer: float = 0) -> Tuple[float, float, float, float]:
+    """
+    (min_lat, min_lng, max_lat, max_lng) of the tile, grown by `buffer` tile widths on each side
+    """
+    tiles = 2 ** zoom
+    min_x, max_x = (x - buffer) / tiles, (x + 1 + buffer) / tiles
+    min_y, max_y = (y - buffer) / tiles, (y + 1 + buffer) / tiles
+    latitudes = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.array([max_y, min_y])))))
+    return float(latitudes[0]), min_x * 360 - 180, float(latitudes[1]), max_x * 360 - 180
+
+
+def to_tile_units(coordinates: np.ndarray, zoom: int, x: int, y: int, extent: int) -> np.ndarray:
+    """
+    Polyline coordinates to (N, 2) float positions in the tile, from 0 to `extent` on each axis
+    """
+    return (to_global_pixels(coordinates, zoom) - np.array([x, y]) * TILE_SIZE) * (extent / TILE_SIZE)
+
+
+def clip_lines(points: np.ndarray, low: float, high: float) -> List[np.ndarray]:
+    """
+    Parts of the line inside the square [low, high]², segments crossing its border are cut on the border
+    (Liang-Barsky, all segments at once)
+    """
+    if len(points) < 2:
+        return []
+    starts, deltas = points[:-1], np.diff(points, axis=0)
+    enter, leave = np.zeros(len(deltas)), np.ones(len(deltas))
+    visible = np.ones(len(deltas), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for p, q in ((-deltas, starts - low), (deltas, high - starts)):
+            ratios = q / p
+            visible &= ~((p == 0) & (q < 0)).any(axis=1)
+            enter = np.maximum(enter, np.where(p < 0, ratios, 0).max(axis=1))
+            leave = np.minimum(leave, np.where(p > 0, ratios, 1).min(axis=1))
+    segments = np.flatnonzero(visible & (enter <= leave))
+    if len(segments) == 0:
+        return []
+
+    # A segment continues the previous part when both are whole at their common point
+    starts_part = np.ones(len(segments), dtype=bool)
+    starts_part[1:] = ~((np.diff(segments) == 1) & (leave[segments[:-1]] >= 1) & (enter[segments[1:]] <= 0))
+    ends = np.stack([starts[segments] + deltas[segments] * enter[segments, None],
+                     starts[segments] + deltas[segments] * leave[segments, None]], axis=1)
+    clipped = ends[np.stack([starts_part, np.ones_like(starts_part)], axis=1)]
+    counts = 1 + starts_part
+    return np.split(clipped, (np.cumsum(counts) - counts)[starts_part][1:])
+
+
+def densify(pixels: np.ndarray) -> np.ndarray:
+    """
+    Interpolate points along each segment so consecutive points are at most one pixel apart
+    """
+    if len(pixels) < 2:
+        return pixels
+    deltas = np.diff(pixels, axis=0)
+    steps = np.maximum(1, np.ceil(np.abs(deltas).max(axis=1))).astype(np.int64)
+    segment = np.repeat(np.arange(len(deltas)), steps)
+    offsets = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+    ratios = (offsets / steps[segment])[:, None]
+    return np.concatenate([pixels[segment] + deltas[segment] * ratios, pixels[-1:]])
+
+
+def rasterize_route(coordinates: np.ndarray, zoom: int) -> Dict[Tuple[int, int], np.ndarray]:
+    """
+    Pixels crossed by the route, grouped by tile: {(x, y): flat pixel indices within the 256x256 tile}.
+    Each pixel appears once per route.
+    """
+    if len(coordinates) == 0:
+        return {}
+    world_size = TILE_SIZE * 2 ** zoom
+    pixels = np.floor(densify(to_global_pixels(coordinates, zoom))).astype(np.int64)
+    pixels = np.unique(np.clip(pixels[:, 0], 0, world_size - 1) * world_size + np.clip(pixels[:, 1], 0, world_size - 1))
+    pixel_x, pixel_y = pixels // world_size, pixels % world_size
+
+    tile_keys = (pixel_x // TILE_SIZE) * world_size + pixel_y // TILE_SIZE
+    order = np.argsort(tile_keys, kind="stable")
+    tile_keys = tile_keys[order]
+    flat_indices = ((pixel_y % TILE_SIZE) * TILE_SIZE + pixel_x % TILE_SIZE)[order]
+    boundaries = np.flatnonzero(np.diff(tile_keys)) + 1
+    return {(int(tile_key // world_size), int(tile_key % world_size)): indices
+            for tile_key, indices in zip(tile_keys[np.concatenate(([0], boundaries))],
+                                         np.split(flat_indices, boundaries))}
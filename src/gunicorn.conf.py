@@ -0,0 +1,30 @@
+"""
+Gunicorn settings of the API processes, the background work runs in worker.py
+
+    gunicorn -c gunicorn.conf.py main:app
+"""
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8010)}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+# Time given to the requests in flight on SIGTERM
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+
+def on_starting(server):
+    # Metrics files of a previous run would be aggregated with the new ones
+    metrics_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
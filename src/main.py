@@ -1,27 +1,42 @@
 """
 Main application
 """
+import math
 import os
-from typing import Annotated, Union
+import threading
+from datetime import datetime, date
+from typing import Annotated, Union, List
 
-import requests
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, Query, BackgroundTasks, Request
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Path, Response, BackgroundTasks
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 
-from services.itinerary import get_routes_by_date
+from monitoring.metrics import render_metrics
+from monitoring.middleware import MetricsMiddleware
+from services.bbox import get_routes_in_bounding_box
+from services.cache import response_cache
+from services.heatmap import EXPLORED_MIN_ZOOM, EXPLORED_MAX_ZOOM, stored_tile_key, tile_counts, render_tile
+from services.itinerary import get_routes_by_date, format_routes_async, RouteFormat
+from services.route_store import route_store, ROUTE_STORE_ENABLED
+from services.similarity import get_unique_routes, get_similar_routes
+from services.vector_tiles import build_routes_tile, MVT_MEDIA_TYPE
+from services.export import ExportFormat, EXPORT_MEDIA_TYPES, export_activities
+from services.responses import iter_ndjson, wants_ndjson, NDJSON_MEDIA_TYPE
 from schemas.strava_models.auth_code import AuthCode
 from schemas.webhooks import WebhookCreate
 from schemas.auth import LoginCreate
 from schemas.misc import StravaErrors
-from database.db import SessionLocal, engine, Base
-from models import crud
-from strava.api import StravaApi
-
-Base.metadata.create_all(bind=engine)
-
+from schemas.sync_jobs import SyncJob
+from schemas.activities import ActivityResponse, LocatedRouteResponse, UniqueRouteResponse, SimilarRouteResponse
+from schemas.stats import AthleteStats, StatsPeriod
+from database.db import AsyncSessionLocal, AsyncReadSessionLocal, has_replica
+from models import async_crud
+from strava.api import STRAVA_API_URL
+from strava.client import StravaApiError, get_async_strava_client, close_strava_client, close_async_strava_client
+from worker import start_worker_threads
 
 load_dotenv()
 
@@ -34,7 +49,7 @@ origins = [
     "http://www.rideout.earth"
 ]
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     SessionMiddleware,
     secret_key=os.getenv('SESSION_KEY'),
@@ -48,15 +63,36 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+# Off when the background work runs in its own process (python -m worker)
+RUN_BACKGROUND_WORKERS = os.getenv('RUN_BACKGROUND_WORKERS', 'true').lower() == 'true'
+_workers_stop = threading.Event()
+
+
+@app.on_event("startup")
+def start_workers():
+    if RUN_BACKGROUND_WORKERS:
+        start_worker_threads(_workers_stop, sync_concurrency=1, webhook_concurrency=1, enrich_concurrency=1,
+                             explored_concurrency=1)
+
+
+@app.on_event("shutdown")
+def stop_workers():
+    _workers_stop.set()
+
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    close_strava_client()
+    await close_async_strava_client()
+    await response_cache.close()
 
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 async def check_user_session(request: Request):
@@ -66,34 +102,67 @@ async def check_user_session(request: Request):
     return athlete_id
 
 
+async def get_read_db(athlete_id=Depends(check_user_session)):
+    """
+    Session on the read replica, for endpoints that never write. Right after a change of the athlete's activities the
+    primary is read instead: a lagging replica would have the old data cached under the new version.
+    """
+    session_factory = AsyncReadSessionLocal
+    if has_replica() and await response_cache.athlete_changed_recently(athlete_id):
+        session_factory = AsyncSessionLocal
+    async with session_factory() as db:
+        yield db
+
+
 @app.get("/ping")
-def ping():
+async def ping():
     return {"msg": "pong"}
 
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics of the hot paths
+    """
+    content, media_type = render_metrics()
+    return Response(content=content, headers={'Content-Type': media_type})
+
+
 @app.post("/exchange_token")
-def exchange_token(request: Request, auth_code: AuthCode, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def exchange_token(request: Request, auth_code: AuthCode, background_tasks: BackgroundTasks,
+                         db: AsyncSession = Depends(get_db)):
     """
     /exchange_token endpoint to get Strava short-lived access token
     """
     if auth_code.scope != "read,activity:read_all":
         raise HTTPException(status_code=400, detail="Select authorization read and activity:read_all")
 
-    url = (f"https://www.strava.com/api/v3/oauth/token?client_id={os.getenv('STRAVA_CLIENT_ID')}&"
-           f"client_secret={os.getenv('STRAVA_CLIENT_SECRET')}&code={auth_code.code}&grant_type=authorization_code")
-
-    response = requests.post(url, timeout=10)
+    params = {
+        'client_id': os.getenv('STRAVA_CLIENT_ID'),
+        'client_secret': os.getenv('STRAVA_CLIENT_SECRET'),
+        'code': auth_code.code,
+        'grant_type': 'authorization_code'
+    }
+    try:
+        response = await get_async_strava_client().post(f"{STRAVA_API_URL}/oauth/token", params=params,
+                                                        wait_for_quota=False)
+    except StravaApiError as e:
+        # Rate limited or unreachable: the login is not held until the next quota window
+        headers = {"Retry-After": str(math.ceil(e.retry_after))} if e.retry_after else None
+        raise HTTPException(status_code=503, detail="Strava is unavailable, try again later", headers=headers)
 
     if response.status_code == 200:
         login_create_data = LoginCreate(**response.json())
-        db_athlete = crud.get_athlete_by_id(db, login_create_data.athlete.id)
+        db_athlete = await async_crud.get_athlete_by_id(db, login_create_data.athlete.id)
         if db_athlete is None:
-            db_athlete = crud.create_athlete_login(db, login_create_data)
-            background_tasks.add_task(back_populate, db, db_athlete.id)
+            db_athlete = await async_crud.create_athlete_login(db, login_create_data)
+            await back_populate(db, db_athlete.id)
         else:
-            crud.update_athlete_login(db, login_create_data, athlete_id=db_athlete.id)
+            await async_crud.update_athlete_login(db, login_create_data, athlete_id=db_athlete.id)
 
         request.session['athlete_id'] = db_athlete.id
+        if ROUTE_STORE_ENABLED:
+            background_tasks.add_task(route_store.warm_up, db_athlete.id)
         return db_athlete.id
 
     elif response.status_code == 400:
@@ -105,15 +174,22 @@ def exchange_token(request: Request, auth_code: AuthCode, background_tasks: Back
 
 
 @app.post("/webhook", status_code=200)
-def webhook(webhook_activity: WebhookCreate, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def webhook(webhook_activity: WebhookCreate, db: AsyncSession = Depends(get_db)):
     """
-    /webhook endpoint to get Strava webhook activities
+    /webhook endpoint to get Strava webhook activities. Events are queued in DB and applied by the webhook worker.
+    Redeliveries of an event already received are acknowledged without queueing it again.
     """
-    background_tasks.add_task(register_webhook, webhook_activity, db)
+    if webhook_activity.object_type != "activity":
+        return
+    if await async_crud.get_athlete_by_id(db, athlete_id=webhook_activity.owner_id) is None:
+        print(f"Owner not registered in users. Skip webhook {webhook_activity}")
+        return
+    if not await async_crud.create_webhook(db, webhook_activity):
+        print(f"Duplicate webhook {webhook_activity}, skip")
 
 
 @app.get("/webhook")
-def webhook_validation(verify_token: Annotated[Union[str, None], Query(alias="hub.verify_token")] = None,
+async def webhook_validation(verify_token: Annotated[Union[str, None], Query(alias="hub.verify_token")] = None,
                        challenge: Annotated[Union[str, None], Query(alias="hub.challenge")] = None,
                        mode: Annotated[Union[str, None], Query(alias="hub.mode")] = None,
                        ):
@@ -125,67 +201,201 @@ def webhook_validation(verify_token: Annotated[Union[str, None], Query(alias="hu
     return {'hub.challenge': challenge}
 
 
-def register_webhook(webhook_activity: WebhookCreate, db: Session):
-    """
-    async registration of the webhook in DB
-    """
-    strava_api = StravaApi(db=db, athlete_id=webhook_activity.owner_id)
-    athlete = crud.get_athlete_by_id(db, athlete_id=webhook_activity.owner_id)
-    if athlete is not None and webhook_activity.object_type == "activity":
-        webhook_db = crud.create_webhook(db, webhook_activity)
-
-        if webhook_activity.aspect_type == "create":
-            strava_api.get_activity_from_id(webhook_db.object_id)
-        elif webhook_activity.aspect_type == "update":
-            crud.update_activity_by_id(
-                db=db,
-                activity_id=webhook_activity.object_id,
-                changes=webhook_activity.updates
-            )
-        elif webhook_activity.aspect_type == "delete":
-            crud.delete_activity_by_id(
-                db=db,
-                activity_id=webhook_activity.object_id
-            )
-        crud.delete_webhook_by_id(db, webhook_db.id)
-    else:
-        print(f"Owner not registered in users. Skip webhook {webhook_activity}")
+@app.get("/activity/{activity_id}", response_model=ActivityResponse)
+async def get_activity(request: Request,
+                       activity_id: int,
+                       db: AsyncSession = Depends(get_read_db),
+                       athlete_id=Depends(check_user_session)):
+    async def build():
+        activity = await async_crud.get_activity_columns(db, activity_id, ActivityResponse.model_fields)
+        if activity is None:
+            raise HTTPException(status_code=404, detail="Activity not found")
+        if activity.athlete_id != athlete_id:
+            raise HTTPException(status_code=403, detail="You cannot access another user's activity")
+        return dict(activity._mapping)
+
+    key = await response_cache.activity_key(athlete_id, activity_id, request)
+    return await response_cache.respond(request, key, build)
+
+
+@app.get("/route/{activity_id}", response_model=Union[str, List[List[float]], None])
+async def get_activity(request: Request,
+                       activity_id: int,
+                       zoom: Annotated[Union[int, None], Query(ge=0, le=22)] = None,
+                       route_format: Annotated[RouteFormat, Query(alias="format")] = RouteFormat.polyline,
+                       db: AsyncSession = Depends(get_read_db),
+                       athlete_id=Depends(check_user_session)):
+    async def build():
+        activity = await async_crud.get_activity_by_id(db=db, activity_id=activity_id, with_route=True)
+        if activity is None:
+            raise HTTPException(status_code=404, detail="Activity not found")
+        if activity.athlete_id != athlete_id:
+            raise HTTPException(status_code=403, detail="You cannot access another user's activity")
+        return (await format_routes_async([activity], with_route=True, zoom=zoom, route_format=route_format))[0]
+
+    key = await response_cache.activity_key(athlete_id, activity_id, request)
+    return await response_cache.respond(request, key, build)
+
+
+@app.get("/route/{activity_id}/similar", response_model=List[SimilarRouteResponse])
+async def similar_routes(request: Request,
+                         activity_id: int,
+                         zoom: Annotated[Union[int, None], Query(ge=0, le=22)] = None,
+                         route_format: Annotated[RouteFormat, Query(alias="format")] = RouteFormat.polyline,
+                         db: AsyncSession = Depends(get_read_db),
+                         athlete_id=Depends(check_user_session)):
+    """
+    The athlete's other activities on nearly the same route, most similar first
+    """
+    async def build():
+        activity = await async_crud.get_activity_columns(db, activity_id, ["athlete_id"])
+        if activity is None:
+            raise HTTPException(status_code=404, detail="Activity not found")
+        if activity.athlete_id != athlete_id:
+            raise HTTPException(status_code=403, detail="You cannot access another user's activity")
+        return await get_similar_routes(athlete_id=athlete_id, activity_id=activity_id, db=db, zoom=zoom,
+                                        route_format=route_format)
+
+    key = await response_cache.athlete_key(athlete_id, request)
+    return await response_cache.respond(request, key, build)
+
+
+@app.get("/routes/", response_model=List[LocatedRouteResponse])
+async def get_activity(request: Request,
+                       limit: Annotated[int, Query(ge=1, le=200)] = 10,
+                       before: Union[datetime, None] = None,
+                       before_id: Union[int, None] = None,
+                       zoom: Annotated[Union[int, None], Query(ge=0, le=22)] = None,
+                       route_format: Annotated[RouteFormat, Query(alias="format")] = RouteFormat.polyline,
+                       db: AsyncSession = Depends(get_read_db),
+                       athlete_id=Depends(check_user_session)):
+    async def build():
+        return await get_routes_by_date(athlete_id=athlete_id, db=db, limit=limit, before=before, before_id=before_id,
+                                        zoom=zoom, route_format=route_format)
+
+    key = await response_cache.athlete_key(athlete_id, request)
+    return await response_cache.respond(request, key, build)
+
+
+@app.get("/routes/unique", response_model=List[UniqueRouteResponse])
+async def get_distinct_routes(request: Request,
+                              zoom: Annotated[Union[int, None], Query(ge=0, le=22)] = None,
+                              route_format: Annotated[RouteFormat, Query(alias="format")] = RouteFormat.polyline,
+                              db: AsyncSession = Depends(get_read_db),
+                              athlete_id=Depends(check_user_session)):
+    """
+    One route per group of near-identical routes, with the number of activities on it
+    """
+    async def build():
+        return await get_unique_routes(athlete_id=athlete_id, db=db, zoom=zoom, route_format=route_format)
+
+    key = await response_cache.athlete_key(athlete_id, request)
+    return await response_cache.respond(request, key, build)
+
+
+@app.get("/routes/bbox", response_model=List[LocatedRouteResponse])
+async def get_routes_in_viewport(request: Request,
+                                 min_lat: Annotated[float, Query(ge=-90, le=90)],
+                                 min_lng: Annotated[float, Query(ge=-180, le=180)],
+                                 max_lat: Annotated[float, Query(ge=-90, le=90)],
+                                 max_lng: Annotated[float, Query(ge=-180, le=180)],
+                                 limit: Annotated[int, Query(ge=1, le=1000)] = 200,
+                                 zoom: Annotated[Union[int, None], Query(ge=0, le=22)] = None,
+                                 route_format: Annotated[RouteFormat, Query(alias="format")] = RouteFormat.polyline,
+                                 db: AsyncSession = Depends(get_read_db),
+                                 athlete_id=Depends(check_user_session)):
+    if min_lat > max_lat or min_lng > max_lng:
+        raise HTTPException(status_code=400, detail="Bounding box min values must be lower than max values")
+    routes = await get_routes_in_bounding_box(athlete_id=athlete_id, db=db,
+                                              bounding_box=(min_lat, min_lng, max_lat, max_lng), limit=limit,
+                                              zoom=zoom, route_format=route_format)
+    if wants_ndjson(request):
+        return StreamingResponse(iter_ndjson(routes), media_type=NDJSON_MEDIA_TYPE)
+    return ORJSONResponse(routes)
+
+
+@app.get("/routes/tiles/{z}/{x}/{y}.mvt")
+async def get_routes_tile(request: Request,
+                          z: Annotated[int, Path(ge=0, le=22)],
+                          x: Annotated[int, Path(ge=0)],
+                          y: Annotated[int, Path(ge=0)],
+                          db: AsyncSession = Depends(get_read_db),
+                          athlete_id=Depends(check_user_session)):
+    """
+    Mapbox Vector Tile of the athlete's routes, layer "routes" with the activity id, date and sport_type
+    """
+    if x >= 2 ** z or y >= 2 ** z:
+        raise HTTPException(status_code=404, detail="Tile out of bounds")
 
+    async def build():
+        return await build_routes_tile(athlete_id, db, z, x, y)
 
-@app.get("/activity/{activity_id}")
-def get_activity(activity_id: int,
-                 db: Session = Depends(get_db),
-                 athlete_id=Depends(check_user_session)):
-    activity = crud.get_activity_by_id(db=db, activity_id=activity_id)
-    if activity.athlete_id != athlete_id:
-        raise HTTPException(status_code=403, detail="You cannot access another user's activity")
-    return activity
+    key = await response_cache.athlete_key(athlete_id, request)
+    return await response_cache.respond(request, key, build, media_type=MVT_MEDIA_TYPE)
 
 
-@app.get("/route/{activity_id}")
-def get_activity(activity_id: int,
-                 db: Session = Depends(get_db),
+@app.get("/export")
+async def export(export_format: Annotated[ExportFormat, Query(alias="format")] = ExportFormat.ndjson,
+                 gzip: bool = False,
                  athlete_id=Depends(check_user_session)):
-    activity = crud.get_activity_by_id(db=db, activity_id=activity_id)
-    if activity.athlete_id != athlete_id:
-        raise HTTPException(status_code=403, detail="You cannot access another user's activity")
-    return activity.polyline
+    """
+    Whole activity archive of the athlete as NDJSON, GPX or GeoJSON, streamed as it is read from DB
+    """
+    filename = f"activities.{export_format.value}" + (".gz" if gzip else "")
+    return StreamingResponse(export_activities(athlete_id, export_format, gzip=gzip),
+                             media_type="application/gzip" if gzip else EXPORT_MEDIA_TYPES[export_format],
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@app.get("/stats", response_model=List[AthleteStats])
+async def get_stats(request: Request,
+                    period: StatsPeriod = StatsPeriod.month,
+                    sport_type: Union[str, None] = None,
+                    since: Union[date, None] = None,
+                    db: AsyncSession = Depends(get_read_db),
+                    athlete_id=Depends(check_user_session)):
+    """
+    Count, distance, moving time and elevation gain of the athlete per week, month or year and sport type
+    """
+    async def build():
+        stats = await async_crud.get_athlete_stats(db, athlete_id, period.value, sport_type=sport_type, since=since)
+        return [AthleteStats.model_validate(row).model_dump() for row in stats]
 
+    key = await response_cache.athlete_key(athlete_id, request)
+    return await response_cache.respond(request, key, build)
 
-@app.get("/routes/")
-def get_activity(db: Session = Depends(get_db),
-                 athlete_id=Depends(check_user_session)):
-    activities = get_routes_by_date(athlete_id=athlete_id, db=db)
-    return activities[-10:]
+
+@app.get("/tiles/{z}/{x}/{y}")
+async def get_explored_tile(z: Annotated[int, Path(ge=EXPLORED_MIN_ZOOM, le=EXPLORED_MAX_ZOOM + 8)],
+                            x: Annotated[int, Path(ge=0)],
+                            y: Annotated[int, Path(ge=0)],
+                            db: AsyncSession = Depends(get_read_db),
+                            athlete_id=Depends(check_user_session)):
+    """
+    PNG tile of the area explored by the athlete, more opaque where they went more often
+    """
+    if x >= 2 ** z or y >= 2 ** z:
+        raise HTTPException(status_code=404, detail="Tile out of bounds")
+    tile = await async_crud.get_explored_tile(db, athlete_id, *stored_tile_key(z, x, y))
+    return Response(content=render_tile(tile_counts(tile, z, x, y)), media_type="image/png")
+
+
+@app.post("/backpopulate", status_code=200, response_model=SyncJob)
+async def back_populate_post(athlete_id: int, db: AsyncSession = Depends(get_db)):
+    return await back_populate(db, athlete_id)
 
 
-@app.post("/backpopulate", status_code=200)
-def back_populate_post(athlete_id: int, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
-    background_tasks.add_task(back_populate, db, athlete_id)
+@app.get("/backpopulate", response_model=SyncJob)
+async def back_populate_progress(db: AsyncSession = Depends(get_db),
+                                 athlete_id=Depends(check_user_session)):
+    job = await async_crud.get_sync_job_by_athlete_id(db, athlete_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No import started for this athlete")
+    return job
 
 
-def back_populate(db: Session, athlete_id: int):
-    api = StravaApi(db=db, athlete_id=athlete_id)
-    activities = api.list_activity_for_athlete_id()
-    crud.create_activity_batch(db=db, activities=activities)
-    return activities
\ No newline at end of file
+async def back_populate(db: AsyncSession, athlete_id: int):
+    """
+    Queue an incremental sync of the athlete's activities, picked up by the sync worker
+    """
+    return await async_crud.enqueue_sync_job(db, athlete_id)
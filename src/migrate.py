@@ -0,0 +1,107 @@
+"""
+Brings the database schema in line with the models, run once per deploy before the API and worker start:
+
+    python -m migrate
+
+Missing tables, columns and indexes are created, then the columns computed from the polylines (route, fingerprint,
+bounding box) are filled for the activities stored before they existed. Nothing is dropped or altered: renames and type
+changes still need to be written by hand.
+"""
+import os
+from typing import List, Optional
+
+from sqlalchemy import inspect, text, select, delete, update, func, or_, and_, bindparam
+from sqlalchemy.engine import Connection, Engine
+
+from database.db import Base, get_engine
+# Every model module, so their tables are registered on Base.metadata
+from models import activities, athletes, athlete_stats, auth, explored, sync_jobs, webhooks  # noqa: F401
+from models.crud import route_columns
+
+BACKFILL_BATCH_SIZE = int(os.getenv('BACKFILL_BATCH_SIZE', 1000))
+
+
+def _add_missing_columns(connection: Connection):
+    inspector = inspect(connection)
+    quote = connection.dialect.identifier_preparer.quote
+    ddl_compiler = connection.dialect.ddl_compiler(connection.dialect, None)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            # The server default also fills the column of the existing rows
+            default = ddl_compiler.get_column_default_string(column)
+            connection.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"
+                                    + (f" DEFAULT {default}" if default is not None else "")))
+            print(f"Added column {table.name}.{column.name}")
+
+
+def _delete_duplicate_webhooks(connection: Connection):
+    """
+    Redeliveries queued before events were unique on (object_id, aspect_type, event_time) would fail the creation of
+    the unique index, the first delivery is kept
+    """
+    index = next(index for index in webhooks.WebhookActivitiesModel.__table__.indexes if index.unique)
+    if index.name in {existing["name"] for existing in inspect(connection).get_indexes(index.table.name)}:
+        return
+    table = index.table
+    first_deliveries = select(func.min(table.c.id)).group_by(table.c.object_id, table.c.aspect_type, table.c.event_time)
+    deleted = connection.execute(delete(table).where(table.c.id.not_in(first_deliveries))).rowcount
+    if deleted:
+        print(f"Deleted {deleted} duplicate webhook events")
+
+
+def _create_missing_indexes(connection: Connection):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _latlng(lat: Optional[str], lng: Optional[str]) -> List[float]:
+    return [float(lat), float(lng)] if lat is not None and lng is not None else []
+
+
+def backfill_route_columns(engine: Engine, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """
+    Compute the route columns of the activities missing them, one transaction per batch in id order so an interrupted
+    run keeps its progress. Returns the number of activities filled.
+    """
+    table = activities.ActivityModel.__table__
+    missing = or_(and_(table.c.polyline.is_not(None), table.c.polyline != "",
+                       or_(table.c.route.is_(None), table.c.fingerprint.is_(None))),
+                  and_(table.c.min_lat.is_(None), table.c.start_lat.is_not(None), table.c.end_lat.is_not(None)))
+    query = (select(table.c.id, table.c.polyline,
+                    table.c.start_lat, table.c.start_lng, table.c.end_lat, table.c.end_lng)
+             .where(missing)
+             .order_by(table.c.id)
+             .limit(batch_size))
+    filled, last_id = 0, None
+    while True:
+        with engine.begin() as connection:
+            # Rows whose polyline holds no route still match, the id cursor reads them once
+            rows = connection.execute(query if last_id is None else query.where(table.c.id > last_id)).all()
+            if not rows:
+                return filled
+            connection.execute(update(table).where(table.c.id == bindparam("activity_id")),
+                               [{"activity_id": row.id,
+                                 **route_columns(row.polyline, _latlng(row.start_lat, row.start_lng),
+                                                 _latlng(row.end_lat, row.end_lng))}
+                                for row in rows])
+        filled, last_id = filled + len(rows), rows[-1].id
+        print(f"Filled the route columns of {filled} activities")
+
+
+def migrate():
+    with get_engine().begin() as connection:
+        Base.metadata.create_all(bind=connection)
+        _add_missing_columns(connection)
+        _delete_duplicate_webhooks(connection)
+        _create_missing_indexes(connection)
+    backfill_route_columns(get_engine())
+
+
+if __name__ == "__main__":
+    migrate()
+    print("Database schema up to date")
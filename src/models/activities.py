@@ -1,11 +1,15 @@
-from sqlalchemy import Column, BigInteger, Integer, String, DateTime, Float, Boolean, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import (Column, BigInteger, Integer, String, DateTime, Float, Boolean, ForeignKey, LargeBinary, Index,
+                        func)
+from sqlalchemy.orm import relationship, deferred
 
 from database.db import Base
 
 
 class ActivityModel(Base):
     __tablename__ = "activities"
+    __table_args__ = (
+        Index("ix_activities_athlete_id_start_date_local", "athlete_id", "start_date_local"),
+    )
 
     id = Column(BigInteger, primary_key=True, index=True)
     athlete_id = Column(BigInteger, ForeignKey('athletes.id'))
@@ -25,7 +29,13 @@ class ActivityModel(Base):
     start_lng = Column(String)
     end_lat = Column(String)
     end_lng = Column(String)
+    min_lat = Column(Float)
+    min_lng = Column(Float)
+    max_lat = Column(Float)
+    max_lng = Column(Float)
     polyline = Column(String)
+    route = deferred(Column(LargeBinary))  # decoded polyline, see geo.polyline.pack_coordinates
+    fingerprint = deferred(Column(LargeBinary))  # MinHash of the route, see geo.fingerprint.route_fingerprint
     trainer = Column(Boolean)
     commute = Column(Boolean)
     manual = Column(Boolean)
@@ -41,3 +51,26 @@ class ActivityModel(Base):
     device_watts = Column(Boolean)
     max_watts = Column(Integer)
     weighted_average_watts = Column(Integer)
+    # Set once the DetailedActivity was stored (full resolution polyline, gear), NULL for summary only activities
+    detailed_at = Column(DateTime)
+    # The enrichment worker does not pick the activity again before this date (fetch in progress or failed)
+    detail_retry_at = Column(DateTime)
+    # Hash of the columns written from Strava data, see crud._content_hash. NULL after a partial update.
+    content_hash = Column(BigInteger)
+
+
+# Queue of the enrichment worker, most recent activities first
+Index(
+    "ix_activities_summary_only",
+    ActivityModel.start_date_local.desc(),
+    postgresql_where=ActivityModel.detailed_at.is_(None),
+    sqlite_where=ActivityModel.detailed_at.is_(None),
+)
+
+# Viewport queries on PostgreSQL use a GiST index on the built-in box type, no extension required
+Index(
+    "ix_activities_bounding_box",
+    func.box(func.point(ActivityModel.min_lng, ActivityModel.min_lat),
+             func.point(ActivityModel.max_lng, ActivityModel.max_lat)),
+    postgresql_using="gist",
+).ddl_if(dialect="postgresql")
@@ -0,0 +1,216 @@
+"""
+Async counterparts of models.crud used by the request handlers
+"""
+from datetime import datetime, date
+from typing import Optional, List, Tuple, Iterable, AsyncIterator
+
+from sqlalchemy import select, func, case, tuple_, Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import undefer
+
+from models.activities import ActivityModel
+from models.auth import LoginDetailsModel
+from models.crud import _insert_for_dialect
+from models.athletes import AthleteModel
+from models.athlete_stats import AthleteStatsModel
+from models.explored import ExploredTileModel
+from models.sync_jobs import SyncJobModel
+from models.webhooks import WebhookActivitiesModel
+from schemas.auth import LoginCreate, LoginBase
+from schemas.webhooks import WebhookCreate
+from strava.tokens import token_cache
+
+
+async def get_athlete_by_id(db: AsyncSession, athlete_id: int) -> Optional[AthleteModel]:
+    return await db.get(AthleteModel, athlete_id)
+
+
+async def create_athlete_login(db: AsyncSession, login_info: LoginCreate) -> Optional[AthleteModel]:
+    db_athlete = AthleteModel(**login_info.athlete.model_dump())
+    db_athlete_login = LoginDetailsModel(**login_info.model_dump(exclude={'athlete'}), athlete_id=db_athlete.id)
+
+    db.add(db_athlete)
+    db.add(db_athlete_login)
+    await db.commit()
+    return db_athlete
+
+
+async def update_athlete_login(db: AsyncSession, login_info: LoginBase, athlete_id: int) -> Optional[LoginDetailsModel]:
+    login = await get_athlete_login(db, athlete_id)
+    login.expires_at = login_info.expires_at
+    login.refresh_token = login_info.refresh_token
+    login.access_token = login_info.access_token
+    await db.commit()
+    token_cache.invalidate(athlete_id)
+    return login
+
+
+async def get_athlete_login(db: AsyncSession, athlete_id: int) -> Optional[LoginDetailsModel]:
+    return await db.scalar(select(LoginDetailsModel).where(LoginDetailsModel.athlete_id == athlete_id))
+
+
+async def create_webhook(db: AsyncSession, webhook: WebhookCreate) -> bool:
+    """
+    Queue the event. False for a redelivery of an event already received, which the unique index turns away whatever
+    the process that received the first delivery.
+    """
+    insert = _insert_for_dialect(db.get_bind().dialect.name)
+    result = await db.execute(insert(WebhookActivitiesModel)
+                              .values(**webhook.model_dump(), attempts=0, available_at=datetime.utcnow(),
+                                      status="queued")
+                              .on_conflict_do_nothing(index_elements=["object_id", "aspect_type", "event_time"]))
+    await db.commit()
+    return result.rowcount > 0
+
+
+async def get_activity_by_id(db: AsyncSession, activity_id: int, with_route: bool = False) -> Optional[ActivityModel]:
+    return await db.get(ActivityModel, activity_id, options=[undefer(ActivityModel.route)] if with_route else None)
+
+
+async def get_activity_columns(db: AsyncSession, activity_id: int, columns: Iterable[str]) -> Optional[Row]:
+    return (await db.execute(select(*(getattr(ActivityModel, column) for column in columns))
+                             .where(ActivityModel.id == activity_id))).first()
+
+
+async def get_routes_page(db: AsyncSession, athlete_id: int, limit: int, before: Optional[datetime] = None,
+                          before_id: Optional[int] = None, with_route: bool = False) -> List[Row]:
+    """
+    Most recent routes of the athlete before the (`before`, `before_id`) cursor in (start_date_local, id) order, or
+    started before `before` without `before_id`, newest first. Served from the (athlete_id, start_date_local) index
+    whatever the size of the history.
+    """
+    query = select(*_route_columns(with_route)).where(ActivityModel.athlete_id == athlete_id)
+    if before is not None and before_id is not None:
+        query = query.where(tuple_(ActivityModel.start_date_local, ActivityModel.id) < tuple_(before, before_id))
+    elif before is not None:
+        query = query.where(ActivityModel.start_date_local < before)
+    result = await db.execute(query.order_by(ActivityModel.start_date_local.desc(), ActivityModel.id.desc())
+                              .limit(limit))
+    return list(result)
+
+
+async def stream_activities(db: AsyncSession, athlete_id: int, columns: Iterable[str],
+                            batch_size: int) -> AsyncIterator[Row]:
+    """
+    Every activity of the athlete, oldest first, fetched `batch_size` rows at a time through a server-side cursor
+    """
+    query = (select(*(getattr(ActivityModel, column) for column in columns))
+             .where(ActivityModel.athlete_id == athlete_id)
+             .order_by(ActivityModel.start_date_local, ActivityModel.id)
+             .execution_options(yield_per=batch_size))
+    async for row in await db.stream(query):
+        yield row
+
+
+async def get_bounding_boxes(db: AsyncSession, athlete_id: int) -> List[Row]:
+    result = await db.execute(select(ActivityModel.id, ActivityModel.min_lat, ActivityModel.min_lng,
+                                     ActivityModel.max_lat, ActivityModel.max_lng)
+                              .where(ActivityModel.athlete_id == athlete_id, ActivityModel.min_lat.is_not(None)))
+    return list(result)
+
+
+async def get_fingerprints(db: AsyncSession, athlete_id: int) -> List[Row]:
+    """
+    (id, fingerprint, polyline) of the athlete's activities, oldest first. The polyline is only read for the
+    activities stored before fingerprints were computed.
+    """
+    polyline = case((ActivityModel.fingerprint.is_(None), ActivityModel.polyline)).label("polyline")
+    result = await db.execute(select(ActivityModel.id, ActivityModel.fingerprint, polyline)
+                              .where(ActivityModel.athlete_id == athlete_id)
+                              .order_by(ActivityModel.start_date_local, ActivityModel.id))
+    return list(result)
+
+
+async def get_athlete_routes(db: AsyncSession, athlete_id: int,
+                             activity_ids: Optional[List[int]] = None) -> List[Row]:
+    """
+    Everything the route endpoints read of the athlete's activities (or only of `activity_ids`), oldest first
+    """
+    query = (select(*_route_columns(with_route=True, with_sport_type=True), ActivityModel.min_lat,
+                    ActivityModel.min_lng, ActivityModel.max_lat, ActivityModel.max_lng)
+             .where(ActivityModel.athlete_id == athlete_id))
+    if activity_ids is not None:
+        query = query.where(ActivityModel.id.in_(activity_ids))
+    result = await db.execute(query.order_by(ActivityModel.start_date_local, ActivityModel.id))
+    return list(result)
+
+
+def _route_columns(with_route: bool, with_sport_type: bool = False) -> list:
+    columns = [ActivityModel.id, ActivityModel.polyline, ActivityModel.start_date_local]
+    if with_route:
+        columns.append(ActivityModel.route)
+    if with_sport_type:
+        columns.append(ActivityModel.sport_type)
+    return columns
+
+
+async def get_routes_by_ids(db: AsyncSession, activity_ids: List[int], limit: Optional[int],
+                            with_route: bool = False, with_sport_type: bool = False) -> List[Row]:
+    result = await db.execute(select(*_route_columns(with_route, with_sport_type))
+                              .where(ActivityModel.id.in_(activity_ids))
+                              .order_by(ActivityModel.start_date_local.desc())
+                              .limit(limit))
+    return list(result)
+
+
+async def get_routes_in_bounding_box(db: AsyncSession, athlete_id: int, bounding_box: Tuple[float, float, float, float],
+                                     limit: Optional[int], with_route: bool = False,
+                                     with_sport_type: bool = False) -> List[Row]:
+    """
+    PostgreSQL only, served by the ix_activities_bounding_box GiST index. No limit when `limit` is None.
+    """
+    min_lat, min_lng, max_lat, max_lng = bounding_box
+    activity_box = func.box(func.point(ActivityModel.min_lng, ActivityModel.min_lat),
+                            func.point(ActivityModel.max_lng, ActivityModel.max_lat))
+    viewport = func.box(func.point(min_lng, min_lat), func.point(max_lng, max_lat))
+    result = await db.execute(select(*_route_columns(with_route, with_sport_type))
+                              .where(ActivityModel.athlete_id == athlete_id, activity_box.op("&&")(viewport))
+                              .order_by(ActivityModel.start_date_local.desc())
+                              .limit(limit))
+    return list(result)
+
+
+async def get_explored_tile(db: AsyncSession, athlete_id: int, zoom: int, x: int,
+                            y: int) -> Optional[ExploredTileModel]:
+    return await db.scalar(select(ExploredTileModel)
+                           .where(ExploredTileModel.athlete_id == athlete_id, ExploredTileModel.zoom == zoom,
+                                  ExploredTileModel.x == x, ExploredTileModel.y == y))
+
+
+async def get_athlete_stats(db: AsyncSession, athlete_id: int, period: str, sport_type: Optional[str] = None,
+                            since: Optional[date] = None) -> List[AthleteStatsModel]:
+    """
+    Rollups of the athlete for the period, oldest first. Read from the athlete_stats unique index.
+    """
+    query = select(AthleteStatsModel).where(AthleteStatsModel.athlete_id == athlete_id,
+                                            AthleteStatsModel.period == period)
+    if sport_type is not None:
+        query = query.where(AthleteStatsModel.sport_type == sport_type)
+    if since is not None:
+        query = query.where(AthleteStatsModel.period_start >= since)
+    result = await db.scalars(query.order_by(AthleteStatsModel.period_start, AthleteStatsModel.sport_type))
+    return list(result)
+
+
+async def get_sync_job_by_athlete_id(db: AsyncSession, athlete_id: int) -> Optional[SyncJobModel]:
+    return await db.scalar(select(SyncJobModel).where(SyncJobModel.athlete_id == athlete_id))
+
+
+async def enqueue_sync_job(db: AsyncSession, athlete_id: int) -> SyncJobModel:
+    """
+    See crud.enqueue_sync_job
+    """
+    now = datetime.utcnow()
+    job = await get_sync_job_by_athlete_id(db, athlete_id)
+    if job is None:
+        job = SyncJobModel(athlete_id=athlete_id, status="pending", last_page=0, last_start_date=0, activities=0,
+                           attempts=0, created_at=now, updated_at=now)
+        db.add(job)
+    elif job.status != "running":
+        job.status = "pending"
+        job.error = None
+        job.attempts = 0
+        job.available_at = None
+        job.updated_at = now
+    await db.commit()
+    return job
@@ -0,0 +1,25 @@
+from sqlalchemy import Column, BigInteger, Integer, String, Date, Float, ForeignKey, Index
+
+from database.db import Base, BigIntegerId
+
+
+class AthleteStatsModel(Base):
+    """
+    Totals of the athlete's activities per period (week, month, year starting on that date) and sport type, kept up to
+    date by the crud functions writing activities
+    """
+    __tablename__ = "athlete_stats"
+    __table_args__ = (
+        Index("ix_athlete_stats_athlete_id_period_period_start_sport_type",
+              "athlete_id", "period", "period_start", "sport_type", unique=True),
+    )
+
+    id = Column(BigIntegerId, primary_key=True, index=True)
+    athlete_id = Column(BigInteger, ForeignKey('athletes.id'))
+    period = Column(String)
+    period_start = Column(Date)
+    sport_type = Column(String)
+    count = Column(Integer, default=0)
+    distance = Column(Float, default=0)
+    moving_time = Column(BigInteger, default=0)
+    elevation_gain = Column(Float, default=0)
@@ -1,13 +1,13 @@
 from sqlalchemy import Column, BigInteger, String, ForeignKey
 from sqlalchemy.orm import relationship
 
-from database.db import Base
+from database.db import Base, BigIntegerId
 
 
 class LoginDetailsModel(Base):
     __tablename__ = "login_details"
 
-    id = Column(BigInteger, primary_key=True, index=True)
+    id = Column(BigIntegerId, primary_key=True, index=True)
     expires_at = Column(BigInteger)
     refresh_token = Column(String)
     access_token = Column(String)
@@ -1,15 +1,40 @@
-from typing import Optional, Union, Dict, Any, List
+import hashlib
+import uuid
+from datetime import datetime, timedelta, date
+from typing import Optional, Union, Dict, Any, List, Iterator, Iterable, Tuple, Set
 
 from sqlalchemy.orm import Session
-from sqlalchemy import select
-
+import numpy as np
+from sqlalchemy import (select, delete, update, case, func, or_, and_, not_, false, null, literal, tuple_, Insert, Row,
+                        Select, Executable, ColumnElement)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from geo.fingerprint import route_fingerprint
+from geo.polyline import decode_polyline, pack_coordinates, to_degrees
 from models.activities import ActivityModel
+from models.athlete_stats import AthleteStatsModel
+from models.events import notify_activities_changed
+from models.explored import ExploredTileModel, ExploredActivityModel, ExploredChangeModel
 from models.auth import LoginDetailsModel
 from models.athletes import AthleteModel
+from models.sync_jobs import SyncJobModel
 from models.webhooks import WebhookActivitiesModel
 from schemas.activities import DetailedActivity, SummaryActivity
 from schemas.auth import LoginCreate, LoginBase
-from schemas.webhooks import WebhookCreate
+from strava.tokens import token_cache
+
+UPSERT_CHUNK_SIZE = 500
+
+# Columns the athlete_stats rollups are computed from, in the order _add_stats expects them
+_STATS_COLUMNS = (ActivityModel.athlete_id, ActivityModel.start_date_local, ActivityModel.sport_type,
+                  ActivityModel.distance, ActivityModel.moving_time, ActivityModel.total_elevation_gain)
+StatsKey = Tuple[int, str, date, str]  # athlete_id, period, period_start, sport_type
+# Columns where the DetailedActivity is better than the SummaryActivity of the activity list
+_DETAIL_COLUMNS = ('polyline', 'route', 'fingerprint', 'min_lat', 'min_lng', 'max_lat', 'max_lng', 'gear_id',
+                   'detailed_at')
+# The content hash covers the other columns, the detail ones are compared on their own as a summary may not replace them
+_UNHASHED_COLUMNS = {'id', 'content_hash', *_DETAIL_COLUMNS}
 
 
 def get_athlete_by_id(db: Session, athlete_id: int) -> Optional[AthleteModel]:
@@ -35,6 +60,7 @@ def update_athlete_login(db: Session, login_info: LoginBase, athlete_id: int) ->
     login.refresh_token = login_info.refresh_token
     login.access_token = login_info.access_token
     db.commit()
+    token_cache.invalidate(athlete_id)
     db.refresh(login)
     return login
 
@@ -43,76 +69,323 @@ def get_athlete_login(db: Session, athlete_id: int) -> Optional[LoginDetailsMode
     return db.query(LoginDetailsModel).filter(LoginDetailsModel.athlete_id == athlete_id).first()
 
 
-def create_webhook(db: Session, webhook: WebhookCreate) -> Optional[WebhookActivitiesModel]:
-    webhook = WebhookActivitiesModel(**webhook.model_dump())
-    db.add(webhook)
+def claim_webhooks(db: Session, batch_size: int, lease: timedelta) -> List[Row]:
+    """
+    Lease up to `batch_size` due events, plus every other due event for the same objects so they can be coalesced.
+    Leased events are not handed to another worker until the lease expires. The events are returned as plain rows,
+    reading them does not query the database again once the batch is committed or rolled back.
+    """
+    now = datetime.utcnow()
+    due = and_(WebhookActivitiesModel.status == "queued", WebhookActivitiesModel.available_at <= now)
+    object_ids = set(db.scalars(select(WebhookActivitiesModel.object_id)
+                                .where(due)
+                                .order_by(WebhookActivitiesModel.id)
+                                .limit(batch_size)
+                                .with_for_update(skip_locked=True)))
+    if not object_ids:
+        db.commit()
+        return []
+    webhooks = db.execute(select(*WebhookActivitiesModel.__table__.columns)
+                          .where(due, WebhookActivitiesModel.object_id.in_(object_ids))
+                          .order_by(WebhookActivitiesModel.event_time, WebhookActivitiesModel.id)
+                          .with_for_update(skip_locked=True)).all()
+    db.execute(update(WebhookActivitiesModel)
+               .where(WebhookActivitiesModel.id.in_([webhook.id for webhook in webhooks]))
+               .values(available_at=now + lease))
+    db.commit()
+    return webhooks
+
+
+def complete_webhooks(db: Session, webhook_ids: List[int]):
+    """
+    Mark the events applied. They are kept until pruned so redeliveries of them are not queued again.
+    """
+    db.query(WebhookActivitiesModel).filter(WebhookActivitiesModel.id.in_(webhook_ids)).update({
+        'status': "done",
+        'available_at': None,
+        'finished_at': datetime.utcnow(),
+    }, synchronize_session=False)
     db.commit()
-    db.refresh(webhook)
-    return webhook
 
 
-def delete_webhook_by_id(db: Session, webhook_id: int):
-    db.query(WebhookActivitiesModel).filter(WebhookActivitiesModel.id == webhook_id).delete()
+def retry_webhooks(db: Session, webhook_ids: List[int], error: str, backoff: timedelta, max_attempts: int):
+    """
+    Queue the events again after `backoff`, events reaching `max_attempts` are marked failed instead
+    """
+    now = datetime.utcnow()
+    exhausted = WebhookActivitiesModel.attempts + 1 >= max_attempts
+    retry_at = literal(now + backoff, WebhookActivitiesModel.available_at.type)
+    db.query(WebhookActivitiesModel).filter(WebhookActivitiesModel.id.in_(webhook_ids)).update({
+        'attempts': WebhookActivitiesModel.attempts + 1,
+        'available_at': case((exhausted, null()), else_=retry_at),
+        'status': case((exhausted, "failed"), else_="queued"),
+        'finished_at': case((exhausted, literal(now, WebhookActivitiesModel.finished_at.type)), else_=null()),
+        'last_error': error,
+    }, synchronize_session=False)
     db.commit()
 
 
+def prune_webhooks(db: Session, status: str, retention: timedelta) -> int:
+    """
+    Delete the events with this status (done or failed) finished more than `retention` ago
+    """
+    deleted = (db.query(WebhookActivitiesModel)
+               .filter(WebhookActivitiesModel.status == status,
+                       WebhookActivitiesModel.finished_at < datetime.utcnow() - retention)
+               .delete(synchronize_session=False))
+    db.commit()
+    return deleted
+
+
 def get_activity_by_id(db: Session, activity_id: int):
     return db.query(ActivityModel).filter(ActivityModel.id == activity_id).first()
 
 
-def get_routes_by_athlete_id(db: Session, athlete_id: int):
-    return (db.query(ActivityModel)
-            .filter(ActivityModel.athlete_id == athlete_id)
-            .order_by(ActivityModel.start_date_local)
+def _bounding_box(coordinates: np.ndarray, start_latlng: List[float], end_latlng: List[float]) -> Dict[str, Any]:
+    if len(coordinates):
+        min_lat, min_lng = to_degrees(coordinates.min(axis=0))
+        max_lat, max_lng = to_degrees(coordinates.max(axis=0))
+    elif len(start_latlng) and len(end_latlng):
+        latitudes, longitudes = zip(start_latlng, end_latlng)
+        min_lat, max_lat, min_lng, max_lng = min(latitudes), max(latitudes), min(longitudes), max(longitudes)
+    else:
+        return {'min_lat': None, 'min_lng': None, 'max_lat': None, 'max_lng': None}
+    return {'min_lat': float(min_lat), 'min_lng': float(min_lng), 'max_lat': float(max_lat), 'max_lng': float(max_lng)}
+
+
+def route_columns(polyline: Optional[str], start_latlng: List[float], end_latlng: List[float]) -> Dict[str, Any]:
+    """
+    Columns computed from the polyline: packed route, fingerprint and bounding box (of the start and end points when
+    there is no route)
+    """
+    coordinates = decode_polyline(polyline)
+    return {**_bounding_box(coordinates, start_latlng, end_latlng),
+            'route': pack_coordinates(coordinates) if len(coordinates) else None,
+            'fingerprint': route_fingerprint(coordinates)}
+
+
+def get_activity_routes(db: Session, athlete_id: int, activity_ids: Iterable[int]) -> List[Row]:
+    return (db.query(ActivityModel.id, ActivityModel.polyline, ActivityModel.route)
+            .filter(ActivityModel.athlete_id == athlete_id, ActivityModel.id.in_(list(activity_ids)))
             .all())
 
 
-def _create_activity_model_from_schema(activity: Union[SummaryActivity, DetailedActivity]):
-    return ActivityModel(
-        **activity.model_dump(exclude=activity.db_exclude_list()),
-        athlete_id=activity.athlete_id,
-        polyline=activity.polyline,
-        start_lat=activity.start_latlng[0] if len(activity.start_latlng) else None,
-        start_lng=activity.start_latlng[1] if len(activity.start_latlng) else None,
-        end_lat=activity.end_latlng[0] if len(activity.end_latlng) else None,
-        end_lng=activity.end_latlng[1] if len(activity.end_latlng) else None,
-        gear_id=activity.gear_id
-    )
-
-
-def create_activity(db: Session, activity: Union[SummaryActivity, DetailedActivity]) -> Optional[ActivityModel]:
-    activity = _create_activity_model_from_schema(activity)
-    db.add(activity)
-    db.commit()
-    db.refresh(activity)
-    return activity
+def _content_hash(values: Dict[str, Any]) -> int:
+    """
+    Cheap hash of the activity columns outside of _DETAIL_COLUMNS
+    """
+    content = repr(sorted((key, value) for key, value in values.items() if key not in _UNHASHED_COLUMNS))
+    return int.from_bytes(hashlib.blake2b(content.encode(), digest_size=8).digest(), "little", signed=True)
 
 
-def create_activity_batch(db: Session, activities: List[Union[SummaryActivity, DetailedActivity]]):
-    activities_models = [_create_activity_model_from_schema(activity) for activity in activities]
-    db.bulk_save_objects(activities_models)
-    db.commit()
+def _content_changed(content_hash, polyline, gear_id, detailed_at,
+                     keep_details: ColumnElement[bool] = false()) -> ColumnElement[bool]:
+    """
+    Whether writing these values changes the stored row: unchanged rows are skipped, with their rollups and listeners
+    """
+    return or_(ActivityModel.content_hash.is_distinct_from(content_hash),
+               and_(not_(keep_details), or_(ActivityModel.polyline.is_distinct_from(polyline),
+                                            ActivityModel.gear_id.is_distinct_from(gear_id))),
+               # The details arrive for a summary only activity, even when they hold the same route
+               and_(detailed_at.is_not(None), ActivityModel.detailed_at.is_(None)))
 
 
-def update_activity(db: Session, activity: Union[SummaryActivity, DetailedActivity]) -> Optional[ActivityModel]:
-    new_activity_dict = activity.model_dump(exclude=activity.db_exclude_list())
-    new_activity_dict.update({
+def _activity_values_from_schema(activity: Union[SummaryActivity, DetailedActivity]) -> Dict[str, Any]:
+    activity_values = activity.model_dump(exclude=activity.db_exclude_list())
+    activity_values.update(route_columns(activity.polyline, activity.start_latlng, activity.end_latlng))
+    activity_values.update({
         'athlete_id': activity.athlete_id,
         'polyline': activity.polyline,
         'start_lat': activity.start_latlng[0] if len(activity.start_latlng) else None,
         'start_lng': activity.start_latlng[1] if len(activity.start_latlng) else None,
         'end_lat': activity.end_latlng[0] if len(activity.end_latlng) else None,
         'end_lng': activity.end_latlng[1] if len(activity.end_latlng) else None,
-        'gear_id': activity.gear_id
+        'gear_id': activity.gear_id,
+        'detailed_at': datetime.utcnow() if isinstance(activity, DetailedActivity) else None,
     })
-    db.query(ActivityModel).filter(ActivityModel.id == activity.id).update(new_activity_dict)
+    activity_values['content_hash'] = _content_hash(activity_values)
+    return activity_values
+
+
+def _insert_for_dialect(dialect_name: str):
+    if dialect_name == "postgresql":
+        return postgresql_insert
+    # SQLite (tests, local runs) supports the same ON CONFLICT syntax
+    return sqlite_insert
+
+
+def _period_starts(start_date_local: datetime) -> Iterator[Tuple[str, date]]:
+    day = start_date_local.date()
+    yield "week", day - timedelta(days=day.weekday())
+    yield "month", day.replace(day=1)
+    yield "year", day.replace(month=1, day=1)
+
+
+def _stats_values(values: Union[Dict[str, Any], ActivityModel]) -> Tuple:
+    if isinstance(values, ActivityModel):
+        return tuple(getattr(values, column.key) for column in _STATS_COLUMNS)
+    return tuple(values.get(column.key) for column in _STATS_COLUMNS)
+
+
+def _add_stats(deltas: Dict[StatsKey, List[float]], activities: Iterable[Tuple], sign: int = 1
+               ) -> Dict[StatsKey, List[float]]:
+    """
+    Add the activities, tuples of the _STATS_COLUMNS values, to the per-period totals in `deltas` (count, distance,
+    moving_time, elevation_gain), or take them out with sign=-1.
+    """
+    for athlete_id, start_date_local, sport_type, distance, moving_time, elevation_gain in activities:
+        if start_date_local is None:
+            continue
+        for period, period_start in _period_starts(start_date_local):
+            totals = deltas.setdefault((athlete_id, period, period_start, sport_type or "Unknown"), [0, 0., 0, 0.])
+            totals[0] += sign
+            totals[1] += sign * (distance or 0)
+            totals[2] += sign * (moving_time or 0)
+            totals[3] += sign * (elevation_gain or 0)
+    return deltas
+
+
+def _stats_statements(dialect_name: str, deltas: Dict[StatsKey, List[float]],
+                      chunk_size: int = UPSERT_CHUNK_SIZE) -> Iterator[Executable]:
+    """
+    Add the deltas to the stored rollups, creating the missing rows, then drop the rows left without activity.
+    Rows are written in key order so concurrent writers lock them in the same order.
+    """
+    rows = [{'athlete_id': athlete_id, 'period': period, 'period_start': period_start, 'sport_type': sport_type,
+             'count': count, 'distance': distance, 'moving_time': moving_time, 'elevation_gain': elevation_gain}
+            for (athlete_id, period, period_start, sport_type), (count, distance, moving_time, elevation_gain)
+            in sorted(deltas.items()) if count or distance or moving_time or elevation_gain]
+    insert = _insert_for_dialect(dialect_name)
+    for start in range(0, len(rows), chunk_size):
+        statement = insert(AthleteStatsModel).values(rows[start:start + chunk_size])
+        yield statement.on_conflict_do_update(
+            index_elements=[AthleteStatsModel.athlete_id, AthleteStatsModel.period, AthleteStatsModel.period_start,
+                            AthleteStatsModel.sport_type],
+            set_={key: getattr(AthleteStatsModel, key) + statement.excluded[key]
+                  for key in ('count', 'distance', 'moving_time', 'elevation_gain')}
+        )
+    athlete_ids = {athlete_id for athlete_id, _, _, _ in deltas}
+    if athlete_ids:
+        yield delete(AthleteStatsModel).where(AthleteStatsModel.athlete_id.in_(athlete_ids),
+                                              AthleteStatsModel.count <= 0)
+
+
+def _stored_stats_query(activity_ids: Iterable[int]) -> Select:
+    return select(*_STATS_COLUMNS).where(ActivityModel.id.in_(list(activity_ids)))
+
+
+def _apply_stats(db: Session, deltas: Dict[StatsKey, List[float]]):
+    for statement in _stats_statements(db.get_bind().dialect.name, deltas):
+        db.execute(statement)
+
+
+def _lock_athletes(db: Session, athlete_ids: Iterable[int]):
+    """
+    Serialize the writers of these athletes' activities until the transaction ends, by locking the athlete rows (in
+    id order). The rollup deltas are computed from the stored activities: two writers of the same activity (webhook
+    worker, enrichment, import) reading the same stored values would both apply the same delta.
+    """
+    db.execute(select(AthleteModel.id)
+               .where(AthleteModel.id.in_(sorted(set(athlete_ids))))
+               .order_by(AthleteModel.id)
+               .with_for_update())
+
+
+def rebuild_athlete_stats(db: Session, athlete_id: int):
+    """
+    Recompute all the athlete's rollups from the activities in one pass, without committing
+    """
+    _lock_athletes(db, [athlete_id])
+    deltas = _add_stats({}, db.execute(select(*_STATS_COLUMNS)
+                                       .where(ActivityModel.athlete_id == athlete_id)
+                                       .execution_options(yield_per=UPSERT_CHUNK_SIZE)))
+    db.execute(delete(AthleteStatsModel).where(AthleteStatsModel.athlete_id == athlete_id))
+    _apply_stats(db, deltas)
+
+
+def _activity_rows(activities: List[Union[SummaryActivity, DetailedActivity]]) -> List[Dict[str, Any]]:
+    """
+    Column values of each activity, computed once per upsert (polyline decoding, fingerprint, content hash).
+    Last occurrence wins, a statement cannot touch the same row twice.
+    """
+    return list({activity.id: _activity_values_from_schema(activity) for activity in activities}.values())
+
+
+def _upsert_activities_statements(dialect_name: str, rows: List[Dict[str, Any]],
+                                  chunk_size: int = UPSERT_CHUNK_SIZE) -> Iterator[Insert]:
+    insert = _insert_for_dialect(dialect_name)
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        statement = insert(ActivityModel).values(chunk)
+        # A summary (activity list, sync job) must not overwrite the details already fetched for the activity
+        keep_details = and_(statement.excluded.detailed_at.is_(None), ActivityModel.detailed_at.is_not(None))
+        excluded = statement.excluded
+        changed = _content_changed(excluded.content_hash, excluded.polyline, excluded.gear_id, excluded.detailed_at,
+                                   keep_details=keep_details)
+        yield statement.on_conflict_do_update(
+            index_elements=[ActivityModel.id],
+            set_={key: case((keep_details, ActivityModel.__table__.c[key]), else_=statement.excluded[key])
+                  if key in _DETAIL_COLUMNS else statement.excluded[key]
+                  for key in chunk[0] if key != 'id'},
+            where=changed,
+        ).returning(ActivityModel.id)
+
+
+def _upsert_stats_deltas(previous: Iterable[Tuple], rows: List[Dict[str, Any]]) -> Dict[StatsKey, List[float]]:
+    """
+    Rollup change of an upsert: the stored version of the activities out, the new one in
+    """
+    deltas = _add_stats({}, previous, sign=-1)
+    return _add_stats(deltas, (_stats_values(values) for values in rows))
+
+
+def _upsert_activity_rows(db: Session, activities: List[Union[SummaryActivity, DetailedActivity]],
+                          chunk_size: int = UPSERT_CHUNK_SIZE, with_stats: bool = True) -> Set[int]:
+    """
+    Ids of the activities actually written, the unchanged ones are skipped. The written ones are recorded for the
+    explored worker in the same transaction.
+    """
+    rows = _activity_rows(activities)
+    if with_stats:
+        _lock_athletes(db, (values['athlete_id'] for values in rows))
+        previous = db.execute(_stored_stats_query({values['id'] for values in rows}).with_for_update()).all()
+        _apply_stats(db, _upsert_stats_deltas(previous, rows))
+    written_ids = set()
+    for statement in _upsert_activities_statements(db.get_bind().dialect.name, rows, chunk_size=chunk_size):
+        written_ids.update(db.execute(statement).scalars())
+    for athlete_id, activity_ids in _activity_ids_by_athlete(activities, written_ids).items():
+        mark_explored_changed(db, athlete_id, activity_ids)
+    return written_ids
+
+
+def _activity_ids_by_athlete(activities: List[Union[SummaryActivity, DetailedActivity]],
+                             written_ids: Set[int]) -> Dict[int, List[int]]:
+    activity_ids_by_athlete: Dict[int, List[int]] = {}
+    for activity in activities:
+        if activity.id in written_ids:
+            activity_ids_by_athlete.setdefault(activity.athlete_id, []).append(activity.id)
+    return activity_ids_by_athlete
+
+
+def _notify_upserted(activities: List[Union[SummaryActivity, DetailedActivity]], written_ids: Set[int]):
+    for athlete_id, activity_ids in _activity_ids_by_athlete(activities, written_ids).items():
+        notify_activities_changed(athlete_id, activity_ids)
+
+
+def upsert_activities(db: Session, activities: List[Union[SummaryActivity, DetailedActivity]],
+                      chunk_size: int = UPSERT_CHUNK_SIZE) -> int:
+    """
+    Insert activities or overwrite the stored ones, with one multi-row INSERT ... ON CONFLICT per chunk.
+    Safe to run again on the same activities. Returns the number of activities written.
+    """
+    written_ids = _upsert_activity_rows(db, activities, chunk_size=chunk_size)
     db.commit()
-    return get_activity_by_id(db=db, activity_id=activity.id)
+    _notify_upserted(activities, written_ids)
+    return len(written_ids)
 
 
-def update_activity_by_id(db: Session,  activity_id: int, changes: Dict[str, Any]) -> Optional[ActivityModel]:
-    activity = db.query(ActivityModel).filter(ActivityModel.id == activity_id).first()
-
+def _normalize_webhook_changes(changes: Dict[str, Any]) -> Dict[str, Any]:
+    normalized_changes = {}
     for key, value in changes.items():
         # For whatever reason, Strava webhooks use "title" and the rest of the api use "name" for the activity title
         # and string for boolean values
@@ -124,11 +397,308 @@ def update_activity_by_id(db: Session,  activity_id: int, changes: Dict[str, Any
         elif value == "true":
             value = True
 
+        # Strava also sends fields we do not store (type, authorized, ...)
+        if key in ActivityModel.__table__.columns:
+            normalized_changes[key] = value
+    return normalized_changes
+
+
+def update_activity_by_id(db: Session,  activity_id: int, changes: Dict[str, Any]) -> Optional[ActivityModel]:
+    athlete_id = db.scalar(select(ActivityModel.athlete_id).where(ActivityModel.id == activity_id))
+    if athlete_id is not None:
+        _lock_athletes(db, [athlete_id])
+    # Read again under the lock, the stats delta is computed from these values
+    activity = (db.query(ActivityModel)
+                .filter(ActivityModel.id == activity_id)
+                .with_for_update()
+                .populate_existing()
+                .first())
+    if activity is None:
+        db.commit()
+        return None
+
+    changes = {key: value for key, value in _normalize_webhook_changes(changes).items()
+               if getattr(activity, key) != value}
+    if not changes:
+        db.commit()
+        return activity
+
+    previous = _stats_values(activity)
+    for key, value in changes.items():
         setattr(activity, key, value)
+    # Only the changed columns are known here, the next full write computes the hash again
+    activity.content_hash = None
+    _apply_stats(db, _add_stats(_add_stats({}, [previous], sign=-1), [_stats_values(activity)]))
+    mark_explored_changed(db, activity.athlete_id, [activity.id])
     db.commit()
+    notify_activities_changed(activity.athlete_id, [activity.id])
     return get_activity_by_id(db=db, activity_id=activity.id)
 
 
 def delete_activity_by_id(db: Session, activity_id: int):
-    db.query(ActivityModel).filter(ActivityModel.id == activity_id).delete()
+    athlete_id = db.scalar(select(ActivityModel.athlete_id).where(ActivityModel.id == activity_id))
+    if athlete_id is not None:
+        _lock_athletes(db, [athlete_id])
+    deleted = db.execute(delete(ActivityModel)
+                         .where(ActivityModel.id == activity_id)
+                         .returning(*_STATS_COLUMNS)).first()
+    if deleted is not None:
+        _apply_stats(db, _add_stats({}, [deleted], sign=-1))
+        mark_explored_changed(db, deleted.athlete_id, [activity_id])
     db.commit()
+    if deleted is not None:
+        notify_activities_changed(deleted.athlete_id, [activity_id])
+
+
+def claim_summary_activities(db: Session, batch_size: int, lease: timedelta) -> List[Row]:
+    """
+    Take the `batch_size` most recent activities still missing their details, (id, athlete_id) rows. They are not
+    handed out again before the lease ends, unless written back with their details.
+    """
+    now = datetime.utcnow()
+    activities = db.execute(select(ActivityModel.id, ActivityModel.athlete_id)
+                            .where(ActivityModel.detailed_at.is_(None),
+                                   or_(ActivityModel.detail_retry_at.is_(None), ActivityModel.detail_retry_at < now))
+                            .order_by(ActivityModel.start_date_local.desc())
+                            .limit(batch_size)
+                            .with_for_update(skip_locked=True)).all()
+    if activities:
+        db.execute(update(ActivityModel)
+                   .where(ActivityModel.id.in_([activity.id for activity in activities]))
+                   .values(detail_retry_at=now + lease))
+    db.commit()
+    return activities
+
+
+def save_activity_details(db: Session, activities: List[DetailedActivity], failed_ids: List[int],
+                          retry_at: datetime) -> int:
+    """
+    Write a batch of fetched details in one transaction. Activities deleted since they were claimed are not brought
+    back, the failed ones are left until `retry_at`.
+    """
+    existing_ids = set(db.scalars(select(ActivityModel.id)
+                                  .where(ActivityModel.id.in_([activity.id for activity in activities]))))
+    activities = [activity for activity in activities if activity.id in existing_ids]
+    written_ids = _upsert_activity_rows(db, activities) if activities else set()
+    if failed_ids:
+        db.execute(update(ActivityModel).where(ActivityModel.id.in_(failed_ids)).values(detail_retry_at=retry_at))
+    db.commit()
+    _notify_upserted(activities, written_ids)
+    return len(activities)
+
+
+def get_sync_job_by_athlete_id(db: Session, athlete_id: int) -> Optional[SyncJobModel]:
+    return db.query(SyncJobModel).filter(SyncJobModel.athlete_id == athlete_id).first()
+
+
+def enqueue_sync_job(db: Session, athlete_id: int) -> SyncJobModel:
+    """
+    Mark the athlete's sync job as pending, creating it on first sync. The cursor is kept so the next run is
+    incremental. A job already running is left untouched.
+    """
+    now = datetime.utcnow()
+    job = get_sync_job_by_athlete_id(db, athlete_id)
+    if job is None:
+        job = SyncJobModel(athlete_id=athlete_id, status="pending", last_page=0, last_start_date=0, activities=0,
+                           attempts=0, created_at=now, updated_at=now)
+        db.add(job)
+    elif job.status != "running":
+        job.status = "pending"
+        job.error = None
+        job.attempts = 0
+        job.available_at = None
+        job.updated_at = now
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+class SyncJobLeaseLost(Exception):
+    """
+    The sync job was taken over by another worker, the writes of this one are refused
+    """
+
+
+def claim_sync_job(db: Session, stale_after: timedelta) -> Optional[SyncJobModel]:
+    """
+    Take the oldest pending job past its retry backoff, or a running one whose worker stopped checkpointing and
+    heartbeating (crash, restart, deploy). The job gets a new lease token: the writes of the worker running it are
+    checked against it.
+    """
+    now = datetime.utcnow()
+    pending = and_(SyncJobModel.status == "pending",
+                   or_(SyncJobModel.available_at.is_(None), SyncJobModel.available_at <= now))
+    job = (db.query(SyncJobModel)
+           .filter(or_(pending, and_(SyncJobModel.status == "running", SyncJobModel.updated_at < now - stale_after)))
+           .order_by(SyncJobModel.updated_at)
+           .with_for_update(skip_locked=True)
+           .first())
+    if job is None:
+        db.commit()
+        return None
+    job.status = "running"
+    job.last_page = 0
+    job.lease_token = uuid.uuid4().hex
+    job.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def _lock_leased_sync_job(db: Session, job: SyncJobModel, lease: str):
+    """
+    Lock the job row until the end of the transaction, after checking it is still leased with `lease`
+    """
+    locked = (db.query(SyncJobModel)
+              .filter(SyncJobModel.id == job.id, SyncJobModel.lease_token == lease)
+              .with_for_update()
+              .populate_existing()
+              .first())
+    if locked is None:
+        db.rollback()
+        raise SyncJobLeaseLost(f"Sync job {job.id} was taken over by another worker")
+
+
+def heartbeat_sync_job(db: Session, job: SyncJobModel, lease: str):
+    """
+    Keep the job from being reclaimed while its worker waits (rate limit)
+    """
+    updated = (db.query(SyncJobModel)
+               .filter(SyncJobModel.id == job.id, SyncJobModel.lease_token == lease)
+               .update({'updated_at': datetime.utcnow()}, synchronize_session=False))
+    db.commit()
+    if not updated:
+        raise SyncJobLeaseLost(f"Sync job {job.id} was taken over by another worker")
+
+
+def import_activity_page(db: Session, job: SyncJobModel, lease: str, page: int, activities: List[SummaryActivity]):
+    """
+    Write a page of activities and move the job cursor forward in the same transaction. The rollups are rebuilt
+    once the job is over.
+    """
+    _lock_leased_sync_job(db, job, lease)
+    written_ids = _upsert_activity_rows(db, activities, with_stats=False) if activities else set()
+    if activities:
+        job.last_start_date = max(job.last_start_date, *(int(activity.start_date.timestamp())
+                                                          for activity in activities))
+    job.last_page = page
+    job.activities += len(activities)
+    job.updated_at = datetime.utcnow()
+    db.commit()
+    _notify_upserted(activities, written_ids)
+
+
+def finish_sync_job(db: Session, job: SyncJobModel, lease: str, error: Optional[str] = None):
+    """
+    Close the job and rebuild the athlete's rollups from what was imported, even on failure as the pages written
+    so far are kept.
+    """
+    _lock_leased_sync_job(db, job, lease)
+    rebuild_athlete_stats(db, job.athlete_id)
+    job.status = "failed" if error is not None else "done"
+    job.error = error
+    if error is None:
+        job.attempts = 0
+    job.available_at = None
+    job.lease_token = None
+    job.updated_at = datetime.utcnow()
+    db.commit()
+    notify_activities_changed(job.athlete_id, [])
+
+
+def retry_sync_job(db: Session, job: SyncJobModel, lease: str, error: str, backoff: timedelta):
+    """
+    Put the job back in the queue after a transient error, it resumes from its cursor after `backoff`. The rollups
+    are rebuilt meanwhile from the pages written so far.
+    """
+    _lock_leased_sync_job(db, job, lease)
+    rebuild_athlete_stats(db, job.athlete_id)
+    job.status = "pending"
+    job.lease_token = None
+    job.error = error
+    job.attempts += 1
+    job.available_at = datetime.utcnow() + backoff
+    job.updated_at = datetime.utcnow()
+    db.commit()
+    notify_activities_changed(job.athlete_id, [])
+
+
+def release_sync_job(db: Session, job: SyncJobModel, lease: str):
+    """
+    Put an interrupted job back in the queue, it resumes from its cursor
+    """
+    _lock_leased_sync_job(db, job, lease)
+    job.status = "pending"
+    job.lease_token = None
+    job.updated_at = datetime.utcnow()
+    db.commit()
+
+
+def lock_explored_area(db: Session, athlete_id: int):
+    """
+    PostgreSQL only: serialize the explored tiles updates of the athlete across processes until the transaction ends
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(select(func.pg_advisory_xact_lock(athlete_id)))
+
+
+def try_lock_explored_area(db: Session, athlete_id: int) -> bool:
+    """
+    lock_explored_area() without waiting, False when another transaction holds the lock
+    """
+    if db.get_bind().dialect.name != "postgresql":
+        return True
+    return db.scalar(select(func.pg_try_advisory_xact_lock(athlete_id)))
+
+
+def mark_explored_changed(db: Session, athlete_id: int, activity_ids: List[int]):
+    """
+    Record changed activities for the explored worker, in the transaction of the change so none is lost. The caller
+    commits.
+    """
+    insert = _insert_for_dialect(db.get_bind().dialect.name)(ExploredChangeModel).values(
+        [{'activity_id': activity_id, 'athlete_id': athlete_id, 'version': 0} for activity_id in activity_ids])
+    db.execute(insert.on_conflict_do_update(index_elements=[ExploredChangeModel.activity_id],
+                                            set_={'version': ExploredChangeModel.version + 1}))
+
+
+def claim_explored_changes(db: Session, batch_size: int, athletes_scanned: int = 16) -> Tuple[Optional[int], List[Row]]:
+    """
+    (athlete_id, [(activity_id, version)]) of up to `batch_size` changed activities of an athlete whose explored area
+    no other transaction is updating, (None, []) when there is none. The area stays locked until the transaction ends.
+    """
+    for athlete_id in db.scalars(select(ExploredChangeModel.athlete_id).distinct().limit(athletes_scanned)).all():
+        if try_lock_explored_area(db, athlete_id):
+            changes = db.execute(select(ExploredChangeModel.activity_id, ExploredChangeModel.version)
+                                 .where(ExploredChangeModel.athlete_id == athlete_id)
+                                 .order_by(ExploredChangeModel.activity_id)
+                                 .limit(batch_size)).all()
+            return athlete_id, changes
+    return None, []
+
+
+def delete_explored_changes(db: Session, changes: List[Row]):
+    """
+    Only the changes still at the version read, activities changed again are left for the next batch
+    """
+    db.execute(delete(ExploredChangeModel)
+               .where(tuple_(ExploredChangeModel.activity_id, ExploredChangeModel.version)
+                      .in_([(change.activity_id, change.version) for change in changes])))
+
+
+def get_explored_activities(db: Session, activity_ids: Iterable[int]) -> List[ExploredActivityModel]:
+    return (db.query(ExploredActivityModel)
+            .filter(ExploredActivityModel.activity_id.in_(list(activity_ids)))
+            .all())
+
+
+def get_explored_tiles_for_update(db: Session, athlete_id: int,
+                                  tiles: Iterable[Tuple[int, int, int]]) -> List[ExploredTileModel]:
+    """
+    Tiles by (zoom, x, y), locked until the transaction ends so concurrent workers do not lose counts
+    """
+    return (db.query(ExploredTileModel)
+            .filter(ExploredTileModel.athlete_id == athlete_id,
+                    tuple_(ExploredTileModel.zoom, ExploredTileModel.x, ExploredTileModel.y).in_(list(tiles)))
+            .with_for_update()
+            .all())
@@ -0,0 +1,23 @@
+"""
+Hooks run after activities are committed, so in-memory structures built from them (indexes, caches) stay in sync
+with the database
+"""
+from typing import Callable, Iterable, List
+
+ActivitiesListener = Callable[[int, List[int]], None]
+
+_listeners: List[ActivitiesListener] = []
+
+
+def on_activities_changed(listener: ActivitiesListener) -> ActivitiesListener:
+    """
+    Register `listener(athlete_id, activity_ids)`, called for activities created, updated or deleted.
+    """
+    _listeners.append(listener)
+    return listener
+
+
+def notify_activities_changed(athlete_id: int, activity_ids: Iterable[int]):
+    activity_ids = list(activity_ids)
+    for listener in _listeners:
+        listener(athlete_id, activity_ids)
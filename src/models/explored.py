@@ -0,0 +1,40 @@
+from sqlalchemy import Column, BigInteger, Integer, LargeBinary, ForeignKey, Index
+
+from database.db import Base, BigIntegerId
+
+
+class ExploredTileModel(Base):
+    __tablename__ = "explored_tiles"
+    __table_args__ = (
+        Index("ix_explored_tiles_athlete_id_zoom_x_y", "athlete_id", "zoom", "x", "y", unique=True),
+    )
+
+    id = Column(BigIntegerId, primary_key=True, index=True)
+    athlete_id = Column(BigInteger, ForeignKey('athletes.id'))
+    zoom = Column(Integer)
+    x = Column(Integer)
+    y = Column(Integer)
+    counts = Column(LargeBinary)  # zlib compressed 256x256 little-endian uint16, activities per pixel
+
+
+class ExploredActivityModel(Base):
+    """
+    Route of each activity as it was rasterized into explored_tiles, so it can be taken out again when the activity
+    changes or is deleted
+    """
+    __tablename__ = "explored_activities"
+
+    activity_id = Column(BigInteger, primary_key=True)
+    athlete_id = Column(BigInteger, ForeignKey('athletes.id'), index=True)
+    route = Column(LargeBinary)
+
+
+class ExploredChangeModel(Base):
+    """
+    Activities changed since their route was rasterized, drained by the explored tiles worker
+    """
+    __tablename__ = "explored_changes"
+
+    activity_id = Column(BigInteger, primary_key=True)
+    athlete_id = Column(BigInteger, ForeignKey('athletes.id'), index=True)
+    version = Column(Integer, default=0)  # bumped by each change, a change made while the tiles are updated is kept
@@ -0,0 +1,20 @@
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime, ForeignKey
+
+from database.db import Base, BigIntegerId
+
+
+class SyncJobModel(Base):
+    __tablename__ = "sync_jobs"
+
+    id = Column(BigIntegerId, primary_key=True, index=True)
+    athlete_id = Column(BigInteger, ForeignKey('athletes.id'), unique=True, index=True)
+    status = Column(String, index=True)
+    last_page = Column(Integer, default=0)
+    last_start_date = Column(BigInteger, default=0)  # epoch of the newest imported activity, used as `after=`
+    activities = Column(Integer, default=0)
+    error = Column(String)
+    attempts = Column(Integer, server_default="0")  # failed runs in a row, reset once the job is done
+    available_at = Column(DateTime)  # a job put back after a transient error waits until then
+    lease_token = Column(String)  # worker running the job, its writes are refused once another one took over
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
@@ -1,18 +1,28 @@
-from sqlalchemy import Column, BigInteger, String, ForeignKey
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime, ForeignKey, JSON, Index
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.mutable import MutableDict
 
-from database.db import Base
+from database.db import Base, BigIntegerId
 
 
 class WebhookActivitiesModel(Base):
     __tablename__ = "webhooks"
+    __table_args__ = (
+        # Strava delivers an event again when the first delivery is not acknowledged in time
+        Index("ix_webhooks_object_id_aspect_type_event_time", "object_id", "aspect_type", "event_time", unique=True),
+    )
 
-    id = Column(BigInteger, primary_key=True, index=True)
+    id = Column(BigIntegerId, primary_key=True, index=True)
     object_type = Column(String)
     object_id = Column(BigInteger)
     aspect_type = Column(String)
-    updates = Column(MutableDict.as_mutable(JSONB))  # noqa
+    updates = Column(MutableDict.as_mutable(JSON().with_variant(JSONB, "postgresql")))  # noqa
     owner_id = Column(BigInteger, ForeignKey('athletes.id'))
     subscription_id = Column(BigInteger)
     event_time = Column(BigInteger)
+    attempts = Column(Integer, default=0)
+    available_at = Column(DateTime, index=True)  # next time a worker may pick the event, leased while processing
+    last_error = Column(String)
+    # queued, done once applied, or failed once WEBHOOK_MAX_ATTEMPTS is reached
+    status = Column(String, server_default="queued")
+    finished_at = Column(DateTime)
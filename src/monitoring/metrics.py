@@ -0,0 +1,105 @@
+"""
+Prometheus metrics of the hot paths: HTTP requests, SQL queries, Strava calls and background tasks.
+Set PROMETHEUS_MULTIPROC_DIR when running several worker processes so /metrics aggregates all of them.
+"""
+import os
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, \
+    CONTENT_TYPE_LATEST, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latency of the HTTP requests",
+                            ["method", "route", "status"])
+REQUEST_QUERIES = Histogram("http_request_db_queries", "SQL queries run while serving a request", ["route"],
+                            buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144))
+REQUEST_QUERY_TIME = Histogram("http_request_db_duration_seconds", "Time spent in SQL while serving a request",
+                               ["route"])
+DB_QUERIES = Counter("db_queries_total", "SQL queries run, in requests and background tasks")
+DB_QUERY_TIME = Histogram("db_query_duration_seconds", "Duration of each SQL query")
+
+STRAVA_REQUESTS = Counter("strava_requests_total", "Calls to the Strava API", ["method", "endpoint", "status"])
+STRAVA_LATENCY = Histogram("strava_request_duration_seconds", "Latency of the Strava API", ["method", "endpoint"])
+STRAVA_HEADROOM = Gauge("strava_rate_limit_headroom", "Strava requests left in the current rate limit windows",
+                        multiprocess_mode="min")
+
+TASK_DURATION = Histogram("background_task_duration_seconds", "Duration of the background tasks",
+                          ["task", "outcome"], buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+
+ROUTE_STORE_BYTES = Gauge("route_store_bytes", "Estimated memory held by the in-process route store",
+                          multiprocess_mode="livesum")
+ROUTE_STORE_ATHLETES = Gauge("route_store_athletes", "Athletes held by the in-process route store",
+                             multiprocess_mode="livesum")
+ROUTE_STORE_LOOKUPS = Counter("route_store_lookups_total", "Reads of the route store, hit or (re)load", ["result"])
+
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 0))  # 0 disables the slow request log
+
+_STRAVA_IDS = re.compile(r"/\d+")
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.
+
+
+# Set for the duration of each request by MetricsMiddleware
+current_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("current_query_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+    DB_QUERIES.inc()
+    DB_QUERY_TIME.observe(duration)
+    stats = current_query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += duration
+
+
+def strava_endpoint(url: str) -> str:
+    """
+    Path of a Strava API url with the ids replaced, to keep the label cardinality low
+    """
+    path = url.split("?", 1)[0].split("/api/v3", 1)[-1]
+    return _STRAVA_IDS.sub("/{id}", path)
+
+
+def observe_strava_call(method: str, url: str, status: int, duration: float, headroom: int):
+    endpoint = strava_endpoint(url)
+    STRAVA_REQUESTS.labels(method, endpoint, str(status)).inc()
+    STRAVA_LATENCY.labels(method, endpoint).observe(duration)
+    STRAVA_HEADROOM.set(headroom)
+
+
+@contextmanager
+def track_task(task: str):
+    """
+    Time the block as one run of a background task, labelled with its outcome
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        TASK_DURATION.labels(task, outcome).observe(time.perf_counter() - start)
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
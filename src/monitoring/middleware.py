@@ -0,0 +1,43 @@
+import time
+
+from monitoring.metrics import (REQUEST_LATENCY, REQUEST_QUERIES, REQUEST_QUERY_TIME, SLOW_REQUEST_SECONDS, QueryStats,
+                                current_query_stats)
+
+
+class MetricsMiddleware:
+    """
+    Records the latency and the SQL queries of each request, labelled with the route template (/route/{activity_id})
+    rather than the path. Streamed responses are timed until their last chunk.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = current_query_stats.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            current_query_stats.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_LATENCY.labels(scope["method"], route, str(status)).observe(duration)
+            REQUEST_QUERIES.labels(route).observe(stats.count)
+            REQUEST_QUERY_TIME.labels(route).observe(stats.seconds)
+            if SLOW_REQUEST_SECONDS and duration >= SLOW_REQUEST_SECONDS:
+                print(f"Slow request {scope['method']} {scope['path']}?{scope['query_string'].decode()} "
+                      f"{status} in {duration:.3f}s, {stats.count} queries in {stats.seconds:.3f}s")
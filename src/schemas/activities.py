@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import List, Set, Optional
+from typing import List, Set, Optional, Union
 
 from pydantic import BaseModel
 
@@ -70,3 +70,59 @@ class DetailedActivity(ActivityBase):
 
     class Config:
         from_attributes = True
+
+
+class ActivityResponse(BaseModel):
+    """
+    Columns served by /activity/{activity_id}, selected as is from the activities table
+    """
+    id: int
+    athlete_id: int
+    name: Optional[str] = None
+    distance: Optional[float] = None
+    moving_time: Optional[int] = None
+    elapsed_time: Optional[int] = None
+    total_elevation_gain: Optional[float] = None
+    elev_high: Optional[float] = None
+    elev_low: Optional[float] = None
+    sport_type: Optional[str] = None
+    start_date: Optional[datetime] = None
+    start_date_local: Optional[datetime] = None
+    timezone: Optional[str] = None
+    start_lat: Optional[str] = None
+    start_lng: Optional[str] = None
+    end_lat: Optional[str] = None
+    end_lng: Optional[str] = None
+    polyline: Optional[str] = None
+    trainer: Optional[bool] = None
+    commute: Optional[bool] = None
+    manual: Optional[bool] = None
+    private: Optional[bool] = None
+    visibility: Optional[str] = None
+    flagged: Optional[bool] = None
+    workout_type: Optional[int] = None
+    average_speed: Optional[float] = None
+    max_speed: Optional[float] = None
+    hide_from_home: Optional[bool] = None
+    gear_id: Optional[str] = None
+    average_watts: Optional[float] = None
+    device_watts: Optional[bool] = None
+    max_watts: Optional[int] = None
+    weighted_average_watts: Optional[int] = None
+
+
+class RouteResponse(BaseModel):
+    polyline: Union[str, List[List[float]], None]
+    date: datetime
+
+
+class LocatedRouteResponse(RouteResponse):
+    id: int
+
+
+class UniqueRouteResponse(LocatedRouteResponse):
+    count: int  # activities on this route
+
+
+class SimilarRouteResponse(LocatedRouteResponse):
+    similarity: float
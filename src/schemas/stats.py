@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+from datetime import date
+from enum import Enum
+
+from pydantic import BaseModel
+
+
+class StatsPeriod(str, Enum):
+    week = "week"
+    month = "month"
+    year = "year"
+
+
+class AthleteStats(BaseModel):
+    period_start: date
+    sport_type: str
+    count: int
+    distance: float
+    moving_time: int
+    elevation_gain: float
+
+    class Config:
+        from_attributes = True
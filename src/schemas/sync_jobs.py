@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class SyncJob(BaseModel):
+    id: int
+    athlete_id: int
+    status: str
+    last_page: int
+    last_start_date: int
+    activities: int
+    error: Optional[str] = None
+    attempts: int = 0
+    available_at: Optional[datetime] = None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,74 @@
+import os
+import threading
+from typing import Optional, List, Dict, Any
+
+from cachetools import TTLCache
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from geo.grid_index import GridIndex, BoundingBox
+from models import async_crud
+from models.events import on_activities_changed
+from services.cache import response_cache
+from services.itinerary import RouteFormat, format_routes_async
+from services.route_store import route_store, ROUTE_STORE_ENABLED
+
+# Indexes are stored with the athlete's version in the response cache backend and rebuilt once it moved, which also
+# covers the writes of other processes sharing the backend. The TTL covers them with the in-process backend.
+_indexes: TTLCache = TTLCache(maxsize=int(os.getenv('BBOX_INDEX_CACHE_SIZE', 256)),
+                              ttl=int(os.getenv('BBOX_INDEX_TTL', 600)))
+_indexes_lock = threading.Lock()
+
+
+@on_activities_changed
+def invalidate_index(athlete_id: int, activity_ids: List[int]):
+    with _indexes_lock:
+        _indexes.pop(athlete_id, None)
+
+
+async def _get_index(db: AsyncSession, athlete_id: int) -> GridIndex:
+    # Before the query: a change committed during it bumps the version again
+    version = await response_cache.athlete_version(athlete_id)
+    with _indexes_lock:
+        indexed_version, index = _indexes.get(athlete_id, (None, None))
+    if index is None or indexed_version != version:
+        rows = await async_crud.get_bounding_boxes(db=db, athlete_id=athlete_id)
+        index = GridIndex((row.id for row in rows), (tuple(row[1:]) for row in rows))
+        with _indexes_lock:
+            _indexes[athlete_id] = (version, index)
+    return index
+
+
+async def find_routes_in_bounding_box(athlete_id: int, db: AsyncSession, bounding_box: BoundingBox,
+                                      limit: Optional[int], with_route: bool = False,
+                                      with_sport_type: bool = False) -> List[Row]:
+    """
+    Rows of the `limit` most recent activities whose bounding box intersects `bounding_box`, most recent first.
+    Answered by the route store when enabled, otherwise PostgreSQL answers with its GiST index and other databases go
+    through an in-memory grid index per athlete.
+    """
+    if ROUTE_STORE_ENABLED:
+        return (await route_store.get(db, athlete_id)).in_bounding_box(bounding_box, limit)
+    if db.get_bind().dialect.name == "postgresql":
+        return await async_crud.get_routes_in_bounding_box(db=db, athlete_id=athlete_id, bounding_box=bounding_box,
+                                                           limit=limit, with_route=with_route,
+                                                           with_sport_type=with_sport_type)
+    index = await _get_index(db, athlete_id)
+    activity_ids = index.query(bounding_box).tolist()
+    if not activity_ids:
+        return []
+    return await async_crud.get_routes_by_ids(db=db, activity_ids=activity_ids, limit=limit, with_route=with_route,
+                                              with_sport_type=with_sport_type)
+
+
+async def get_routes_in_bounding_box(athlete_id: int, db: AsyncSession, bounding_box: BoundingBox, limit: int = 200,
+                                     zoom: Optional[int] = None,
+                                     route_format: RouteFormat = RouteFormat.polyline) -> List[Dict[str, Any]]:
+    """
+    The `limit` most recent routes whose bounding box intersects the viewport, oldest first.
+    """
+    with_route = zoom is not None or route_format != RouteFormat.polyline
+    activities = (await find_routes_in_bounding_box(athlete_id, db, bounding_box, limit, with_route=with_route))[::-1]
+    routes = await format_routes_async(activities, with_route, zoom, route_format)
+    return [{'id': activity.id, 'polyline': route, 'date': activity.start_date_local}
+            for activity, route in zip(activities, routes)]
@@ -0,0 +1,203 @@
+"""
+Response cache for the route endpoints.
+
+Entries are namespaced by a version per athlete and per activity: a change bumps the versions and the old entries are
+never read again, which works the same with an in-process or a shared backend. The in-process backend only sees the
+changes made by its own process, writes from other processes are picked up when entries expire (CACHE_TTL).
+
+Reads happen on the event loop and are awaited. Versions are bumped by the activities changed listeners, which run in
+the worker threads, so bump() is synchronous.
+
+A bump is also remembered for REPLICA_LAG_WINDOW: until then the athlete's reads go to the primary, a replica lagging
+behind would otherwise have the old data cached under the new version.
+"""
+import hashlib
+import os
+import threading
+import time
+from typing import Optional, Tuple, Callable, Awaitable, Any, List
+
+from cachetools import TTLCache
+from fastapi import Request, Response
+
+from models.events import on_activities_changed
+from services.responses import dumps, dumps_ndjson, wants_ndjson, JSON_MEDIA_TYPE, NDJSON_MEDIA_TYPE
+
+CACHE_TTL = int(os.getenv('CACHE_TTL', 300))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+# How long after a change the athlete's reads go to the primary, enough for the replica to catch up
+REPLICA_LAG_WINDOW = int(os.getenv('REPLICA_LAG_WINDOW', 30))
+
+CachedResponse = Tuple[bytes, str, str]  # body, etag, media type
+
+
+class LocalCacheBackend:
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: int = CACHE_TTL,
+                 replica_lag_window: float = REPLICA_LAG_WINDOW):
+        self._entries = TTLCache(maxsize=max_entries, ttl=ttl)
+        self._versions = TTLCache(maxsize=max_entries, ttl=ttl * 2)
+        self._bumped = TTLCache(maxsize=max_entries, ttl=replica_lag_window) if replica_lag_window > 0 else {}
+        self._replica_lag_window = replica_lag_window
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            return self._entries.get(key)
+
+    async def set(self, key: str, value: CachedResponse):
+        with self._lock:
+            self._entries[key] = value
+
+    async def version(self, namespace: str) -> int:
+        with self._lock:
+            # An evicted version must not come back as a value used before, start from the clock
+            return self._versions.setdefault(namespace, time.time_ns())
+
+    def bump(self, namespace: str):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, time.time_ns()) + 1
+            if self._replica_lag_window > 0:
+                self._bumped[namespace] = True
+
+    async def bumped_recently(self, namespace: str) -> bool:
+        with self._lock:
+            return namespace in self._bumped
+
+    async def close(self):
+        pass
+
+
+class RedisCacheBackend:
+    def __init__(self, url: str, ttl: int = CACHE_TTL, replica_lag_window: float = REPLICA_LAG_WINDOW):
+        import redis
+        self._url = url
+        self._redis = redis.Redis.from_url(url)
+        self._async_redis = None
+        self._ttl = ttl
+        self._replica_lag_window = replica_lag_window
+
+    @property
+    def _aredis(self):
+        """
+        Client of the event loop, created on first use from that loop
+        """
+        if self._async_redis is None:
+            import redis.asyncio
+            self._async_redis = redis.asyncio.Redis.from_url(self._url)
+        return self._async_redis
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        value = await self._aredis.hgetall(key)
+        if not value:
+            return None
+        return value[b"body"], value[b"etag"].decode(), value[b"media_type"].decode()
+
+    async def set(self, key: str, value: CachedResponse):
+        body, etag, media_type = value
+        async with self._aredis.pipeline() as pipeline:
+            pipeline.hset(key, mapping={"body": body, "etag": etag, "media_type": media_type})
+            pipeline.expire(key, self._ttl)
+            await pipeline.execute()
+
+    async def version(self, namespace: str) -> int:
+        version = await self._aredis.get(f"version:{namespace}")
+        if version is None:
+            await self._aredis.set(f"version:{namespace}", time.time_ns(), nx=True)
+            version = await self._aredis.get(f"version:{namespace}")
+        return int(version)
+
+    def bump(self, namespace: str):
+        with self._redis.pipeline() as pipeline:
+            pipeline.incr(f"version:{namespace}")
+            if self._replica_lag_window > 0:
+                pipeline.set(f"bumped:{namespace}", 1, px=int(self._replica_lag_window * 1000))
+            pipeline.execute()
+
+    async def bumped_recently(self, namespace: str) -> bool:
+        return bool(await self._aredis.exists(f"bumped:{namespace}"))
+
+    async def close(self):
+        if self._async_redis is not None:
+            await self._async_redis.aclose()
+            self._async_redis = None
+        self._redis.close()
+
+
+def _create_backend():
+    if os.getenv('CACHE_REDIS_URL'):
+        return RedisCacheBackend(os.getenv('CACHE_REDIS_URL'))
+    return LocalCacheBackend()
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self._backend = backend
+
+    async def athlete_version(self, athlete_id: int) -> int:
+        """
+        Version of the athlete's activities, bumped once per change by every process sharing the backend
+        """
+        return await self._backend.version(f"athlete:{athlete_id}")
+
+    async def athlete_key(self, athlete_id: int, request: Request) -> str:
+        version = await self.athlete_version(athlete_id)
+        return f"athlete:{athlete_id}:{version}:{request.url.path}?{request.url.query}"
+
+    async def activity_key(self, athlete_id: int, activity_id: int, request: Request) -> str:
+        version = await self._backend.version(f"activity:{activity_id}")
+        return f"athlete:{athlete_id}:activity:{activity_id}:{version}:{request.url.path}?{request.url.query}"
+
+    async def athlete_changed_recently(self, athlete_id: int) -> bool:
+        """
+        The athlete's activities changed less than REPLICA_LAG_WINDOW ago, a replica may not have the change yet
+        """
+        return await self._backend.bumped_recently(f"athlete:{athlete_id}")
+
+    async def close(self):
+        await self._backend.close()
+
+    def invalidate(self, athlete_id: int, activity_ids: List[int]):
+        self._backend.bump(f"athlete:{athlete_id}")
+        for activity_id in activity_ids:
+            self._backend.bump(f"activity:{activity_id}")
+
+    @staticmethod
+    def _not_modified(request: Request, etag: str) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        return if_none_match is not None and etag in (tag.strip() for tag in if_none_match.split(","))
+
+    async def respond(self, request: Request, key: str, build: Callable[[], Awaitable[Any]],
+                      media_type: str = JSON_MEDIA_TYPE) -> Response:
+        """
+        Serve the cached response for `key`, or build, cache and serve it. Answers 304 when the client already has
+        this version (If-None-Match). Lists are served as NDJSON to clients accepting it, bytes are served as they are
+        with `media_type`.
+        """
+        ndjson = wants_ndjson(request)
+        if ndjson:
+            key = f"{key}:ndjson"
+        cached = await self._backend.get(key)
+        if cached is None:
+            payload = await build()
+            if isinstance(payload, bytes):
+                body = payload
+            elif ndjson and isinstance(payload, list):
+                body, media_type = dumps_ndjson(payload), NDJSON_MEDIA_TYPE
+            else:
+                body, media_type = dumps(payload), JSON_MEDIA_TYPE
+            cached = (body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', media_type)
+            await self._backend.set(key, cached)
+
+        body, etag, media_type = cached
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if self._not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type=media_type, headers=headers)
+
+
+response_cache = ResponseCache(_create_backend())
+
+
+@on_activities_changed
+def invalidate_cached_responses(athlete_id: int, activity_ids: List[int]):
+    response_cache.invalidate(athlete_id, activity_ids)
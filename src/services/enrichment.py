@@ -0,0 +1,78 @@
+"""
+Background enrichment of the activities imported from the activity list. The sync jobs store SummaryActivity data
+(low resolution polyline, no gear), the DetailedActivity of each of them is fetched here over time, most recent first,
+with the Strava requests left over by the imports and webhooks.
+"""
+import os
+import threading
+import traceback
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from database.db import SessionLocal
+from models import crud
+from monitoring.metrics import track_task
+from strava.api import StravaApi
+from strava.client import get_strava_client
+
+ENRICH_BATCH_SIZE = int(os.getenv('ENRICH_BATCH_SIZE', 50))
+ENRICH_FETCH_CONCURRENCY = int(os.getenv('ENRICH_FETCH_CONCURRENCY', 4))
+ENRICH_POLL_INTERVAL = float(os.getenv('ENRICH_POLL_INTERVAL', 60))
+# Requests of the rate limit window kept for the sync jobs and webhooks, enrichment only uses the rest
+ENRICH_RATE_LIMIT_RESERVE = int(os.getenv('ENRICH_RATE_LIMIT_RESERVE', 50))
+# A claimed batch not written back after this long (crashed worker) is picked up again
+ENRICH_LEASE = timedelta(seconds=int(os.getenv('ENRICH_LEASE', 600)))
+ENRICH_RETRY_DELAY = timedelta(seconds=int(os.getenv('ENRICH_RETRY_DELAY', 86400)))
+
+
+def enrich_next_batch() -> int:
+    """
+    Fetch and store the details of the most recent summary only activities, as many as the rate limit budget allows.
+    Returns the number of activities claimed, 0 when there was nothing to do or no budget left.
+    """
+    budget = min(ENRICH_BATCH_SIZE, get_strava_client().rate_limiter.headroom - ENRICH_RATE_LIMIT_RESERVE)
+    if budget <= 0:
+        return 0
+
+    db = SessionLocal()
+    try:
+        activities = crud.claim_summary_activities(db, batch_size=budget, lease=ENRICH_LEASE)
+        activity_ids_by_athlete: Dict[int, List[int]] = {}
+        for activity in activities:
+            activity_ids_by_athlete.setdefault(activity.athlete_id, []).append(activity.id)
+
+        with track_task("enrich_activities"):
+            details, failed_ids = [], []
+            for athlete_id, activity_ids in activity_ids_by_athlete.items():
+                try:
+                    fetched = StravaApi(db=db, athlete_id=athlete_id).get_activity_details(
+                        activity_ids, concurrency=ENRICH_FETCH_CONCURRENCY)
+                except Exception:
+                    # Left to the lease, the other athletes of the batch are still written
+                    print(f"Fetching activity details failed for athlete {athlete_id}")
+                    traceback.print_exc()
+                    db.rollback()
+                    continue
+                # Activities missing from `fetched` hit a transient error, they are claimed again after the lease
+                for activity_id, detail in fetched.items():
+                    if detail is None:
+                        failed_ids.append(activity_id)
+                    else:
+                        details.append(detail)
+            crud.save_activity_details(db, details, failed_ids, retry_at=datetime.utcnow() + ENRICH_RETRY_DELAY)
+        return len(activities)
+    finally:
+        db.close()
+
+
+def enrich_worker_loop(stop: threading.Event, poll_interval: float = ENRICH_POLL_INTERVAL):
+    """
+    Enrich activities until `stop` is set, sleeping `poll_interval` when none is left or the budget is used up.
+    """
+    while not stop.is_set():
+        try:
+            if enrich_next_batch():
+                continue
+        except Exception:
+            traceback.print_exc()
+        stop.wait(poll_interval)
@@ -0,0 +1,117 @@
+"""
+Streaming export of an athlete's whole activity archive. Rows come from a server-side cursor and are encoded one by
+one, so memory stays flat whatever the size of the history.
+"""
+import os
+import zlib
+from enum import Enum
+from typing import AsyncIterator, Dict, Any
+from xml.sax.saxutils import escape, quoteattr
+
+from sqlalchemy import Row
+
+from database.db import AsyncReadSessionLocal
+from geo.polyline import to_degrees
+from models import async_crud
+from schemas.activities import ActivityResponse
+from services.itinerary import get_route_coordinates
+from services.responses import dumps, NDJSON_MEDIA_TYPE
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 500))
+# Compressed output is flushed to the client once this much input went through the compressor
+GZIP_FLUSH_SIZE = 64 * 1024
+
+_COLUMNS = [*ActivityResponse.model_fields, 'route']
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    gpx = "gpx"
+    geojson = "geojson"
+
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.ndjson: NDJSON_MEDIA_TYPE,
+    ExportFormat.gpx: "application/gpx+xml",
+    ExportFormat.geojson: "application/geo+json",
+}
+
+GPX_HEADER = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+              b'<gpx version="1.1" creator="rideout.earth" xmlns="http://www.topografix.com/GPX/1/1">\n')
+GPX_FOOTER = b'</gpx>\n'
+GEOJSON_HEADER = b'{"type":"FeatureCollection","features":[\n'
+GEOJSON_FOOTER = b']}\n'
+
+
+def _properties(row: Row) -> Dict[str, Any]:
+    properties = dict(row._mapping)
+    del properties['route']
+    return properties
+
+
+def _ndjson_record(row: Row) -> bytes:
+    record = _properties(row)
+    record['coordinates'] = to_degrees(get_route_coordinates(row.polyline, row.route)).tolist()
+    return dumps(record) + b"\n"
+
+
+def _gpx_track(row: Row) -> bytes:
+    points = "".join(f'<trkpt lat="{lat:.5f}" lon="{lng:.5f}"/>'
+                     for lat, lng in to_degrees(get_route_coordinates(row.polyline, row.route)).tolist())
+    link = quoteattr(f"https://www.strava.com/activities/{row.id}")
+    return (f'<trk><name>{escape(row.name or "")}</name><link href={link}/>'
+            f'<type>{escape(row.sport_type or "")}</type><trkseg>{points}</trkseg></trk>\n').encode()
+
+
+def _geojson_feature(row: Row) -> bytes:
+    coordinates = to_degrees(get_route_coordinates(row.polyline, row.route)[:, ::-1]).tolist()
+    properties = _properties(row)
+    del properties['polyline']
+    # A LineString needs at least two positions
+    geometry = {'type': 'LineString', 'coordinates': coordinates} if len(coordinates) >= 2 else None
+    return dumps({'type': 'Feature', 'id': row.id, 'geometry': geometry, 'properties': properties})
+
+
+async def _encode(rows: AsyncIterator[Row], export_format: ExportFormat) -> AsyncIterator[bytes]:
+    if export_format == ExportFormat.ndjson:
+        async for row in rows:
+            yield _ndjson_record(row)
+    elif export_format == ExportFormat.gpx:
+        yield GPX_HEADER
+        async for row in rows:
+            yield _gpx_track(row)
+        yield GPX_FOOTER
+    else:
+        yield GEOJSON_HEADER
+        separator = b""
+        async for row in rows:
+            yield separator + _geojson_feature(row)
+            separator = b",\n"
+        yield b"\n" + GEOJSON_FOOTER
+
+
+async def _gzip(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    pending, first = 0, True
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        pending += len(chunk)
+        # Flush the first chunk straight away so the download starts, then in blocks to keep a good ratio
+        if first or pending >= GZIP_FLUSH_SIZE:
+            compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending, first = 0, False
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def export_activities(athlete_id: int, export_format: ExportFormat, gzip: bool = False) -> AsyncIterator[bytes]:
+    """
+    The encoded archive, chunk by chunk. Opens its own session as it outlives the request handler.
+    """
+    async with AsyncReadSessionLocal() as db:
+        chunks = _encode(async_crud.stream_activities(db, athlete_id, _COLUMNS, EXPORT_BATCH_SIZE), export_format)
+        if gzip:
+            chunks = _gzip(chunks)
+        async for chunk in chunks:
+            yield chunk
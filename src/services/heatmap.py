@@ -0,0 +1,172 @@
+"""
+Explored area of each athlete: the routes rasterized into per-zoom tiles of visit counts, kept up to date
+incrementally as activities change. Writes only record the changed activities, the explored worker updates the tiles
+in batches out of the request and import paths.
+"""
+import os
+import threading
+import traceback
+import zlib
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from database.db import SessionLocal
+from geo.png import encode_rgba
+from geo.polyline import unpack_coordinates, pack_coordinates
+from geo.tiles import rasterize_route, TILE_SIZE
+from models import crud
+from models.explored import ExploredTileModel, ExploredActivityModel
+from monitoring.metrics import track_task
+from services.itinerary import get_route_coordinates
+
+EXPLORED_MIN_ZOOM = int(os.getenv('EXPLORED_MIN_ZOOM', 6))
+EXPLORED_MAX_ZOOM = int(os.getenv('EXPLORED_MAX_ZOOM', 14))
+EXPLORED_ZOOMS = range(EXPLORED_MIN_ZOOM, EXPLORED_MAX_ZOOM + 1)
+EXPLORED_BATCH_SIZE = int(os.getenv('EXPLORED_BATCH_SIZE', 500))
+EXPLORED_POLL_INTERVAL = float(os.getenv('EXPLORED_POLL_INTERVAL', 5))
+
+EXPLORED_COLOR = (252, 76, 2)
+
+TileKey = Tuple[int, int, int]  # zoom, x, y
+
+# Two updates of the same activities must not both read the previous routes before either writes
+_update_lock = threading.Lock()
+
+
+def decode_counts(tile: Optional[ExploredTileModel]) -> np.ndarray:
+    if tile is None:
+        return np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint16)
+    return np.frombuffer(zlib.decompress(tile.counts), dtype="<u2").reshape(TILE_SIZE, TILE_SIZE)
+
+
+def encode_counts(counts: np.ndarray) -> bytes:
+    return zlib.compress(counts.astype("<u2").tobytes())
+
+
+def _add_route(deltas: Dict[TileKey, List[Tuple[np.ndarray, int]]], route: bytes, sign: int):
+    coordinates = unpack_coordinates(route)
+    for zoom in EXPLORED_ZOOMS:
+        for (x, y), pixels in rasterize_route(coordinates, zoom).items():
+            deltas.setdefault((zoom, x, y), []).append((pixels, sign))
+
+
+def update_explored_tiles(db: Session, athlete_id: int, activity_ids: List[int]):
+    """
+    Bring the athlete's tiles in line with the current routes of these activities: the route previously rasterized
+    is subtracted and the new one added, unchanged routes cost nothing. The caller commits.
+    """
+    crud.lock_explored_area(db, athlete_id)
+    current_routes = {}
+    for activity in crud.get_activity_routes(db, athlete_id=athlete_id, activity_ids=activity_ids):
+        coordinates = get_route_coordinates(activity.polyline, activity.route)
+        current_routes[activity.id] = pack_coordinates(coordinates) if len(coordinates) else None
+    applied = {explored.activity_id: explored for explored in crud.get_explored_activities(db, activity_ids)}
+
+    deltas: Dict[TileKey, List[Tuple[np.ndarray, int]]] = {}
+    for activity_id in activity_ids:
+        route, explored = current_routes.get(activity_id), applied.get(activity_id)
+        applied_route = explored.route if explored is not None else None
+        if route == applied_route:
+            continue
+        if applied_route:
+            _add_route(deltas, applied_route, -1)
+        if route:
+            _add_route(deltas, route, 1)
+
+        if route is None:
+            if explored is not None:
+                db.delete(explored)
+        elif explored is None:
+            db.add(ExploredActivityModel(activity_id=activity_id, athlete_id=athlete_id, route=route))
+        else:
+            explored.route = route
+
+    tiles = {(tile.zoom, tile.x, tile.y): tile
+             for tile in crud.get_explored_tiles_for_update(db, athlete_id, deltas.keys())} if deltas else {}
+    for (zoom, x, y), tile_deltas in deltas.items():
+        tile = tiles.get((zoom, x, y))
+        counts = decode_counts(tile).astype(np.int64).ravel()
+        for pixels, sign in tile_deltas:
+            counts += sign * np.bincount(pixels, minlength=TILE_SIZE * TILE_SIZE)
+        counts = np.clip(counts, 0, np.iinfo(np.uint16).max).reshape(TILE_SIZE, TILE_SIZE)
+
+        if not counts.any():
+            if tile is not None:
+                db.delete(tile)
+        elif tile is None:
+            db.add(ExploredTileModel(athlete_id=athlete_id, zoom=zoom, x=x, y=y, counts=encode_counts(counts)))
+        else:
+            tile.counts = encode_counts(counts)
+
+
+def update_next_explored_batch(batch_size: int = EXPLORED_BATCH_SIZE) -> int:
+    """
+    Update the tiles of one athlete for up to `batch_size` changed activities. Returns the number of activities
+    handled, 0 when no change is left.
+    """
+    db = SessionLocal()
+    try:
+        with _update_lock:
+            athlete_id, changes = crud.claim_explored_changes(db, batch_size)
+            if not changes:
+                db.commit()
+                return 0
+            with track_task("update_explored_tiles"):
+                update_explored_tiles(db, athlete_id, [change.activity_id for change in changes])
+            crud.delete_explored_changes(db, changes)
+            db.commit()
+        return len(changes)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def explored_worker_loop(stop: threading.Event, poll_interval: float = EXPLORED_POLL_INTERVAL):
+    """
+    Update the explored tiles until `stop` is set, sleeping `poll_interval` when no change is left. The changes
+    recorded meanwhile, a whole import page for instance, are applied together.
+    """
+    while not stop.is_set():
+        try:
+            if update_next_explored_batch():
+                continue
+        except Exception:
+            traceback.print_exc()
+        stop.wait(poll_interval)
+
+
+def render_tile(counts: Optional[np.ndarray]) -> bytes:
+    image = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    if counts is not None:
+        visited = counts > 0
+        image[visited, :3] = EXPLORED_COLOR
+        # More visits, more opaque
+        image[visited, 3] = np.minimum(255, 128 + 32 * np.log2(counts[visited])).astype(np.uint8)
+    return encode_rgba(image)
+
+
+def tile_counts(tile: Optional[ExploredTileModel], zoom: int, x: int, y: int) -> Optional[np.ndarray]:
+    """
+    Counts of the requested tile. Above EXPLORED_MAX_ZOOM, `tile` is the ancestor tile at EXPLORED_MAX_ZOOM and its
+    matching area is scaled up, up to EXPLORED_MAX_ZOOM + 8 where a stored pixel covers the whole tile.
+    """
+    if tile is None:
+        return None
+    counts = decode_counts(tile)
+    if zoom <= EXPLORED_MAX_ZOOM:
+        return counts
+    scale = 2 ** (zoom - EXPLORED_MAX_ZOOM)
+    size = TILE_SIZE // scale
+    row, column = (y % scale) * size, (x % scale) * size
+    return np.kron(counts[row:row + size, column:column + size], np.ones((scale, scale), dtype=np.uint16))
+
+
+def stored_tile_key(zoom: int, x: int, y: int) -> TileKey:
+    if zoom <= EXPLORED_MAX_ZOOM:
+        return zoom, x, y
+    shift = zoom - EXPLORED_MAX_ZOOM
+    return EXPLORED_MAX_ZOOM, x >> shift, y >> shift
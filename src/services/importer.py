@@ -0,0 +1,113 @@
+import os
+import threading
+import traceback
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from database.db import SessionLocal
+from models import crud
+from models.sync_jobs import SyncJobModel
+from monitoring.metrics import track_task
+from strava.api import StravaApi
+from strava.client import StravaApiError
+
+IMPORT_CONCURRENCY = int(os.getenv('STRAVA_IMPORT_CONCURRENCY', 4))
+SYNC_POLL_INTERVAL = float(os.getenv('SYNC_POLL_INTERVAL', 5))
+# A running job not checkpointed for this long is considered abandoned and picked up again
+SYNC_STALE_AFTER = timedelta(seconds=int(os.getenv('SYNC_STALE_AFTER', 300)))
+# Running jobs are kept alive this often while waiting for Strava (rate limit), well within SYNC_STALE_AFTER
+SYNC_HEARTBEAT_INTERVAL = float(os.getenv('SYNC_HEARTBEAT_INTERVAL', 60))
+# Jobs hitting transient errors (network, 5xx, rate limit) are resumed later, up to SYNC_MAX_ATTEMPTS runs in a row
+SYNC_MAX_ATTEMPTS = int(os.getenv('SYNC_MAX_ATTEMPTS', 8))
+
+
+def _retry_backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(60 * 2 ** attempts, 6 * 3600))
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """
+    Strava refused the request (revoked token, missing scope, ...): running the job again will not help
+    """
+    return (isinstance(error, StravaApiError) and error.status_code is not None
+            and 400 <= error.status_code < 500 and error.status_code != 429)
+
+
+def import_activities(db: Session, job: SyncJobModel, lease: str, concurrency: int = IMPORT_CONCURRENCY,
+                      stop: Optional[threading.Event] = None) -> bool:
+    """
+    Stream the athlete's activities newer than the job cursor from Strava, writing and checkpointing each page as
+    soon as it arrives. Only one page of activities is held in memory at a time.
+    Returns False when `stop` was set before the end, the job can be resumed from its cursor. Raises
+    crud.SyncJobLeaseLost when another worker took the job over.
+    """
+    api = StravaApi(db=db, athlete_id=job.athlete_id)
+    pages = api.iter_activity_pages(concurrency=concurrency, after=job.last_start_date,
+                                    heartbeat=lambda: crud.heartbeat_sync_job(db, job, lease),
+                                    heartbeat_interval=SYNC_HEARTBEAT_INTERVAL)
+    for page, activities in pages:
+        crud.import_activity_page(db=db, job=job, lease=lease, page=page, activities=activities)
+        if stop is not None and stop.is_set():
+            return False
+    return True
+
+
+def run_next_sync_job(stop: Optional[threading.Event] = None) -> bool:
+    """
+    Claim and run one sync job. Returns False when there was nothing to do.
+    """
+    db = SessionLocal()
+    try:
+        job = crud.claim_sync_job(db, stale_after=SYNC_STALE_AFTER)
+        if job is None:
+            return False
+        job_id, lease = job.id, job.lease_token
+        try:
+            _run_sync_job(db, job, lease, stop)
+        except crud.SyncJobLeaseLost:
+            db.rollback()
+            print(f"Sync job {job_id} was taken over by another worker, leaving it")
+        return True
+    finally:
+        db.close()
+
+
+def _run_sync_job(db: Session, job: SyncJobModel, lease: str, stop: Optional[threading.Event]):
+    try:
+        with track_task("back_populate"):
+            completed = import_activities(db=db, job=job, lease=lease, stop=stop)
+    except crud.SyncJobLeaseLost:
+        raise
+    except Exception as e:
+        db.rollback()
+        if is_permanent_error(e) or job.attempts + 1 >= SYNC_MAX_ATTEMPTS:
+            print(f"Sync job {job.id} failed for athlete {job.athlete_id}")
+            traceback.print_exc()
+            crud.finish_sync_job(db, job, lease, error=repr(e))
+        else:
+            backoff = _retry_backoff(job.attempts)
+            if isinstance(e, StravaApiError) and e.retry_after:
+                backoff = max(backoff, timedelta(seconds=e.retry_after))
+            print(f"Sync job {job.id} of athlete {job.athlete_id} interrupted by {e!r}, resumed in {backoff}")
+            crud.retry_sync_job(db, job, lease, error=repr(e), backoff=backoff)
+    else:
+        if completed:
+            crud.finish_sync_job(db, job, lease)
+        else:
+            print(f"Sync job {job.id} interrupted, left for the next worker")
+            crud.release_sync_job(db, job, lease)
+
+
+def sync_worker_loop(stop: threading.Event, poll_interval: float = SYNC_POLL_INTERVAL):
+    """
+    Run pending sync jobs until `stop` is set, sleeping `poll_interval` when the queue is empty.
+    """
+    while not stop.is_set():
+        try:
+            if run_next_sync_job(stop):
+                continue
+        except Exception:
+            traceback.print_exc()
+        stop.wait(poll_interval)
@@ -1,9 +1,79 @@
-from models import crud
-from sqlalchemy.orm import Session
+from datetime import datetime
+from enum import Enum
+from typing import Optional, Union, List, Sequence
 
+import numpy as np
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
-def get_routes_by_date(athlete_id: int, db: Session):
-    activities = crud.get_routes_by_athlete_id(db=db, athlete_id=athlete_id)
+from geo.polyline import decode_polyline, encode_polyline, unpack_coordinates, to_degrees
+from geo.simplify import simplify, tolerance_for_zoom
+from models import async_crud
+from services.route_store import route_store, ROUTE_STORE_ENABLED
 
-    activities_routes = [{'polyline': activity.polyline, 'date': activity.start_date_local} for activity in activities]
-    return activities_routes
\ No newline at end of file
+
+class RouteFormat(str, Enum):
+    polyline = "polyline"
+    coordinates = "coordinates"
+
+
+def get_route_coordinates(polyline: Optional[str], route: Optional[bytes] = None) -> np.ndarray:
+    if route is not None:
+        return unpack_coordinates(route)
+    # Activities stored before the route column was added
+    return decode_polyline(polyline)
+
+
+def format_route(polyline: Optional[str], route: Optional[bytes] = None, zoom: Optional[int] = None,
+                 route_format: RouteFormat = RouteFormat.polyline) -> Union[str, List[List[float]]]:
+    """
+    Route of the activity, simplified for the map zoom level when given, as an encoded polyline or [lat, lng] pairs
+    """
+    if zoom is None and route_format == RouteFormat.polyline:
+        return polyline
+
+    coordinates = get_route_coordinates(polyline, route)
+    if zoom is not None:
+        coordinates = simplify(coordinates, tolerance_for_zoom(zoom))
+    if route_format == RouteFormat.coordinates:
+        return to_degrees(coordinates).tolist()
+    return encode_polyline(coordinates)
+
+
+def format_routes(activities: Sequence[Row], with_route: bool, zoom: Optional[int] = None,
+                  route_format: RouteFormat = RouteFormat.polyline) -> List[Union[str, List[List[float]]]]:
+    return [format_route(activity.polyline, activity.route if with_route else None, zoom, route_format)
+            for activity in activities]
+
+
+async def format_routes_async(activities: Sequence[Row], with_route: bool, zoom: Optional[int] = None,
+                              route_format: RouteFormat = RouteFormat.polyline) -> List[Union[str, List[List[float]]]]:
+    """
+    format_routes() run in the thread pool when the routes are decoded: simplifying a page of routes takes longer
+    than the event loop should be held
+    """
+    if zoom is None and route_format == RouteFormat.polyline:
+        return [activity.polyline for activity in activities]
+    return await run_in_threadpool(format_routes, activities, with_route, zoom, route_format)
+
+
+async def get_routes_by_date(athlete_id: int, db: AsyncSession, limit: int = 10, before: Optional[datetime] = None,
+                             before_id: Optional[int] = None, zoom: Optional[int] = None,
+                             route_format: RouteFormat = RouteFormat.polyline):
+    """
+    The `limit` most recent routes before the (`before`, `before_id`) cursor, oldest first. The next page is requested
+    with the date and id of the first route as `before` and `before_id`, routes started at the same time are not
+    skipped. Without `before_id`, routes started before `before`.
+    """
+    with_route = zoom is not None or route_format != RouteFormat.polyline
+    if ROUTE_STORE_ENABLED:
+        activities = (await route_store.get(db, athlete_id)).page(limit, before, before_id)
+    else:
+        activities = await async_crud.get_routes_page(db=db, athlete_id=athlete_id, limit=limit, before=before,
+                                                      before_id=before_id, with_route=with_route)
+
+    activities = activities[::-1]
+    routes = await format_routes_async(activities, with_route, zoom, route_format)
+    return [{'id': activity.id, 'polyline': route, 'date': activity.start_date_local}
+            for activity, route in zip(activities, routes)]
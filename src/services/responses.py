@@ -0,0 +1,34 @@
+"""
+Serialization shared by the endpoints: orjson everywhere, NDJSON for clients that stream lists
+"""
+from typing import Any, Iterable, AsyncIterator
+
+import orjson
+from fastapi import Request
+from pydantic import BaseModel
+
+JSON_MEDIA_TYPE = "application/json"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def _default(value: Any):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(payload: Any) -> bytes:
+    return orjson.dumps(payload, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def dumps_ndjson(items: Iterable[Any]) -> bytes:
+    return b"".join(dumps(item) + b"\n" for item in items)
+
+
+async def iter_ndjson(items: Iterable[Any]) -> AsyncIterator[bytes]:
+    for item in items:
+        yield dumps(item) + b"\n"
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
@@ -0,0 +1,235 @@
+"""
+Optional in-process store of the athletes' routes (ROUTE_STORE_ENABLED), so the route and bbox queries of active
+athletes are answered from memory instead of PostgreSQL.
+
+Each athlete is loaded whole on first use (or at login), changes reported by the activities changed hook are reloaded
+on the next read. Least recently used athletes are evicted above ROUTE_STORE_MAX_MB.
+
+Entries remember the athlete's version in the response cache backend. Every change bumps it once: when it moved by more
+than the changes notified in this process, another process sharing the backend (CACHE_REDIS_URL) wrote and the athlete
+is reloaded. With the in-process backend, entries are reloaded after ROUTE_STORE_TTL to pick up those writes.
+"""
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, List, Dict, Set, Iterable
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.db import AsyncReadSessionLocal
+from geo.grid_index import BoundingBox
+from models import async_crud
+from models.events import on_activities_changed
+from monitoring.metrics import ROUTE_STORE_BYTES, ROUTE_STORE_ATHLETES, ROUTE_STORE_LOOKUPS
+from services.cache import ResponseCache, response_cache
+
+ROUTE_STORE_ENABLED = os.getenv('ROUTE_STORE_ENABLED', 'false').lower() == 'true'
+ROUTE_STORE_MAX_MB = float(os.getenv('ROUTE_STORE_MAX_MB', 256))
+ROUTE_STORE_TTL = int(os.getenv('ROUTE_STORE_TTL', 600))
+
+
+class StoredRoute:
+    """
+    Same attributes as the rows of the route queries
+    """
+    __slots__ = ('id', 'polyline', 'start_date_local', 'sport_type', 'route')
+
+    def __init__(self, id: int, polyline: Optional[str], start_date_local: datetime, sport_type: Optional[str],
+                 route: Optional[bytes]):
+        self.id = id
+        self.polyline = polyline
+        self.start_date_local = start_date_local
+        self.sport_type = sport_type
+        self.route = route
+
+
+class AthleteRoutes:
+    """
+    Routes of one athlete, oldest first, with their bounding boxes in one array for vectorized viewport queries
+    """
+
+    def __init__(self, routes: List[StoredRoute], boxes: np.ndarray, loaded_at: Optional[float] = None):
+        self.routes = routes
+        self.boxes = boxes  # (N, 4) min_lat, min_lng, max_lat, max_lng, NaN without location
+        self.keys = [(route.start_date_local, route.id) for route in routes]
+        self.loaded_at = time.monotonic() if loaded_at is None else loaded_at
+        self.stale_ids: Set[int] = set()  # changed since loaded, reloaded on the next read
+        self.version: Optional[int] = None  # athlete's version in the cache backend when loaded
+        self.bumps = 0  # changes notified since then, each one bumped the version
+        self.size = (self.boxes.nbytes + sys.getsizeof(self.routes) + sys.getsizeof(self.keys)
+                     + sum(sys.getsizeof(route) + sys.getsizeof(route.polyline) + sys.getsizeof(route.route)
+                           for route in routes))
+
+    @classmethod
+    def from_rows(cls, rows: Iterable) -> "AthleteRoutes":
+        rows = list(rows)
+        routes = [StoredRoute(row.id, row.polyline, row.start_date_local, row.sport_type, row.route) for row in rows]
+        boxes = np.array([[np.nan if value is None else value
+                           for value in (row.min_lat, row.min_lng, row.max_lat, row.max_lng)] for row in rows],
+                         dtype=np.float64).reshape(-1, 4)
+        return cls(routes, boxes)
+
+    def patched(self, changed_ids: Set[int], rows: Iterable) -> "AthleteRoutes":
+        """
+        Copy with the activities of `changed_ids` replaced by `rows`, the ones missing from `rows` were deleted
+        """
+        kept = [position for position, route in enumerate(self.routes) if route.id not in changed_ids]
+        fresh = AthleteRoutes.from_rows(rows)
+        routes = [self.routes[position] for position in kept] + fresh.routes
+        boxes = np.concatenate([self.boxes[kept], fresh.boxes])
+        order = sorted(range(len(routes)), key=lambda position: (routes[position].start_date_local,
+                                                                  routes[position].id))
+        return AthleteRoutes([routes[position] for position in order], boxes[order], loaded_at=self.loaded_at)
+
+    def page(self, limit: int, before: Optional[datetime] = None, before_id: Optional[int] = None) -> List[StoredRoute]:
+        """
+        Same as async_crud.get_routes_page: the `limit` most recent routes before the (`before`, `before_id`) cursor,
+        newest first
+        """
+        if before is None:
+            end = len(self.routes)
+        else:
+            # (before,) sorts ahead of every (before, id)
+            end = bisect.bisect_left(self.keys, (before,) if before_id is None else (before, before_id))
+        return self.routes[max(0, end - limit):end][::-1]
+
+    def in_bounding_box(self, bounding_box: BoundingBox, limit: Optional[int]) -> List[StoredRoute]:
+        """
+        Same as async_crud.get_routes_in_bounding_box: routes whose bounding box intersects, newest first
+        """
+        min_lat, min_lng, max_lat, max_lng = bounding_box
+        positions = np.flatnonzero((self.boxes[:, 0] <= max_lat) & (self.boxes[:, 2] >= min_lat)
+                                   & (self.boxes[:, 1] <= max_lng) & (self.boxes[:, 3] >= min_lng))[::-1]
+        return [self.routes[position] for position in positions[:limit]]
+
+
+class _Load:
+    """
+    Changes notified while an athlete is being loaded
+    """
+    __slots__ = ('changed_ids', 'bumps', 'outdated')
+
+    def __init__(self):
+        self.changed_ids: Set[int] = set()
+        self.bumps = 0
+        self.outdated = False  # the whole history changed, the result is not stored
+
+
+class RouteStore:
+    def __init__(self, max_bytes: float, ttl: float, versions: ResponseCache = response_cache):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._versions = versions
+        self._entries: "OrderedDict[int, AthleteRoutes]" = OrderedDict()
+        self._loads: Dict[int, List[_Load]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def memory_usage(self) -> int:
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _update_metrics(self):
+        ROUTE_STORE_BYTES.set(sum(entry.size for entry in self._entries.values()))
+        ROUTE_STORE_ATHLETES.set(len(self._entries))
+
+    def _store(self, athlete_id: int, entry: AthleteRoutes):
+        """
+        Must be called holding the lock
+        """
+        if entry.size > self._max_bytes:
+            self._entries.pop(athlete_id, None)
+        else:
+            self._entries[athlete_id] = entry
+            self._entries.move_to_end(athlete_id)
+            total = sum(stored.size for stored in self._entries.values())
+            while total > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                total -= evicted.size
+        self._update_metrics()
+
+    def invalidate(self, athlete_id: int, activity_ids: List[int]):
+        with self._lock:
+            for load in self._loads.get(athlete_id, []):
+                load.changed_ids.update(activity_ids)
+                load.bumps += 1
+                load.outdated = load.outdated or not activity_ids
+            entry = self._entries.get(athlete_id)
+            if entry is None:
+                return
+            if activity_ids:
+                entry.stale_ids.update(activity_ids)
+                entry.bumps += 1
+            else:
+                # The whole history may have changed (end of a sync job)
+                del self._entries[athlete_id]
+                self._update_metrics()
+
+    async def _load(self, db: AsyncSession, athlete_id: int, version: int) -> AthleteRoutes:
+        load = _Load()
+        with self._lock:
+            self._loads.setdefault(athlete_id, []).append(load)
+        try:
+            entry = AthleteRoutes.from_rows(await async_crud.get_athlete_routes(db, athlete_id))
+        finally:
+            with self._lock:
+                loads = self._loads[athlete_id]
+                loads.remove(load)
+                if not loads:
+                    del self._loads[athlete_id]
+        with self._lock:
+            entry.stale_ids, entry.version, entry.bumps = load.changed_ids, version, load.bumps
+            if not load.outdated:
+                self._store(athlete_id, entry)
+        return entry
+
+    async def _refresh(self, db: AsyncSession, athlete_id: int, entry: AthleteRoutes, version: int) -> AthleteRoutes:
+        with self._lock:
+            stale_ids, entry.stale_ids, entry.bumps = entry.stale_ids, set(), 0
+        fresh = entry.patched(stale_ids, await async_crud.get_athlete_routes(db, athlete_id, list(stale_ids)))
+        with self._lock:
+            # Changes notified during the query are left for the next read
+            fresh.stale_ids, fresh.version, fresh.bumps = entry.stale_ids, version, entry.bumps
+            if self._entries.get(athlete_id) is entry:
+                self._store(athlete_id, fresh)
+        return fresh
+
+    async def get(self, db: AsyncSession, athlete_id: int) -> AthleteRoutes:
+        # Before the queries: a change committed during them bumps the version again and is reloaded on the next read
+        version = await self._versions.athlete_version(athlete_id)
+        with self._lock:
+            entry = self._entries.get(athlete_id)
+            if entry is not None:
+                self._entries.move_to_end(athlete_id)
+        if (entry is None or time.monotonic() - entry.loaded_at > self._ttl
+                or entry.version + entry.bumps != version):
+            ROUTE_STORE_LOOKUPS.labels("load").inc()
+            return await self._load(db, athlete_id, version)
+        if entry.stale_ids:
+            ROUTE_STORE_LOOKUPS.labels("refresh").inc()
+            return await self._refresh(db, athlete_id, entry, version)
+        ROUTE_STORE_LOOKUPS.labels("hit").inc()
+        return entry
+
+    async def warm_up(self, athlete_id: int):
+        """
+        Load the athlete ahead of their first map request, with its own session as it runs after the response
+        """
+        async with AsyncReadSessionLocal() as db:
+            await self.get(db, athlete_id)
+
+
+route_store = RouteStore(max_bytes=ROUTE_STORE_MAX_MB * 1024 * 1024, ttl=ROUTE_STORE_TTL)
+
+
+@on_activities_changed
+def invalidate_stored_routes(athlete_id: int, activity_ids: List[int]):
+    route_store.invalidate(athlete_id, activity_ids)
@@ -0,0 +1,86 @@
+"""
+Near-identical routes of an athlete (same commute, same loop), found from the route fingerprints
+"""
+import os
+import threading
+from typing import Optional, List, Dict, Any
+
+from cachetools import TTLCache
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from geo.fingerprint import SimilarityIndex, route_fingerprint, unpack_fingerprint
+from geo.polyline import decode_polyline
+from models import async_crud
+from models.events import on_activities_changed
+from services.cache import response_cache
+from services.itinerary import RouteFormat, format_routes_async
+
+# Share of the route cells two routes must have in common to be the same route
+ROUTE_SIMILARITY_THRESHOLD = float(os.getenv('ROUTE_SIMILARITY_THRESHOLD', 0.6))
+
+# Indexes are stored with the athlete's version in the response cache backend and rebuilt once it moved, which also
+# covers the writes of other processes sharing the backend. The TTL covers them with the in-process backend.
+_indexes: TTLCache = TTLCache(maxsize=int(os.getenv('SIMILARITY_INDEX_CACHE_SIZE', 256)),
+                              ttl=int(os.getenv('SIMILARITY_INDEX_TTL', 600)))
+_indexes_lock = threading.Lock()
+
+
+@on_activities_changed
+def invalidate_index(athlete_id: int, activity_ids: List[int]):
+    with _indexes_lock:
+        _indexes.pop(athlete_id, None)
+
+
+async def _get_index(db: AsyncSession, athlete_id: int) -> SimilarityIndex:
+    # Before the query: a change committed during it bumps the version again
+    version = await response_cache.athlete_version(athlete_id)
+    with _indexes_lock:
+        indexed_version, index = _indexes.get(athlete_id, (None, None))
+    if index is None or indexed_version != version:
+        ids, fingerprints = [], []
+        for row in await async_crud.get_fingerprints(db=db, athlete_id=athlete_id):
+            fingerprint = row.fingerprint
+            if fingerprint is None and row.polyline:
+                fingerprint = route_fingerprint(decode_polyline(row.polyline))
+            if fingerprint is not None:
+                ids.append(row.id)
+                fingerprints.append(unpack_fingerprint(fingerprint))
+        index = SimilarityIndex(ids, fingerprints)
+        with _indexes_lock:
+            _indexes[athlete_id] = (version, index)
+    return index
+
+
+async def _format_routes(db: AsyncSession, activity_ids: List[int], zoom: Optional[int],
+                         route_format: RouteFormat) -> Dict[int, Dict[str, Any]]:
+    with_route = zoom is not None or route_format != RouteFormat.polyline
+    activities = (await async_crud.get_routes_by_ids(db=db, activity_ids=activity_ids, limit=None,
+                                                     with_route=with_route))[::-1] if activity_ids else []
+    routes = await format_routes_async(activities, with_route, zoom, route_format)
+    return {activity.id: {'id': activity.id, 'polyline': route, 'date': activity.start_date_local}
+            for activity, route in zip(activities, routes)}
+
+
+async def get_unique_routes(athlete_id: int, db: AsyncSession, zoom: Optional[int] = None,
+                            route_format: RouteFormat = RouteFormat.polyline) -> List[Dict[str, Any]]:
+    """
+    One route per group of near-identical routes, the most recent one, with the number of activities of the group.
+    Oldest first.
+    """
+    index = await _get_index(db, athlete_id)
+    # Groups list their activities in index order, oldest first
+    counts = {group[-1]: len(group) for group in index.clusters(ROUTE_SIMILARITY_THRESHOLD)}
+    routes = await _format_routes(db, list(counts), zoom, route_format)
+    return [{**route, 'count': counts[activity_id]} for activity_id, route in routes.items()]
+
+
+async def get_similar_routes(athlete_id: int, activity_id: int, db: AsyncSession, zoom: Optional[int] = None,
+                             route_format: RouteFormat = RouteFormat.polyline) -> List[Dict[str, Any]]:
+    """
+    The athlete's other routes near-identical to this activity's, most similar first
+    """
+    index = await _get_index(db, athlete_id)
+    similarities = dict(index.similar(activity_id, ROUTE_SIMILARITY_THRESHOLD))
+    routes = await _format_routes(db, list(similarities), zoom, route_format)
+    return [{**routes[similar_id], 'similarity': similarity}
+            for similar_id, similarity in similarities.items() if similar_id in routes]
@@ -0,0 +1,71 @@
+"""
+Mapbox Vector Tiles of the athlete's routes
+"""
+import os
+from typing import List
+
+import numpy as np
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from geo import mvt
+from geo.simplify import simplify
+from geo.tiles import tile_bounds, to_tile_units, clip_lines, TILE_SIZE
+from services.bbox import find_routes_in_bounding_box
+from services.itinerary import get_route_coordinates
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+ROUTES_LAYER = "routes"
+# Geometries reach a little into the neighbouring tiles so lines are not cut visibly at the tile borders
+MVT_BUFFER = int(os.getenv('MVT_BUFFER', 64))
+MVT_SIMPLIFY_PIXELS = float(os.getenv('MVT_SIMPLIFY_PIXELS', 0.5))
+# Most recent activities drawn on a tile, low zoom tiles would otherwise load and encode every route of the athlete
+MVT_MAX_FEATURES = int(os.getenv('MVT_MAX_FEATURES', 1000))
+
+
+def _tile_parts(coordinates: np.ndarray, zoom: int, x: int, y: int) -> List[np.ndarray]:
+    """
+    Integer parts of the route within the buffered tile, simplified for this zoom level
+    """
+    points = to_tile_units(coordinates, zoom, x, y, mvt.EXTENT)
+    tolerance = MVT_SIMPLIFY_PIXELS * mvt.EXTENT / TILE_SIZE
+    parts = []
+    for part in clip_lines(points, -MVT_BUFFER, mvt.EXTENT + MVT_BUFFER):
+        part = np.rint(part).astype(np.int64)
+        part = part[np.concatenate(([True], (np.diff(part, axis=0) != 0).any(axis=1)))]
+        if len(part) >= 2:
+            parts.append(simplify(part, tolerance))
+    return parts
+
+
+def encode_routes_tile(activities: List[Row], zoom: int, x: int, y: int) -> bytes:
+    """
+    Tile with one line feature per activity crossing it, with its id, date and sport type as attributes. Activities
+    are given most recent first and drawn oldest first.
+    """
+    features = []
+    for activity in reversed(activities):
+        parts = _tile_parts(get_route_coordinates(activity.polyline, activity.route), zoom, x, y)
+        if not parts:
+            continue
+        properties = {'id': activity.id, 'date': activity.start_date_local.isoformat()}
+        if activity.sport_type is not None:
+            properties['sport_type'] = activity.sport_type
+        features.append((activity.id, parts, properties))
+    if not features:
+        return b""
+    return mvt.encode_tile([mvt.encode_layer(ROUTES_LAYER, features)])
+
+
+async def build_routes_tile(athlete_id: int, db: AsyncSession, zoom: int, x: int, y: int,
+                            max_features: int = MVT_MAX_FEATURES) -> bytes:
+    """
+    Tile of the `max_features` most recent activities crossing it, clipped and encoded in the thread pool
+    """
+    bounding_box = tile_bounds(zoom, x, y, buffer=MVT_BUFFER / mvt.EXTENT)
+    activities = await find_routes_in_bounding_box(athlete_id, db, bounding_box, limit=max_features, with_route=True,
+                                                   with_sport_type=True)
+    if not activities:
+        return b""
+    return await run_in_threadpool(encode_routes_tile, activities, zoom, x, y)
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from typing import List, Dict
+
+from sqlalchemy import Row
+from sqlalchemy.orm import Session
+
+from database.db import SessionLocal
+from models import crud
+from monitoring.metrics import track_task
+from strava.api import StravaApi
+from strava.client import StravaApiError
+
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 100))
+WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', 1))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 8))
+# Events are leased for this long while processed, a crashed worker's events come back after it
+WEBHOOK_LEASE = timedelta(seconds=int(os.getenv('WEBHOOK_LEASE', 300)))
+# Events still failing after WEBHOOK_MAX_ATTEMPTS are kept this long to be looked at, then deleted
+WEBHOOK_FAILED_RETENTION = timedelta(seconds=int(os.getenv('WEBHOOK_FAILED_RETENTION', 7 * 86400)))
+WEBHOOK_PRUNE_INTERVAL = float(os.getenv('WEBHOOK_PRUNE_INTERVAL', 3600))
+# Applied events are kept this long, Strava's redeliveries of them are not queued again meanwhile
+WEBHOOK_DEDUP_TTL = timedelta(seconds=int(os.getenv('WEBHOOK_DEDUP_TTL', 3600)))
+
+
+def _retry_backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(30 * 2 ** attempts, 3600))
+
+
+def register_webhook(db: Session, webhooks: List[Row]):
+    """
+    Apply the events received for one activity, oldest first, as a single action:
+    a delete wins, a create (or an update for an activity we do not have) is one fetch of the current state from
+    Strava, otherwise the updates are merged into one write.
+    """
+    last_webhook = webhooks[-1]
+    activity_id = last_webhook.object_id
+
+    if last_webhook.aspect_type == "delete":
+        crud.delete_activity_by_id(db=db, activity_id=activity_id)
+        return
+
+    if any(webhook.aspect_type == "create" for webhook in webhooks):
+        # Nothing to fetch when the details were already fetched after the last event (import, enrichment worker)
+        activity = crud.get_activity_by_id(db=db, activity_id=activity_id)
+        if activity is None or activity.detailed_at is None or \
+                activity.detailed_at < datetime.utcfromtimestamp(last_webhook.event_time):
+            _fetch_activity(db, last_webhook.owner_id, activity_id)
+        return
+
+    changes = {}
+    for webhook in webhooks:
+        changes.update(webhook.updates or {})
+    if crud.update_activity_by_id(db=db, activity_id=activity_id, changes=changes) is None:
+        _fetch_activity(db, last_webhook.owner_id, activity_id)
+
+
+def _fetch_activity(db: Session, athlete_id: int, activity_id: int):
+    """
+    Store the current state of the activity. Other Strava errors than a deleted or private activity are raised, for
+    the events to be retried.
+    """
+    try:
+        StravaApi(db=db, athlete_id=athlete_id).get_activity_from_id(activity_id)
+    except StravaApiError as e:
+        if not e.permanent:
+            raise
+        print(f"Activity {activity_id} is not readable anymore, nothing to apply: {e}")
+
+
+def process_webhook_batch(batch_size: int = WEBHOOK_BATCH_SIZE) -> int:
+    """
+    Drain one batch of queued webhook events. Returns the number of events handled.
+    """
+    db = SessionLocal()
+    try:
+        webhooks = crud.claim_webhooks(db, batch_size=batch_size, lease=WEBHOOK_LEASE)
+        webhooks_by_activity: Dict[int, List[Row]] = {}
+        for webhook in webhooks:
+            webhooks_by_activity.setdefault(webhook.object_id, []).append(webhook)
+
+        for activity_webhooks in webhooks_by_activity.values():
+            webhook_ids = [webhook.id for webhook in activity_webhooks]
+            attempts = max(webhook.attempts for webhook in activity_webhooks)
+            try:
+                with track_task("register_webhook"):
+                    register_webhook(db, activity_webhooks)
+            except Exception as e:
+                will_retry = "will retry" if attempts + 1 < WEBHOOK_MAX_ATTEMPTS else "giving up"
+                print(f"Webhook processing failed for activity {activity_webhooks[-1].object_id}, {will_retry}")
+                traceback.print_exc()
+                db.rollback()
+                crud.retry_webhooks(db, webhook_ids, error=repr(e), backoff=_retry_backoff(attempts),
+                                    max_attempts=WEBHOOK_MAX_ATTEMPTS)
+            else:
+                crud.complete_webhooks(db, webhook_ids)
+        return len(webhooks)
+    finally:
+        db.close()
+
+
+def prune_webhooks() -> int:
+    db = SessionLocal()
+    try:
+        return (crud.prune_webhooks(db, status="done", retention=WEBHOOK_DEDUP_TTL)
+                + crud.prune_webhooks(db, status="failed", retention=WEBHOOK_FAILED_RETENTION))
+    finally:
+        db.close()
+
+
+def webhook_worker_loop(stop: threading.Event, poll_interval: float = WEBHOOK_POLL_INTERVAL):
+    """
+    Process queued webhook events until `stop` is set, sleeping `poll_interval` when the queue is empty.
+    Applied and failed events past their retention are deleted every WEBHOOK_PRUNE_INTERVAL.
+    """
+    next_prune = 0
+    while not stop.is_set():
+        try:
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + WEBHOOK_PRUNE_INTERVAL
+                if pruned := prune_webhooks():
+                    print(f"Deleted {pruned} finished webhook events")
+            if process_webhook_batch():
+                continue
+        except Exception:
+            traceback.print_exc()
+        stop.wait(poll_interval)
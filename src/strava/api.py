@@ -1,14 +1,27 @@
 import os
-from datetime import datetime
-from typing import Dict, Optional, List
-
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Dict, Optional, List, Iterator, Tuple, Callable
 
 from sqlalchemy.orm import Session
 
 from models import crud
 from schemas.activities import DetailedActivity, SummaryActivity
 from schemas.auth import RefreshedLogin
+from strava.client import StravaApiError, get_strava_client, raise_for_status
+from strava.tokens import token_cache
+
+STRAVA_API_URL = os.getenv("STRAVA_API_URL", "https://www.strava.com/api/v3")
+ACTIVITIES_PER_PAGE = 200
+
+
+def _refresh_token_params(refresh_token: str) -> Dict[str, str]:
+    return {
+        'client_id': os.getenv('STRAVA_CLIENT_ID'),
+        'client_secret': os.getenv('STRAVA_CLIENT_SECRET'),
+        'grant_type': 'refresh_token',
+        'refresh_token': refresh_token
+    }
 
 
 class StravaApi:
@@ -20,63 +33,141 @@ class StravaApi:
         token = self.get_token()
         base_headers = {"Authorization": f"Bearer {token}"}
         if headers is not None:
-            return base_headers.update(headers)
+            base_headers.update(headers)
         return base_headers
 
     def get_strava(self, endpoint: str, headers: Optional[Dict[str, str]] = None, params: Optional[Dict] = None):
+        """
+        Raises StravaApiError when Strava does not answer 200, once the client retries are exhausted
+        """
         headers_with_auth = self._headers(headers=headers)
-        response = requests.get(endpoint, headers=headers_with_auth, params=params)
-        if response.status_code == 200:
-            return response
-        else:
-            print(f"Error while requesting GET {endpoint}")
+        return raise_for_status(get_strava_client().get(endpoint, headers=headers_with_auth, params=params))
 
     def get_token(self) -> str:
-        login = crud.get_athlete_login(self._db, self._athlete_id)
-
-        if datetime.utcfromtimestamp(login.expires_at) < datetime.utcnow():
-            params = {
-                'client_id': os.getenv('STRAVA_CLIENT_ID'),
-                'client_secret': os.getenv('STRAVA_CLIENT_SECRET'),
-                'grant_type': 'refresh_token',
-                'refresh_token': login.refresh_token
-            }
-            response = requests.post("https://www.strava.com/api/v3/oauth/token", params=params)
+        token = token_cache.get(self._athlete_id)
+        if token is not None:
+            return token
+
+        with token_cache.lock_for(self._athlete_id):
+            # Another task may have refreshed the token while we were waiting for the lock
+            token = token_cache.get(self._athlete_id)
+            if token is not None:
+                return token
+
+            login = crud.get_athlete_login(self._db, self._athlete_id)
+            if token_cache.is_fresh(login.expires_at):
+                token_cache.set(self._athlete_id, login.access_token, login.expires_at)
+                return login.access_token
+
+            response = get_strava_client().post(f"{STRAVA_API_URL}/oauth/token", wait_for_quota=False,
+                                                params=_refresh_token_params(login.refresh_token))
             if response.status_code == 200:
                 refreshed_login_data = RefreshedLogin(**response.json())
                 crud.update_athlete_login(self._db, refreshed_login_data, athlete_id=self._athlete_id)
+                token_cache.set(self._athlete_id, refreshed_login_data.access_token, refreshed_login_data.expires_at)
                 return refreshed_login_data.access_token
-            else:
-                print("ERROR while refreshing token")
-        else:
-            return login.access_token
+            raise StravaApiError(f"Error {response.status_code} while refreshing the token of athlete "
+                                 f"{self._athlete_id}", status_code=response.status_code)
 
     def get_activity_from_id(self, activity_id: int):
-        url = f"https://www.strava.com/api/v3/activities/{activity_id}?"
+        url = f"{STRAVA_API_URL}/activities/{activity_id}?"
         response = self.get_strava(url)
         activity = DetailedActivity(**response.json())
-        if crud.get_activity_by_id(db=self._db, activity_id=activity.id) is None:
-            crud.create_activity(db=self._db, activity=activity)
-        else:
-            crud.update_activity(db=self._db, activity=activity)
-
-    def _list_activity_recursive(self, page: Optional[int] = 1) -> List[Dict]:
-        url = f"https://www.strava.com/api/v3/athlete/activities"
-        per_page_max = 200
+        crud.upsert_activities(db=self._db, activities=[activity])
+
+    @staticmethod
+    def _fetch_activity_details(headers: Dict[str, str], activity_id: int) -> Optional[DetailedActivity]:
+        try:
+            response = raise_for_status(get_strava_client().get(f"{STRAVA_API_URL}/activities/{activity_id}",
+                                                                headers=headers))
+        except StravaApiError as e:
+            if not e.permanent:
+                raise
+            print(f"Activity {activity_id} is not readable anymore: {e}")
+            return None
+        return DetailedActivity(**response.json())
+
+    def get_activity_details(self, activity_ids: List[int],
+                             concurrency: int = 4) -> Dict[int, Optional[DetailedActivity]]:
+        """
+        DetailedActivity of each activity, fetched with up to `concurrency` requests in flight. None for the
+        activities Strava will not return (deleted, private without the activity:read_all scope, ...).
+        Activities whose request failed otherwise (rate limit, Strava errors) are left out, to be asked again later.
+        """
+        headers = self._headers()
+        details = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {activity_id: executor.submit(self._fetch_activity_details, headers, activity_id)
+                       for activity_id in activity_ids}
+            for activity_id, future in futures.items():
+                try:
+                    details[activity_id] = future.result()
+                except StravaApiError as e:
+                    print(f"Could not fetch the details of activity {activity_id}: {e}")
+        return details
+
+    @staticmethod
+    def _fetch_activity_page(headers: Dict[str, str], page: int, after: Optional[int] = None) -> List[Dict]:
         params = {
-            'per_page': per_page_max,
+            'per_page': ACTIVITIES_PER_PAGE,
             'page': page
         }
-        data = self.get_strava(endpoint=url, params=params).json()
-        if len(data) == per_page_max:
-            data.extend(self._list_activity_recursive(page=page+1))
-        return data
+        if after is not None:
+            params['after'] = after
+        response = get_strava_client().get(f"{STRAVA_API_URL}/athlete/activities", headers=headers, params=params)
+        return raise_for_status(response).json()
+
+    def iter_activity_pages(self, concurrency: int = 4, start_page: int = 1, after: Optional[int] = None,
+                            heartbeat: Optional[Callable[[], None]] = None,
+                            heartbeat_interval: float = 60) -> Iterator[Tuple[int, List[SummaryActivity]]]:
+        """
+        Yield (page, activities) in page order while keeping up to `concurrency` page requests in flight.
+        Stops at the first page holding less than ACTIVITIES_PER_PAGE activities.
+        With `after` (epoch seconds), Strava only returns newer activities, oldest first.
+        `heartbeat` is called every `heartbeat_interval` seconds spent waiting for a page (rate limit), on the
+        caller's thread.
+
+        The first page is requested alone and the number of requests in flight doubles with each full page, so a
+        short history (or an incremental sync) costs one request and at most the current window is requested past
+        the last page.
+        """
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            in_flight = deque()
+            next_page = start_page
+            window = 1
+
+            # Headers are resolved on the caller's thread, the db session is not shared with the workers
+            def fill():
+                nonlocal next_page
+                while len(in_flight) < window:
+                    in_flight.append((next_page, executor.submit(self._fetch_activity_page, self._headers(),
+                                                                 next_page, after)))
+                    next_page += 1
+
+            fill()
+            while in_flight:
+                page, future = in_flight.popleft()
+                raw_activities = self._wait_for_page(future, heartbeat, heartbeat_interval)
+                yield page, self._parse_activities(raw_activities)
+
+                if len(raw_activities) < ACTIVITIES_PER_PAGE:
+                    for _, pending in in_flight:
+                        pending.cancel()
+                    return
+                window = min(window * 2, concurrency)
+                fill()
+
+    @staticmethod
+    def _wait_for_page(future: Future, heartbeat: Optional[Callable[[], None]],
+                       heartbeat_interval: float) -> List[Dict]:
+        while heartbeat is not None:
+            try:
+                return future.result(timeout=heartbeat_interval)
+            except FutureTimeoutError:
+                heartbeat()
+        return future.result()
 
     @staticmethod
     def _parse_activities(raw_activities: List[Dict]) -> List[SummaryActivity]:
         return [SummaryActivity(**raw_activity) for raw_activity in raw_activities]
 
-    def list_activity_for_athlete_id(self):
-        data = self._list_activity_recursive()
-        activities = self._parse_activities(data)
-        return activities
@@ -0,0 +1,323 @@
+"""
+Process-wide HTTP client for the Strava API, shared by every athlete
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Optional, Mapping
+
+import httpx
+
+from monitoring.metrics import observe_strava_call
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+SHORT_WINDOW_SECONDS = 15 * 60
+# Strava errors retried by the client, as well as timeouts and connection errors, after STRAVA_RETRY_BACKOFF, then
+# twice as long, ... seconds
+RETRIED_STATUS_CODES = {500, 502, 503, 504}
+RETRY_BACKOFF_SECONDS = float(os.getenv('STRAVA_RETRY_BACKOFF', 1))
+
+
+class StravaApiError(Exception):
+    """
+    Strava answered with an error status, or could not be reached (no status code)
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after  # seconds, when known
+
+    @property
+    def permanent(self) -> bool:
+        """
+        The resource is gone or not readable with the athlete's scopes, asking again will not help
+        """
+        return self.status_code in (403, 404)
+
+
+class StravaRateLimitError(StravaApiError):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message, status_code=429, retry_after=retry_after)
+
+
+def raise_for_status(response: httpx.Response) -> httpx.Response:
+    if response.status_code != 200:
+        raise StravaApiError(f"Error {response.status_code} while requesting {response.request.method} "
+                             f"{response.request.url}", status_code=response.status_code)
+    return response
+
+
+class StravaRateLimiter:
+    """
+    Keeps track of the Strava quota from the X-RateLimit-Limit / X-RateLimit-Usage headers ("15min,daily") and blocks
+    callers once the current window is used up. The 15-minute window resets on the quarter hour, the daily one at
+    midnight UTC.
+    """
+
+    def __init__(self, short_limit: int = 200, daily_limit: int = 2000, reserve: int = 0):
+        self._condition = threading.Condition()
+        self._short_limit = short_limit
+        self._daily_limit = daily_limit
+        self._reserve = reserve
+        self._short_used = 0
+        self._daily_used = 0
+        self._short_window = self._current_short_window(time.time())
+        self._daily_window = self._current_daily_window(time.time())
+
+    @staticmethod
+    def _current_short_window(now: float) -> int:
+        return int(now // SHORT_WINDOW_SECONDS)
+
+    @staticmethod
+    def _current_daily_window(now: float) -> int:
+        return int(now // 86400)
+
+    def _roll_windows(self, now: float):
+        short_window = self._current_short_window(now)
+        if short_window != self._short_window:
+            self._short_window = short_window
+            self._short_used = 0
+        daily_window = self._current_daily_window(now)
+        if daily_window != self._daily_window:
+            self._daily_window = daily_window
+            self._daily_used = 0
+
+    def _seconds_until_available(self, now: float) -> float:
+        if self._daily_used >= self._daily_limit - self._reserve:
+            return (self._daily_window + 1) * 86400 - now
+        if self._short_used >= self._short_limit - self._reserve:
+            return (self._short_window + 1) * SHORT_WINDOW_SECONDS - now
+        return 0
+
+    def _try_reserve(self) -> float:
+        """
+        Reserve one request in the quota if possible, otherwise return the number of seconds to wait.
+        Must be called holding the condition.
+        """
+        now = time.time()
+        self._roll_windows(now)
+        wait = self._seconds_until_available(now)
+        if wait <= 0:
+            self._short_used += 1
+            self._daily_used += 1
+        return wait
+
+    def acquire(self):
+        """
+        Reserve one request in the quota, waiting for the next window if the current one is used up.
+        """
+        with self._condition:
+            waiting = False
+            while (wait := self._try_reserve()) > 0:
+                if not waiting:
+                    logger.warning("Strava rate limit reached, waiting %.0fs", wait)
+                    waiting = True
+                self._condition.wait(timeout=wait)
+
+    async def acquire_async(self):
+        """
+        Same as acquire() without blocking the event loop.
+        """
+        waiting = False
+        while True:
+            with self._condition:
+                wait = self._try_reserve()
+            if wait <= 0:
+                return
+            if not waiting:
+                logger.warning("Strava rate limit reached, waiting %.0fs", wait)
+                waiting = True
+            await asyncio.sleep(min(wait, 1))
+
+    def seconds_until_available(self) -> float:
+        with self._condition:
+            now = time.time()
+            self._roll_windows(now)
+            return max(0., self._seconds_until_available(now))
+
+    def update(self, headers: Mapping[str, str]):
+        """
+        Sync with the quota reported by Strava, which also counts requests made by other processes.
+        """
+        limit, usage = headers.get("X-RateLimit-Limit"), headers.get("X-RateLimit-Usage")
+        if limit is None or usage is None:
+            return
+        try:
+            short_limit, daily_limit = (int(value) for value in limit.split(",")[:2])
+            short_usage, daily_usage = (int(value) for value in usage.split(",")[:2])
+        except ValueError:
+            return
+        with self._condition:
+            self._roll_windows(time.time())
+            self._short_limit = short_limit
+            self._daily_limit = daily_limit
+            self._short_used = max(self._short_used, short_usage)
+            self._daily_used = max(self._daily_used, daily_usage)
+            self._condition.notify_all()
+
+    def exhaust(self):
+        """
+        Strava answered 429: hold everyone back until the window resets.
+        """
+        with self._condition:
+            self._short_used = self._short_limit
+
+    @property
+    def headroom(self) -> int:
+        with self._condition:
+            self._roll_windows(time.time())
+            return max(0, min(self._short_limit - self._short_used, self._daily_limit - self._daily_used))
+
+
+class StravaClient:
+    def __init__(self, client: httpx.Client, rate_limiter: StravaRateLimiter, max_retries: int = 2):
+        self._client = client
+        self.rate_limiter = rate_limiter
+        self._max_retries = max_retries
+
+    def request(self, method: str, url: str, wait_for_quota: bool = True, **kwargs) -> httpx.Response:
+        """
+        Waits for the quota and retries on 429, 5xx, timeouts and connection errors. Raises StravaRateLimitError when
+        still limited after the retries and StravaApiError when Strava could not be reached, the last 5xx response
+        is returned.
+        OAuth calls are not counted in the API quota and block logins and token refreshes: with `wait_for_quota`
+        False the quota is not waited for and a 429 is raised at once.
+        """
+        for attempt in range(self._max_retries + 1):
+            if wait_for_quota:
+                self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self._client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if attempt == self._max_retries:
+                    raise StravaApiError(f"{e!r} while requesting {method} {url}") from e
+                time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+                continue
+            self.rate_limiter.update(response.headers)
+            observe_strava_call(method, url, response.status_code, time.perf_counter() - start,
+                                self.rate_limiter.headroom)
+            if response.status_code == 429:
+                self.rate_limiter.exhaust()
+                if not wait_for_quota:
+                    break
+            elif response.status_code in RETRIED_STATUS_CODES and attempt < self._max_retries:
+                time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+            else:
+                return response
+        raise StravaRateLimitError(f"Strava rate limit exceeded for {method} {url}",
+                                   retry_after=self.rate_limiter.seconds_until_available())
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self._client.close()
+
+
+class AsyncStravaClient:
+    def __init__(self, client: httpx.AsyncClient, rate_limiter: StravaRateLimiter, max_retries: int = 2):
+        self._client = client
+        self.rate_limiter = rate_limiter
+        self._max_retries = max_retries
+
+    async def request(self, method: str, url: str, wait_for_quota: bool = True, **kwargs) -> httpx.Response:
+        """
+        See StravaClient.request
+        """
+        for attempt in range(self._max_retries + 1):
+            if wait_for_quota:
+                await self.rate_limiter.acquire_async()
+            start = time.perf_counter()
+            try:
+                response = await self._client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if attempt == self._max_retries:
+                    raise StravaApiError(f"{e!r} while requesting {method} {url}") from e
+                await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+                continue
+            self.rate_limiter.update(response.headers)
+            observe_strava_call(method, url, response.status_code, time.perf_counter() - start,
+                                self.rate_limiter.headroom)
+            if response.status_code == 429:
+                self.rate_limiter.exhaust()
+                if not wait_for_quota:
+                    break
+            elif response.status_code in RETRIED_STATUS_CODES and attempt < self._max_retries:
+                await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+            else:
+                return response
+        raise StravaRateLimitError(f"Strava rate limit exceeded for {method} {url}",
+                                   retry_after=self.rate_limiter.seconds_until_available())
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def _client_options() -> dict:
+    return {
+        'http2': HTTP2_AVAILABLE,
+        'timeout': httpx.Timeout(float(os.getenv('STRAVA_TIMEOUT', 10)), connect=5),
+        'limits': httpx.Limits(max_connections=int(os.getenv('STRAVA_MAX_CONNECTIONS', 20)),
+                               max_keepalive_connections=10),
+    }
+
+
+# The sync and async clients draw from the same quota
+_rate_limiter = StravaRateLimiter(reserve=int(os.getenv('STRAVA_RATE_LIMIT_RESERVE', 0)))
+_client: Optional[StravaClient] = None
+_async_client: Optional[AsyncStravaClient] = None
+_client_lock = threading.Lock()
+
+
+def get_strava_client() -> StravaClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = StravaClient(httpx.Client(**_client_options()), _rate_limiter)
+    return _client
+
+
+def get_async_strava_client() -> AsyncStravaClient:
+    """
+    Must be called from the event loop that will use the client
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncStravaClient(httpx.AsyncClient(**_client_options()), _rate_limiter)
+    return _async_client
+
+
+def close_strava_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+async def close_async_strava_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
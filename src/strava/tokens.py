@@ -0,0 +1,56 @@
+"""
+Per-process cache of Strava access tokens, so a token is read from the database once per lifetime instead of once
+per request
+"""
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Tokens are handed out until this many seconds before they expire, then refreshed
+REFRESH_MARGIN_SECONDS = int(os.getenv('STRAVA_TOKEN_REFRESH_MARGIN', 300))
+
+
+class TokenCache:
+    def __init__(self, refresh_margin: int = REFRESH_MARGIN_SECONDS):
+        self._refresh_margin = refresh_margin
+        self._tokens: Dict[int, Tuple[str, int]] = {}
+        self._locks: Dict[int, threading.Lock] = {}
+        self._async_locks: Dict[int, asyncio.Lock] = {}
+        self._lock = threading.Lock()
+
+    def is_fresh(self, expires_at: int) -> bool:
+        return expires_at - self._refresh_margin > time.time()
+
+    def get(self, athlete_id: int) -> Optional[str]:
+        cached = self._tokens.get(athlete_id)
+        if cached is None:
+            return None
+        access_token, expires_at = cached
+        if not self.is_fresh(expires_at):
+            self._tokens.pop(athlete_id, None)
+            return None
+        return access_token
+
+    def set(self, athlete_id: int, access_token: str, expires_at: int):
+        self._tokens[athlete_id] = (access_token, expires_at)
+
+    def invalidate(self, athlete_id: int):
+        self._tokens.pop(athlete_id, None)
+
+    def lock_for(self, athlete_id: int) -> threading.Lock:
+        """
+        Lock held while resolving the athlete's token, so concurrent callers trigger a single refresh.
+        """
+        with self._lock:
+            return self._locks.setdefault(athlete_id, threading.Lock())
+
+    def async_lock_for(self, athlete_id: int) -> asyncio.Lock:
+        """
+        Event loop counterpart of lock_for().
+        """
+        return self._async_locks.setdefault(athlete_id, asyncio.Lock())
+
+
+token_cache = TokenCache()
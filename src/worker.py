@@ -0,0 +1,90 @@
+"""
+Background worker process: runs the sync jobs, drains the webhook queue, fetches the details of the imported
+activities and updates the explored tiles, apart from the API processes.
+
+    python -m worker
+
+SYNC_WORKER_CONCURRENCY, WEBHOOK_WORKER_CONCURRENCY, ENRICH_WORKER_CONCURRENCY and EXPLORED_WORKER_CONCURRENCY set the
+number of threads draining each queue, the work is claimed with SKIP LOCKED so several worker processes can run side by side.
+On SIGTERM / SIGINT no new work is claimed, running imports stop after their current page and are put back in the
+queue.
+"""
+import os
+import signal
+import threading
+import time
+from typing import List
+
+from dotenv import load_dotenv
+from prometheus_client import start_http_server
+
+# Imported for their activities changed listeners, the worker writes activities too
+import services.bbox  # noqa: F401
+import services.cache  # noqa: F401
+from services.enrichment import enrich_worker_loop
+from services.heatmap import explored_worker_loop
+from services.importer import sync_worker_loop
+from services.webhooks import webhook_worker_loop
+from strava.client import close_strava_client
+
+load_dotenv()
+
+SYNC_WORKER_CONCURRENCY = int(os.getenv('SYNC_WORKER_CONCURRENCY', 2))
+WEBHOOK_WORKER_CONCURRENCY = int(os.getenv('WEBHOOK_WORKER_CONCURRENCY', 1))
+ENRICH_WORKER_CONCURRENCY = int(os.getenv('ENRICH_WORKER_CONCURRENCY', 1))
+EXPLORED_WORKER_CONCURRENCY = int(os.getenv('EXPLORED_WORKER_CONCURRENCY', 1))
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv('WORKER_SHUTDOWN_TIMEOUT', 60))
+# Serves the worker metrics when not aggregated by the API through PROMETHEUS_MULTIPROC_DIR, 0 disables it
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', 0))
+
+
+def start_worker_threads(stop: threading.Event, sync_concurrency: int, webhook_concurrency: int,
+                         enrich_concurrency: int, explored_concurrency: int) -> List[threading.Thread]:
+    threads = [threading.Thread(target=sync_worker_loop, args=(stop,), name=f"sync-worker-{index}", daemon=True)
+               for index in range(sync_concurrency)]
+    threads += [threading.Thread(target=webhook_worker_loop, args=(stop,), name=f"webhook-worker-{index}",
+                                 daemon=True)
+                for index in range(webhook_concurrency)]
+    threads += [threading.Thread(target=enrich_worker_loop, args=(stop,), name=f"enrich-worker-{index}", daemon=True)
+                for index in range(enrich_concurrency)]
+    threads += [threading.Thread(target=explored_worker_loop, args=(stop,), name=f"explored-worker-{index}",
+                                 daemon=True)
+                for index in range(explored_concurrency)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def main():
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"Received {signal.Signals(signum).name}, finishing the current work")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    if WORKER_METRICS_PORT:
+        start_http_server(WORKER_METRICS_PORT)
+    threads = start_worker_threads(stop, SYNC_WORKER_CONCURRENCY, WEBHOOK_WORKER_CONCURRENCY, ENRICH_WORKER_CONCURRENCY,
+                                   EXPLORED_WORKER_CONCURRENCY)
+    print(f"Worker started with {SYNC_WORKER_CONCURRENCY} sync, {WEBHOOK_WORKER_CONCURRENCY} webhook, "
+          f"{ENRICH_WORKER_CONCURRENCY} enrichment and {EXPLORED_WORKER_CONCURRENCY} explored tiles threads")
+
+    while not stop.wait(1):
+        pass
+
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+    for thread in threads:
+        thread.join(max(0., deadline - time.monotonic()))
+    # Jobs of threads still running are claimed again by another worker once stale
+    still_running = [thread.name for thread in threads if thread.is_alive()]
+    if still_running:
+        print(f"Shutdown timeout reached, abandoning {', '.join(still_running)}")
+    close_strava_client()
+    print("Worker stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Shared fixtures. The app modules are imported from src/ as the benchmarks do, the database tests run against a
+throwaway SQLite file.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+os.environ["SQLALCHEMY_URL"] = f"sqlite:///{tempfile.mkdtemp()}/tests.db"
+os.environ.setdefault("SESSION_KEY", "tests")
+
+from database.db import Base, SessionLocal, get_engine  # noqa: E402
+from migrate import migrate  # noqa: E402
+from models import events  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def database():
+    migrate()
+    return get_engine()
+
+
+@pytest.fixture
+def db(database):
+    session = SessionLocal()
+    yield session
+    session.close()
+    with database.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+
+
+@pytest.fixture(autouse=True)
+def notifications(monkeypatch):
+    """
+    (athlete_id, activity_ids) of the activities changed notifications sent during the test, the listeners of the
+    imported modules are not called
+    """
+    received = []
+    monkeypatch.setattr(events, "_listeners", [lambda athlete_id, activity_ids: received.append((athlete_id,
+                                                                                                 activity_ids))])
+    return received
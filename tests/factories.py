@@ -0,0 +1,75 @@
+"""
+Strava activities for the tests, built from the first activity of src/activities_sample.json
+"""
+import copy
+import json
+import os
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+from geo.polyline import encode_polyline, PRECISION
+from schemas.activities import SummaryActivity, DetailedActivity
+
+with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src",
+                       "activities_sample.json")) as sample_file:
+    SAMPLE_ACTIVITY = json.load(sample_file)[0]
+
+ATHLETE_ID = SAMPLE_ACTIVITY["athlete"]["id"]
+START_DATE = datetime(2023, 10, 7, 9)
+
+
+def loop(center=(45.0, 6.0), radius: float = 0.01, points: int = 50) -> np.ndarray:
+    """
+    Closed route around `center` (degrees), in polyline units
+    """
+    angles = np.linspace(0, 2 * np.pi, points)
+    latitudes = center[0] + radius * np.sin(angles)
+    longitudes = center[1] + radius * np.cos(angles)
+    return np.rint(np.stack([latitudes, longitudes], axis=1) * PRECISION).astype(np.int32)
+
+
+def _payload(activity_id: int, start_date: datetime, coordinates: Optional[np.ndarray], athlete_id: int,
+             **fields) -> dict:
+    payload = copy.deepcopy(SAMPLE_ACTIVITY)
+    payload.update(id=activity_id, athlete={"id": athlete_id}, start_date=start_date.isoformat() + "Z",
+                   start_date_local=start_date.isoformat() + "Z")
+    if coordinates is not None and len(coordinates):
+        start, end = (coordinates[[0, -1]] / PRECISION).tolist()
+        payload.update(start_latlng=start, end_latlng=end)
+    payload.update(fields)
+    return payload
+
+
+def summary_payload(activity_id: int, start_date: datetime = START_DATE, coordinates: Optional[np.ndarray] = None,
+                    athlete_id: int = ATHLETE_ID, **fields) -> dict:
+    """
+    JSON of an activity in the lists answered by Strava for GET /athlete/activities
+    """
+    payload = _payload(activity_id, start_date, coordinates, athlete_id, **fields)
+    payload["map"] = {"id": f"a{activity_id}", "summary_polyline": encode_polyline(coordinates)
+                      if coordinates is not None else ""}
+    return payload
+
+
+def summary_activity(activity_id: int, start_date: datetime = START_DATE, coordinates: Optional[np.ndarray] = None,
+                     athlete_id: int = ATHLETE_ID, **fields) -> SummaryActivity:
+    return SummaryActivity(**summary_payload(activity_id, start_date, coordinates, athlete_id, **fields))
+
+
+def detailed_payload(activity_id: int, start_date: datetime = START_DATE, coordinates: Optional[np.ndarray] = None,
+                     athlete_id: int = ATHLETE_ID, gear_id: str = "b1", **fields) -> dict:
+    """
+    JSON answered by Strava for GET /activities/{id}
+    """
+    payload = _payload(activity_id, start_date, coordinates, athlete_id, **fields)
+    payload["map"] = {"id": f"a{activity_id}", "polyline": encode_polyline(coordinates)
+                      if coordinates is not None else ""}
+    payload["gear"] = {"id": gear_id, "primary": True, "name": "Bike", "distance": 0}
+    return payload
+
+
+def detailed_activity(activity_id: int, start_date: datetime = START_DATE, coordinates: Optional[np.ndarray] = None,
+                      athlete_id: int = ATHLETE_ID, gear_id: str = "b1", **fields) -> DetailedActivity:
+    return DetailedActivity(**detailed_payload(activity_id, start_date, coordinates, athlete_id, gear_id, **fields))
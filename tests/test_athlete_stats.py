@@ -0,0 +1,84 @@
+from datetime import date, timedelta
+
+import pytest
+
+from models import crud
+from models.athlete_stats import AthleteStatsModel
+from factories import summary_activity, START_DATE
+
+# START_DATE is Saturday 2023-10-07
+WEEK, MONTH, YEAR = date(2023, 10, 2), date(2023, 10, 1), date(2023, 1, 1)
+
+
+def _stats(db):
+    db.expire_all()
+    return {(row.period, row.period_start, row.sport_type): (row.count, row.distance, row.moving_time,
+                                                              row.elevation_gain)
+            for row in db.query(AthleteStatsModel)}
+
+
+def test_upserts_add_to_every_period(db):
+    crud.upsert_activities(db, [summary_activity(1), summary_activity(2, start_date=START_DATE + timedelta(days=1)),
+                                summary_activity(3, sport_type="Run", distance=5000.)])
+
+    stats = _stats(db)
+
+    for period, period_start in (("week", WEEK), ("month", MONTH), ("year", YEAR)):
+        assert stats[(period, period_start, "Ride")] == (2, 20000., 7200, 20.)
+        assert stats[(period, period_start, "Run")] == (1, 5000., 3600, 10.)
+    # Sunday 8th is still in the week of Monday 2nd
+    assert len(stats) == 6
+
+
+def test_writing_the_same_activity_again_changes_nothing(db):
+    crud.upsert_activities(db, [summary_activity(1)])
+    before = _stats(db)
+
+    crud.upsert_activities(db, [summary_activity(1)])
+
+    assert _stats(db) == before
+
+
+def test_changed_activities_move_between_rollups(db):
+    crud.upsert_activities(db, [summary_activity(1), summary_activity(2)])
+
+    crud.upsert_activities(db, [summary_activity(2, start_date=START_DATE + timedelta(days=30), distance=15000.)])
+
+    stats = _stats(db)
+    assert stats[("month", MONTH, "Ride")] == (1, 10000., 3600, 10.)
+    assert stats[("month", date(2023, 11, 1), "Ride")] == (1, 15000., 3600, 10.)
+    assert stats[("year", YEAR, "Ride")] == (2, 25000., 7200, 20.)
+
+
+def test_webhook_updates_apply_their_delta(db):
+    crud.upsert_activities(db, [summary_activity(1), summary_activity(2)])
+
+    crud.update_activity_by_id(db, 2, {"sport_type": "Run", "title": "Renamed"})
+
+    stats = _stats(db)
+    assert stats[("week", WEEK, "Ride")] == (1, 10000., 3600, 10.)
+    assert stats[("week", WEEK, "Run")] == (1, 10000., 3600, 10.)
+
+
+def test_deleting_the_last_activity_drops_the_rollups(db):
+    crud.upsert_activities(db, [summary_activity(1), summary_activity(2, sport_type="Run")])
+
+    crud.delete_activity_by_id(db, 2)
+
+    assert {sport_type for _, _, sport_type in _stats(db)} == {"Ride"}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 500])
+def test_incremental_rollups_match_a_rebuild(db, chunk_size):
+    activities = [summary_activity(activity_id, start_date=START_DATE + timedelta(days=5 * activity_id),
+                                   sport_type="Run" if activity_id % 3 else "Ride", distance=1000. * activity_id)
+                  for activity_id in range(1, 40)]
+    crud.upsert_activities(db, activities, chunk_size=chunk_size)
+    crud.update_activity_by_id(db, 4, {"sport_type": "Hike"})
+    crud.delete_activity_by_id(db, 5)
+    incremental = _stats(db)
+
+    crud.rebuild_athlete_stats(db, activities[0].athlete.id)
+    db.commit()
+
+    assert _stats(db) == incremental
@@ -0,0 +1,109 @@
+import time
+from datetime import timedelta
+
+import httpx
+import pytest
+
+from models import crud
+from services import enrichment
+from strava import api
+from strava.client import StravaClient, StravaRateLimiter
+from strava.tokens import token_cache
+from factories import summary_activity, detailed_activity, detailed_payload, loop, ATHLETE_ID, START_DATE
+
+LEASE = timedelta(minutes=10)
+
+
+class FakeStrava:
+    """
+    GET /activities/{id}, answering the detailed activity unless listed in `statuses`
+    """
+
+    def __init__(self):
+        self.statuses = {}
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        activity_id = int(request.url.path.rsplit("/", 1)[-1])
+        self.requests.append(activity_id)
+        if activity_id in self.statuses:
+            return httpx.Response(self.statuses[activity_id], json={"message": "error"})
+        return httpx.Response(200, json=detailed_payload(activity_id, coordinates=loop(points=200),
+                                                         start_date=START_DATE + timedelta(days=activity_id)))
+
+
+@pytest.fixture
+def strava(monkeypatch):
+    fake = FakeStrava()
+    strava_client = StravaClient(httpx.Client(transport=httpx.MockTransport(fake)), StravaRateLimiter(),
+                                 max_retries=0)
+    monkeypatch.setattr(api, "get_strava_client", lambda: strava_client)
+    monkeypatch.setattr(enrichment, "get_strava_client", lambda: strava_client)
+    monkeypatch.setattr(enrichment, "ENRICH_RATE_LIMIT_RESERVE", 0)
+    token_cache.set(ATHLETE_ID, "token", int(time.time()) + 3600)
+    yield fake
+    token_cache.invalidate(ATHLETE_ID)
+
+
+@pytest.fixture
+def summaries(db):
+    crud.upsert_activities(db, [summary_activity(activity_id, start_date=START_DATE + timedelta(days=activity_id),
+                                                 coordinates=loop(points=20))
+                                for activity_id in (1, 2, 3)])
+
+
+def test_claimed_activities_are_not_handed_out_again_during_the_lease(db, summaries):
+    assert [activity.id for activity in crud.claim_summary_activities(db, batch_size=2, lease=LEASE)] == [3, 2]
+    assert [activity.id for activity in crud.claim_summary_activities(db, batch_size=2, lease=LEASE)] == [1]
+    assert crud.claim_summary_activities(db, batch_size=2, lease=LEASE) == []
+
+
+def test_activities_are_claimed_again_once_the_lease_ended(db, summaries):
+    crud.claim_summary_activities(db, batch_size=3, lease=timedelta(seconds=-1))
+
+    assert len(crud.claim_summary_activities(db, batch_size=3, lease=LEASE)) == 3
+
+
+def test_details_are_fetched_and_stored_once(db, summaries, strava):
+    assert enrichment.enrich_next_batch() == 3
+
+    db.expire_all()
+    assert all(crud.get_activity_by_id(db, activity_id).detailed_at is not None for activity_id in (1, 2, 3))
+    assert crud.get_activity_by_id(db, 1).gear_id == "b1"
+    assert enrichment.enrich_next_batch() == 0
+    assert sorted(strava.requests) == [1, 2, 3]
+
+
+def test_unreadable_activities_wait_for_the_retry_delay(db, summaries, strava):
+    strava.statuses = {2: 404, 3: 503}
+
+    enrichment.enrich_next_batch()
+
+    db.expire_all()
+    retry_at = crud.get_activity_by_id(db, 2).detail_retry_at
+    assert crud.get_activity_by_id(db, 2).detailed_at is None
+    assert retry_at > crud.get_activity_by_id(db, 3).detail_retry_at + timedelta(hours=1)
+
+
+def test_enrichment_keeps_the_rate_limit_reserve(db, summaries, strava, monkeypatch):
+    limiter = StravaRateLimiter(short_limit=52)
+    monkeypatch.setattr(api.get_strava_client(), "rate_limiter", limiter)
+    monkeypatch.setattr(enrichment, "ENRICH_RATE_LIMIT_RESERVE", 50)
+
+    assert enrichment.enrich_next_batch() == 2
+    assert limiter.headroom == 50
+    assert enrichment.enrich_next_batch() == 0
+    assert len(strava.requests) == 2
+
+
+def test_unchanged_details_are_not_written_again(db, notifications):
+    activity = detailed_activity(1, coordinates=loop(points=200))
+    crud.upsert_activities(db, [activity])
+    notifications.clear()
+
+    assert crud.save_activity_details(db, [activity], [], retry_at=START_DATE) == 1
+    assert notifications == []
+
+    crud.save_activity_details(db, [detailed_activity(1, coordinates=loop(points=200), gear_id="b2")], [],
+                               retry_at=START_DATE)
+    assert notifications == [(ATHLETE_ID, [1])]
@@ -0,0 +1,64 @@
+from models import crud
+from models.explored import ExploredTileModel, ExploredChangeModel
+from services import heatmap
+from factories import summary_activity, loop, ATHLETE_ID
+
+
+def _changes(db):
+    return {change.activity_id: change.version for change in db.query(ExploredChangeModel)}
+
+
+def test_writes_only_record_the_changed_activities(db):
+    crud.upsert_activities(db, [summary_activity(1, coordinates=loop()), summary_activity(2, coordinates=loop())])
+    crud.upsert_activities(db, [summary_activity(1, coordinates=loop())])
+    crud.update_activity_by_id(db, 2, {"title": "Renamed"})
+
+    assert _changes(db) == {1: 0, 2: 1}
+    assert db.query(ExploredTileModel).count() == 0
+
+
+def test_changes_are_recorded_in_the_transaction_of_the_write(db):
+    crud._upsert_activity_rows(db, [summary_activity(1, coordinates=loop())])
+    assert _changes(db) == {1: 0}
+
+    db.rollback()
+
+    assert _changes(db) == {} and crud.get_activity_by_id(db, 1) is None
+
+
+def test_worker_updates_the_tiles_in_one_batch(db):
+    crud.upsert_activities(db, [summary_activity(activity_id, coordinates=loop(radius=0.01 * activity_id))
+                                for activity_id in (1, 2)])
+
+    assert heatmap.update_next_explored_batch() == 2
+
+    db.expire_all()
+    assert _changes(db) == {}
+    assert db.query(ExploredTileModel).filter(ExploredTileModel.zoom == heatmap.EXPLORED_MAX_ZOOM).count() > 0
+    assert heatmap.update_next_explored_batch() == 0
+
+
+def test_deleted_activities_are_taken_out_of_the_tiles(db):
+    crud.upsert_activities(db, [summary_activity(1, coordinates=loop())])
+    heatmap.update_next_explored_batch()
+
+    crud.delete_activity_by_id(db, 1)
+    heatmap.update_next_explored_batch()
+
+    db.expire_all()
+    assert db.query(ExploredTileModel).count() == 0
+
+
+def test_changes_made_during_an_update_are_kept(db):
+    crud.mark_explored_changed(db, ATHLETE_ID, [1, 2])
+    db.commit()
+    athlete_id, changes = crud.claim_explored_changes(db, batch_size=10)
+    db.commit()
+
+    crud.mark_explored_changed(db, ATHLETE_ID, [2])
+    db.commit()
+    crud.delete_explored_changes(db, changes)
+    db.commit()
+
+    assert athlete_id == ATHLETE_ID
+    assert _changes(db) == {2: 1}
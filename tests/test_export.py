@@ -0,0 +1,122 @@
+import asyncio
+import gzip
+import zlib
+from datetime import timedelta
+from xml.etree import ElementTree
+
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import main
+from database.db import get_async_engine
+from models import crud
+from services import export
+from services.export import ExportFormat, export_activities
+from factories import summary_activity, loop, ATHLETE_ID, START_DATE
+
+GPX_NAMESPACE = {"gpx": "http://www.topografix.com/GPX/1/1"}
+
+
+@pytest.fixture
+def activities(db):
+    crud.upsert_activities(db, [summary_activity(1, start_date=START_DATE + timedelta(days=2), coordinates=loop()),
+                                summary_activity(2, start_date=START_DATE + timedelta(days=1),
+                                                 coordinates=loop(points=20)),
+                                summary_activity(3, start_date=START_DATE + timedelta(days=3))])
+
+
+def _export(export_format: ExportFormat, gzip: bool = False) -> list:
+    async def chunks():
+        chunks = [chunk async for chunk in export_activities(ATHLETE_ID, export_format, gzip=gzip)]
+        await get_async_engine().dispose()
+        return chunks
+    return asyncio.run(chunks())
+
+
+def test_ndjson_has_one_record_per_activity_oldest_first(activities):
+    chunks = _export(ExportFormat.ndjson)
+
+    records = [orjson.loads(chunk) for chunk in chunks]
+    assert [record["id"] for record in records] == [2, 1, 3]
+    assert [len(record["coordinates"]) for record in records] == [20, 50, 0]
+    assert "route" not in records[0]
+
+
+def test_gpx_has_one_track_per_activity(activities):
+    document = ElementTree.fromstring(b"".join(_export(ExportFormat.gpx)))
+
+    tracks = document.findall("gpx:trk", GPX_NAMESPACE)
+    assert [len(track.findall(".//gpx:trkpt", GPX_NAMESPACE)) for track in tracks] == [20, 50, 0]
+
+
+def test_geojson_is_one_feature_collection(activities):
+    collection = orjson.loads(b"".join(_export(ExportFormat.geojson)))
+
+    assert collection["type"] == "FeatureCollection"
+    assert [feature["id"] for feature in collection["features"]] == [2, 1, 3]
+    longitude, latitude = collection["features"][0]["geometry"]["coordinates"][0]
+    assert (latitude, longitude) == pytest.approx((45.0, 6.01), abs=1e-4)
+    assert collection["features"][2]["geometry"] is None
+
+
+@pytest.mark.parametrize("export_format", list(ExportFormat))
+def test_gzip_output_holds_the_same_archive(activities, export_format):
+    plain = b"".join(_export(export_format))
+
+    compressed = _export(export_format, gzip=True)
+
+    assert gzip.decompress(b"".join(compressed)) == plain
+    # The first chunk is flushed on its own, the client can start decompressing right away
+    assert zlib.decompressobj(wbits=31).decompress(compressed[0])
+
+
+def test_rows_are_encoded_as_they_are_read(activities):
+    async def stored_rows():
+        async with export.AsyncReadSessionLocal() as db:
+            rows = [row async for row in export.async_crud.stream_activities(db, ATHLETE_ID, export._COLUMNS, 10)]
+        await get_async_engine().dispose()
+        return rows
+    stored, read = asyncio.run(stored_rows()), []
+
+    async def rows():
+        for row in stored:
+            read.append(row.id)
+            yield row
+
+    async def first_chunk():
+        chunks = export._encode(rows(), ExportFormat.ndjson)
+        return await chunks.__anext__()
+
+    assert orjson.loads(asyncio.run(first_chunk()))["id"] == 2
+    assert read == [2]
+
+
+def test_rows_are_fetched_in_batches(activities, monkeypatch):
+    statements = []
+    stream = AsyncSession.stream
+
+    async def spy(self, statement, *args, **kwargs):
+        statements.append(statement)
+        return await stream(self, statement, *args, **kwargs)
+    monkeypatch.setattr(AsyncSession, "stream", spy)
+    monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 2)
+
+    assert len(_export(ExportFormat.ndjson)) == 3
+    assert statements[0].get_execution_options()["yield_per"] == 2
+
+
+def test_export_endpoint_streams_the_archive(activities, monkeypatch):
+    monkeypatch.setitem(main.app.dependency_overrides, main.check_user_session, lambda: ATHLETE_ID)
+    client = TestClient(main.app)
+
+    response = client.get("/export", params={"format": "gpx"})
+    compressed = client.get("/export", params={"format": "gpx", "gzip": "true"})
+    asyncio.run(get_async_engine().dispose())
+
+    assert response.headers["content-type"].startswith("application/gpx+xml")
+    assert response.headers["content-disposition"] == 'attachment; filename="activities.gpx"'
+    assert compressed.headers["content-type"] == "application/gzip"
+    assert compressed.headers["content-disposition"] == 'attachment; filename="activities.gpx.gz"'
+    assert gzip.decompress(compressed.content) == response.content
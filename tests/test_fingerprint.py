@@ -0,0 +1,102 @@
+import asyncio
+from datetime import timedelta
+
+import numpy as np
+import pytest
+
+from database.db import AsyncSessionLocal, get_async_engine
+from geo.fingerprint import SimilarityIndex, route_fingerprint, unpack_fingerprint, visited_cells, NUM_HASHES
+from models import crud
+from services import similarity
+from factories import summary_activity, loop, ATHLETE_ID, START_DATE
+
+ROUTE = loop()
+
+
+def _noisy(seed: int, coordinates: np.ndarray = ROUTE) -> np.ndarray:
+    """
+    The route recorded again, with a few meters of GPS noise
+    """
+    return coordinates + np.random.default_rng(seed).integers(-5, 6, coordinates.shape).astype(np.int32)
+
+
+def _similarity(first: np.ndarray, second: np.ndarray) -> float:
+    return float((unpack_fingerprint(route_fingerprint(first)) == unpack_fingerprint(route_fingerprint(second))).mean())
+
+
+def test_fingerprints_are_stable():
+    fingerprint = route_fingerprint(ROUTE)
+
+    assert len(fingerprint) == NUM_HASHES * 4
+    assert route_fingerprint(ROUTE.copy()) == fingerprint
+    assert route_fingerprint(np.empty((0, 2), dtype=np.int32)) is None
+
+
+@pytest.mark.parametrize("other", [ROUTE[:25], ROUTE[:40], loop(center=(45.005, 6.0))])
+def test_similarity_estimates_the_share_of_common_cells(other):
+    cells, other_cells = visited_cells(ROUTE), visited_cells(other)
+    jaccard = len(np.intersect1d(cells, other_cells)) / len(np.union1d(cells, other_cells))
+
+    assert _similarity(ROUTE, other) == pytest.approx(jaccard, abs=0.2)
+
+
+def test_gps_noise_keeps_routes_similar():
+    assert _similarity(ROUTE, _noisy(1)) >= 0.8
+    assert _similarity(ROUTE, loop(center=(45.02, 6.0))) == 0
+
+
+@pytest.fixture
+def index():
+    other = loop(center=(45.02, 6.0))
+    routes = {1: ROUTE, 2: _noisy(1), 3: _noisy(2), 4: other, 5: _noisy(3, other), 6: loop(center=(46.0, 7.0))}
+    return SimilarityIndex(routes, (unpack_fingerprint(route_fingerprint(route)) for route in routes.values()))
+
+
+def test_similar_routes_are_found_through_the_buckets(index):
+    similar = index.similar(1, threshold=0.6)
+
+    assert [activity_id for activity_id, _ in similar] in ([2, 3], [3, 2])
+    assert similar[0][1] >= similar[1][1] >= 0.6
+    assert index.similar(6, threshold=0.6) == []
+    assert index.similar(42, threshold=0.6) == []
+
+
+def test_clusters_group_near_identical_routes(index):
+    assert sorted(index.clusters(threshold=0.6)) == [[1, 2, 3], [4, 5], [6]]
+    assert len(index.clusters(threshold=1.01)) == len(index)
+
+
+def test_unique_routes_keep_the_most_recent_route_of_each_group(db, monkeypatch):
+    monkeypatch.setattr(similarity, "_indexes", {})
+    routes = [ROUTE, _noisy(1), loop(center=(45.02, 6.0)), _noisy(2)]
+    crud.upsert_activities(db, [summary_activity(activity_id, start_date=START_DATE + timedelta(days=activity_id),
+                                                 coordinates=route)
+                                for activity_id, route in enumerate(routes, start=1)])
+
+    async def unique_routes():
+        async with AsyncSessionLocal() as session:
+            routes = await similarity.get_unique_routes(ATHLETE_ID, session)
+        await get_async_engine().dispose()
+        return routes
+
+    assert [(route['id'], route['count']) for route in asyncio.run(unique_routes())] == [(3, 1), (4, 3)]
+
+
+def test_indexes_are_rebuilt_once_the_athlete_version_moved(db, monkeypatch):
+    monkeypatch.setattr(similarity, "_indexes", {})
+    crud.upsert_activities(db, [summary_activity(1, coordinates=ROUTE)])
+
+    async def unique_routes():
+        async with AsyncSessionLocal() as session:
+            routes = await similarity.get_unique_routes(ATHLETE_ID, session)
+        await get_async_engine().dispose()
+        return [(route['id'], route['count']) for route in routes]
+
+    assert asyncio.run(unique_routes()) == [(1, 1)]
+    crud.upsert_activities(db, [summary_activity(2, start_date=START_DATE + timedelta(days=1), coordinates=_noisy(1))])
+    assert asyncio.run(unique_routes()) == [(1, 1)]
+
+    # Bumped by the writing process in the shared cache backend, this process was not notified
+    similarity.response_cache.invalidate(ATHLETE_ID, [2])
+
+    assert asyncio.run(unique_routes()) == [(2, 2)]
@@ -0,0 +1,186 @@
+import time
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from models import crud
+from models.activities import ActivityModel
+from services import importer
+from strava import api, client
+from strava.api import StravaApi
+from strava.client import StravaClient, StravaRateLimiter
+from strava.tokens import token_cache
+from factories import summary_payload, ATHLETE_ID, START_DATE
+
+# Oldest first, as Strava answers with `after`
+ACTIVITIES = [summary_payload(activity_id, start_date=START_DATE + timedelta(days=activity_id))
+              for activity_id in range(1, 6)]
+
+
+def _epoch(activity: dict) -> int:
+    return int(datetime.fromisoformat(activity["start_date"].rstrip("Z")).timestamp())
+
+
+class FakeStrava:
+    """
+    GET /athlete/activities over ACTIVITIES, answering `failures` (page: status) instead of the pages listed there
+    """
+
+    def __init__(self, per_page: int):
+        self.per_page = per_page
+        self.failures = {}
+        self.requests = []
+        self.delay = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        page, after = int(request.url.params["page"]), int(request.url.params.get("after", 0))
+        self.requests.append((page, after))
+        time.sleep(self.delay)
+        if page in self.failures:
+            status = self.failures.pop(page)
+            if status is None:
+                raise httpx.ConnectError("connection refused", request=request)
+            return httpx.Response(status, json={"message": "error"})
+        newer = [activity for activity in ACTIVITIES if _epoch(activity) > after]
+        return httpx.Response(200, json=newer[(page - 1) * self.per_page:page * self.per_page])
+
+
+@pytest.fixture
+def strava(monkeypatch):
+    fake = FakeStrava(per_page=2)
+    strava_client = StravaClient(httpx.Client(transport=httpx.MockTransport(fake)), StravaRateLimiter(),
+                                 max_retries=0)
+    monkeypatch.setattr(api, "get_strava_client", lambda: strava_client)
+    monkeypatch.setattr(api, "ACTIVITIES_PER_PAGE", fake.per_page)
+    monkeypatch.setattr(client, "RETRY_BACKOFF_SECONDS", 0)
+    token_cache.set(ATHLETE_ID, "token", int(time.time()) + 3600)
+    yield fake
+    token_cache.invalidate(ATHLETE_ID)
+
+
+def _job(db):
+    db.expire_all()
+    return crud.get_sync_job_by_athlete_id(db, ATHLETE_ID)
+
+
+def _stored_ids(db):
+    return sorted(activity_id for activity_id, in db.query(ActivityModel.id))
+
+
+def test_a_pending_job_is_claimed_once(db):
+    crud.enqueue_sync_job(db, ATHLETE_ID)
+
+    job = crud.claim_sync_job(db, stale_after=timedelta(minutes=5))
+
+    assert job.status == "running" and job.lease_token
+    assert crud.claim_sync_job(db, stale_after=timedelta(minutes=5)) is None
+
+
+def test_each_page_is_checkpointed(db, strava, monkeypatch):
+    checkpoints = []
+    import_activity_page = crud.import_activity_page
+
+    def checkpoint(db, job, lease, page, activities):
+        import_activity_page(db=db, job=job, lease=lease, page=page, activities=activities)
+        checkpoints.append((_job(db).last_page, _job(db).last_start_date, len(_stored_ids(db))))
+    monkeypatch.setattr(crud, "import_activity_page", checkpoint)
+    crud.enqueue_sync_job(db, ATHLETE_ID)
+
+    assert importer.run_next_sync_job()
+
+    assert checkpoints == [(1, _epoch(ACTIVITIES[1]), 2), (2, _epoch(ACTIVITIES[3]), 4), (3, _epoch(ACTIVITIES[4]), 5)]
+    job = _job(db)
+    assert job.status == "done" and job.activities == 5 and job.lease_token is None
+
+
+def test_crashed_job_resumes_from_its_checkpoint(db, strava):
+    crud.enqueue_sync_job(db, ATHLETE_ID)
+    job = crud.claim_sync_job(db, stale_after=timedelta(minutes=5))
+    first_page = next(StravaApi(db=db, athlete_id=ATHLETE_ID).iter_activity_pages(concurrency=1))[1]
+    crud.import_activity_page(db, job, job.lease_token, page=1, activities=first_page)
+    # The worker dies here, the job stays running until it is stale
+    strava.requests.clear()
+
+    assert not importer.run_next_sync_job()
+    job = crud.claim_sync_job(db, stale_after=timedelta(seconds=-1))
+    assert importer.import_activities(db, job, job.lease_token, concurrency=1)
+
+    assert strava.requests[0] == (1, _epoch(ACTIVITIES[1]))
+    assert _stored_ids(db) == [1, 2, 3, 4, 5]
+
+
+def test_transient_errors_put_the_job_back_with_a_backoff(db, strava):
+    strava.failures = {2: None}
+    crud.enqueue_sync_job(db, ATHLETE_ID)
+
+    importer.run_next_sync_job()
+
+    job = _job(db)
+    assert job.status == "pending" and job.attempts == 1 and job.available_at > datetime.utcnow()
+    assert job.last_start_date == _epoch(ACTIVITIES[1]) and "ConnectError" in job.error
+    assert not importer.run_next_sync_job()
+
+    job.available_at = datetime.utcnow() - timedelta(seconds=1)
+    db.commit()
+    assert importer.run_next_sync_job()
+
+    job = _job(db)
+    assert job.status == "done" and job.attempts == 0 and job.error is None
+    assert _stored_ids(db) == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize("status, retried", [(401, False), (503, True), (429, True)])
+def test_only_refusals_fail_the_job(db, strava, status, retried):
+    strava.failures = {1: status}
+    crud.enqueue_sync_job(db, ATHLETE_ID)
+
+    importer.run_next_sync_job()
+
+    assert _job(db).status == ("pending" if retried else "failed")
+
+
+def test_jobs_fail_after_the_last_attempt(db, strava, monkeypatch):
+    monkeypatch.setattr(importer, "SYNC_MAX_ATTEMPTS", 1)
+    strava.failures = {1: 503}
+    crud.enqueue_sync_job(db, ATHLETE_ID)
+
+    importer.run_next_sync_job()
+
+    assert _job(db).status == "failed"
+
+
+def test_stale_jobs_are_taken_over_and_the_first_worker_stops(db, strava):
+    crud.enqueue_sync_job(db, ATHLETE_ID)
+    first = crud.claim_sync_job(db, stale_after=timedelta(minutes=5))
+    first_lease = first.lease_token
+
+    second = crud.claim_sync_job(db, stale_after=timedelta(seconds=-1))
+
+    assert second.lease_token != first_lease
+    with pytest.raises(crud.SyncJobLeaseLost):
+        crud.import_activity_page(db, first, first_lease, page=1, activities=[])
+    with pytest.raises(crud.SyncJobLeaseLost):
+        crud.heartbeat_sync_job(db, first, first_lease)
+    with pytest.raises(crud.SyncJobLeaseLost):
+        crud.finish_sync_job(db, first, first_lease)
+    assert importer.import_activities(db, second, second.lease_token, concurrency=1)
+    crud.finish_sync_job(db, second, second.lease_token)
+    assert _job(db).status == "done" and _stored_ids(db) == [1, 2, 3, 4, 5]
+
+
+def test_jobs_are_heartbeaten_while_waiting_for_strava(db, strava, monkeypatch):
+    monkeypatch.setattr(importer, "SYNC_HEARTBEAT_INTERVAL", 0.05)
+    strava.delay = 0.2
+    crud.enqueue_sync_job(db, ATHLETE_ID)
+    job = crud.claim_sync_job(db, stale_after=timedelta(minutes=5))
+    claimed_at, lease = job.updated_at, job.lease_token
+    heartbeats = []
+    heartbeat_sync_job = crud.heartbeat_sync_job
+    monkeypatch.setattr(crud, "heartbeat_sync_job",
+                        lambda db, job, lease: heartbeats.append(lease) or heartbeat_sync_job(db, job, lease))
+
+    assert importer.import_activities(db, job, lease, concurrency=1)
+
+    assert heartbeats and set(heartbeats) == {lease}
+    assert _job(db).updated_at > claimed_at
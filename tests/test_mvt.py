@@ -0,0 +1,143 @@
+import asyncio
+from datetime import timedelta
+
+import numpy as np
+
+from database.db import AsyncSessionLocal, get_async_engine
+from geo import mvt
+from geo.polyline import PRECISION
+from geo.tiles import clip_lines, to_global_pixels, TILE_SIZE
+from models import crud
+from services import bbox
+from services.vector_tiles import build_routes_tile
+from factories import summary_activity, loop, ATHLETE_ID, START_DATE
+
+
+def _fields(message: bytes) -> list:
+    """
+    (field number, value) of a protobuf message, varints as int and the other wire types as bytes
+    """
+    fields, position = [], 0
+
+    def varint():
+        nonlocal position
+        value, shift = 0, 0
+        while True:
+            byte = message[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+    while position < len(message):
+        key = varint()
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            fields.append((number, varint()))
+        elif wire_type == 1:
+            fields.append((number, message[position:position + 8]))
+            position += 8
+        else:
+            length = varint()
+            fields.append((number, message[position:position + length]))
+            position += length
+    return fields
+
+
+def _varint_list(payload: bytes) -> list:
+    """
+    Values of a packed repeated varint field
+    """
+    values, value, shift = [], 0, 0
+    for byte in payload:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            values.append(value)
+            value, shift = 0, 0
+    return values
+
+
+def test_varints_match_the_scalar_encoding():
+    values = np.array([0, 1, 127, 128, 300, 2 ** 14, 2 ** 21 - 1, 2 ** 35, 2 ** 63, 2 ** 64 - 1] * 2, dtype=np.uint64)
+
+    assert mvt._varints(values) == b"".join(mvt._varint(int(value)) for value in values)
+
+
+def test_line_geometry_of_the_specification_example():
+    parts = [np.array([[2, 2], [2, 10], [10, 10]]), np.array([[1, 1], [3, 5]])]
+
+    # MoveTo(2, 2) LineTo(0, 8) (8, 0), then MoveTo(-9, -9) LineTo(2, 4) from the end of the first part
+    assert mvt.line_geometry(parts).tolist() == [9, 4, 4, 18, 0, 16, 16, 0, 9, 17, 17, 10, 4, 8]
+
+
+def test_layer_keeps_the_features_and_shares_keys_and_values():
+    features = [(1, [np.array([[0, 0], [10, 0]])], {"sport_type": "Ride", "date": "2023-10-07"}),
+                (2, [np.array([[0, 0], [0, 10]])], {"sport_type": "Ride", "distance": 1.5, "private": True})]
+
+    layer, = [value for number, value in _fields(mvt.encode_tile([mvt.encode_layer("routes", features)]))
+              if number == 3]
+    fields = _fields(layer)
+
+    assert (15, 2) in fields and (1, b"routes") in fields and (5, mvt.EXTENT) in fields
+    assert [value for number, value in fields if number == 3] == [b"sport_type", b"date", b"distance", b"private"]
+    values = [_fields(value)[0] for number, value in fields if number == 4]
+    assert values == [(1, b"Ride"), (1, b"2023-10-07"), (3, np.array([1.5], dtype="<f8").tobytes()), (7, 1)]
+    encoded_features = [dict(_fields(value)) for number, value in fields if number == 2]
+    assert [feature[1] for feature in encoded_features] == [1, 2]
+    assert [_varint_list(feature[2]) for feature in encoded_features] == [[0, 0, 1, 1], [0, 0, 2, 2, 3, 3]]
+    assert _varint_list(encoded_features[1][4]) == [9, 0, 0, 10, 0, 20]
+
+
+def test_clipping_cuts_segments_on_the_border():
+    points = np.array([[-10., 5.], [5., 5.], [5., 20.], [8., 20.], [8., 5.], [20., 5.]])
+
+    parts = clip_lines(points, 0, 10)
+
+    assert [part.tolist() for part in parts] == [[[0., 5.], [5., 5.], [5., 10.]], [[8., 10.], [8., 5.], [10., 5.]]]
+
+
+def test_clipping_drops_lines_outside():
+    assert clip_lines(np.array([[-10., -10.], [-5., 20.], [20., 20.]]), 0, 10) == []
+    assert clip_lines(np.array([[5., 5.]]), 0, 10) == []
+
+
+def test_tile_draws_the_most_recent_routes(db, monkeypatch):
+    monkeypatch.setattr(bbox, "_indexes", {})
+    crud.upsert_activities(db, [summary_activity(activity_id, start_date=START_DATE + timedelta(days=activity_id),
+                                                 coordinates=loop(radius=0.001 * activity_id))
+                                for activity_id in (1, 2, 3)])
+    zoom = 12
+    x, y = (to_global_pixels(np.array([[45 * PRECISION, 6 * PRECISION]]), zoom)[0] // TILE_SIZE).astype(int)
+
+    async def tiles():
+        async with AsyncSessionLocal() as session:
+            tile = await build_routes_tile(ATHLETE_ID, session, zoom, x, y, max_features=2)
+            empty = await build_routes_tile(ATHLETE_ID, session, zoom, x + 2, y)
+        await get_async_engine().dispose()
+        return tile, empty
+    tile, empty = asyncio.run(tiles())
+
+    layer, = [value for number, value in _fields(tile) if number == 3]
+    assert [dict(_fields(value))[1] for number, value in _fields(layer) if number == 2] == [2, 3]
+    assert empty == b""
+
+
+def test_bounding_box_indexes_are_rebuilt_once_the_athlete_version_moved(db, monkeypatch):
+    monkeypatch.setattr(bbox, "_indexes", {})
+    crud.upsert_activities(db, [summary_activity(1, coordinates=loop())])
+
+    async def routes():
+        async with AsyncSessionLocal() as session:
+            rows = await bbox.find_routes_in_bounding_box(ATHLETE_ID, session, (44.9, 5.9, 45.1, 6.1), limit=None)
+        await get_async_engine().dispose()
+        return [row.id for row in rows]
+
+    assert asyncio.run(routes()) == [1]
+    crud.upsert_activities(db, [summary_activity(2, start_date=START_DATE + timedelta(days=1), coordinates=loop())])
+    assert asyncio.run(routes()) == [1]
+
+    # Bumped by the writing process in the shared cache backend, this process was not notified
+    bbox.response_cache.invalidate(ATHLETE_ID, [2])
+
+    assert asyncio.run(routes()) == [2, 1]
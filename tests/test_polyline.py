@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from geo.polyline import decode_polyline, encode_polyline, pack_coordinates, unpack_coordinates, to_degrees
+from factories import loop
+
+# Example of the polyline algorithm documentation
+GOOGLE_EXAMPLE = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+GOOGLE_EXAMPLE_DEGREES = [[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]]
+
+
+def test_decode_the_reference_example():
+    assert np.allclose(to_degrees(decode_polyline(GOOGLE_EXAMPLE)), GOOGLE_EXAMPLE_DEGREES)
+
+
+def test_encode_the_reference_example():
+    coordinates = np.rint(np.array(GOOGLE_EXAMPLE_DEGREES) * 1e5).astype(np.int32)
+
+    assert encode_polyline(coordinates) == GOOGLE_EXAMPLE
+
+
+@pytest.mark.parametrize("coordinates", [
+    loop(),
+    np.array([[0, 0]], dtype=np.int32),
+    # Extreme values and large jumps need every chunk of a value
+    np.array([[9000000, 18000000], [-9000000, -18000000], [1, -1], [0, 0]], dtype=np.int32),
+])
+def test_round_trips_are_lossless(coordinates):
+    assert np.array_equal(decode_polyline(encode_polyline(coordinates)), coordinates)
+    assert np.array_equal(unpack_coordinates(pack_coordinates(coordinates)), coordinates)
+
+
+def test_empty_routes():
+    assert encode_polyline(np.empty((0, 2), dtype=np.int32)) == ""
+    assert decode_polyline("").shape == (0, 2)
+    assert unpack_coordinates(b"").shape == (0, 2)
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from starlette.requests import Request
+
+from services.cache import LocalCacheBackend, ResponseCache
+from factories import ATHLETE_ID
+
+
+def _request(path: str = "/routes/", headers: dict = None) -> Request:
+    return Request({"type": "http", "method": "GET", "path": path, "query_string": b"",
+                    "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]})
+
+
+def _respond(cache: ResponseCache, request: Request, builds: list):
+    async def build():
+        builds.append(request.url.path)
+        return [{"id": len(builds)}]
+
+    async def respond():
+        return await cache.respond(request, await cache.athlete_key(ATHLETE_ID, request), build)
+    return asyncio.run(respond())
+
+
+def test_responses_are_built_once_per_version():
+    cache, builds = ResponseCache(LocalCacheBackend()), []
+
+    first = _respond(cache, _request(), builds)
+    again = _respond(cache, _request(), builds)
+    cache.invalidate(ATHLETE_ID, [1])
+    changed = _respond(cache, _request(), builds)
+
+    assert len(builds) == 2
+    assert first.body == again.body != changed.body
+
+
+def test_known_etag_is_not_modified():
+    cache, builds = ResponseCache(LocalCacheBackend()), []
+    etag = _respond(cache, _request(), builds).headers["etag"]
+
+    response = _respond(cache, _request(headers={"If-None-Match": etag}), builds)
+
+    assert response.status_code == 304 and response.body == b""
+
+
+def test_changes_are_recent_for_the_replica_lag_window():
+    cache = ResponseCache(LocalCacheBackend(replica_lag_window=0.05))
+    assert not asyncio.run(cache.athlete_changed_recently(ATHLETE_ID))
+
+    cache.invalidate(ATHLETE_ID, [1])
+
+    assert asyncio.run(cache.athlete_changed_recently(ATHLETE_ID))
+    assert not asyncio.run(cache.athlete_changed_recently(ATHLETE_ID + 1))
+    time.sleep(0.1)
+    assert not asyncio.run(cache.athlete_changed_recently(ATHLETE_ID))
+
+
+def test_no_window_without_replica_lag():
+    cache = ResponseCache(LocalCacheBackend(replica_lag_window=0))
+
+    cache.invalidate(ATHLETE_ID, [1])
+
+    assert not asyncio.run(cache.athlete_changed_recently(ATHLETE_ID))
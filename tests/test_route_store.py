@@ -0,0 +1,134 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from database.db import AsyncSessionLocal, get_async_engine
+from models import async_crud, crud
+from services.cache import LocalCacheBackend, ResponseCache
+from services.route_store import RouteStore
+from factories import summary_activity, loop, ATHLETE_ID, START_DATE
+
+OTHER_ATHLETE_ID = ATHLETE_ID + 1
+# Around the loops centered on (45, 6), not the ones centered on (46, 7)
+BOUNDING_BOX = (44.9, 5.9, 45.1, 6.1)
+
+
+def _activity(activity_id: int, center=(45.0, 6.0), **fields):
+    return summary_activity(activity_id, start_date=START_DATE + timedelta(days=activity_id),
+                            coordinates=loop(center=center), **fields)
+
+
+def _get(store: RouteStore, athlete_id: int = ATHLETE_ID):
+    async def get():
+        async with AsyncSessionLocal() as session:
+            entry = await store.get(session, athlete_id)
+        await get_async_engine().dispose()
+        return entry
+    return asyncio.run(get())
+
+
+def _changed(store: RouteStore, activity_ids):
+    """
+    What the activities changed hook does in the writing process
+    """
+    store._versions.invalidate(ATHLETE_ID, activity_ids)
+    store.invalidate(ATHLETE_ID, activity_ids)
+
+
+@pytest.fixture
+def store(db):
+    crud.upsert_activities(db, [_activity(1), _activity(2, center=(46.0, 7.0)), _activity(3),
+                                summary_activity(4, start_date=START_DATE + timedelta(days=4))])
+    return RouteStore(max_bytes=2 ** 30, ttl=600, versions=ResponseCache(LocalCacheBackend()))
+
+
+def test_bounding_box_queries_are_answered_newest_first(store):
+    entry = _get(store)
+
+    assert [route.id for route in entry.routes] == [1, 2, 3, 4]
+    assert [route.id for route in entry.in_bounding_box(BOUNDING_BOX, limit=None)] == [3, 1]
+    assert [route.id for route in entry.in_bounding_box(BOUNDING_BOX, limit=1)] == [3]
+    assert entry.in_bounding_box((0, 0, 1, 1), limit=None) == []
+
+
+def test_reads_are_served_from_memory(store, monkeypatch):
+    entry = _get(store)
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("read from the database")
+    monkeypatch.setattr(async_crud, "get_athlete_routes", fail)
+
+    assert _get(store) is entry
+
+
+def test_changed_activities_are_reloaded_on_the_next_read(db, store):
+    entry = _get(store)
+    crud.upsert_activities(db, [_activity(2), _activity(5, center=(46.0, 7.0))])
+    crud.delete_activity_by_id(db, 3)
+
+    _changed(store, [2, 3, 5])
+    refreshed = _get(store)
+
+    assert refreshed is not entry and refreshed.loaded_at == entry.loaded_at
+    assert [route.id for route in refreshed.routes] == [1, 2, 4, 5]
+    assert [route.id for route in refreshed.in_bounding_box(BOUNDING_BOX, limit=None)] == [2, 1]
+    assert _get(store) is refreshed
+
+
+def test_whole_history_changes_reload_the_athlete(store):
+    entry = _get(store)
+
+    _changed(store, [])
+
+    reloaded = _get(store)
+    assert reloaded is not entry and reloaded.loaded_at > entry.loaded_at
+
+
+def test_changes_made_by_other_processes_reload_the_athlete(db, store):
+    entry = _get(store)
+    crud.upsert_activities(db, [_activity(5)])
+
+    # Only the version in the shared cache backend moved, this process was not notified
+    store._versions.invalidate(ATHLETE_ID, [5])
+
+    reloaded = _get(store)
+    assert reloaded.loaded_at > entry.loaded_at and [route.id for route in reloaded.routes] == [1, 2, 3, 4, 5]
+    assert _get(store) is reloaded
+
+
+def test_changes_notified_during_a_load_are_kept(db, store, monkeypatch):
+    get_athlete_routes = async_crud.get_athlete_routes
+
+    async def concurrent_change(db, athlete_id, activity_ids=None):
+        rows = await get_athlete_routes(db, athlete_id, activity_ids)
+        _changed(store, [1])
+        return rows
+    monkeypatch.setattr(async_crud, "get_athlete_routes", concurrent_change)
+
+    entry = _get(store)
+    assert entry.stale_ids == {1}
+    monkeypatch.setattr(async_crud, "get_athlete_routes", get_athlete_routes)
+    assert _get(store).loaded_at == entry.loaded_at
+
+
+def test_entries_expire_after_the_ttl(db):
+    crud.upsert_activities(db, [_activity(1)])
+    store = RouteStore(max_bytes=2 ** 30, ttl=-1)
+
+    entry = _get(store)
+
+    assert _get(store) is not entry
+
+
+def test_least_recently_used_athletes_are_evicted(db):
+    crud.upsert_activities(db, [_activity(1), _activity(2, athlete_id=OTHER_ATHLETE_ID)])
+    size = _get(RouteStore(max_bytes=2 ** 30, ttl=600)).size
+    store = RouteStore(max_bytes=size * 1.5, ttl=600)
+
+    first = _get(store)
+    other = _get(store, OTHER_ATHLETE_ID)
+
+    assert len(store) == 1 and store.memory_usage <= size * 1.5
+    assert _get(store, OTHER_ATHLETE_ID) is other
+    assert _get(store) is not first
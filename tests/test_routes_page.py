@@ -0,0 +1,53 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from database.db import AsyncSessionLocal, get_async_engine
+from models import async_crud, crud
+from services.route_store import AthleteRoutes
+from factories import summary_activity, loop, ATHLETE_ID, START_DATE
+
+# Ids 1 to 5, 2 to 4 started at the same time
+DATES = {1: START_DATE, 2: START_DATE + timedelta(hours=1), 3: START_DATE + timedelta(hours=1),
+         4: START_DATE + timedelta(hours=1), 5: START_DATE + timedelta(hours=2)}
+
+
+@pytest.fixture
+def activities(db):
+    crud.upsert_activities(db, [summary_activity(activity_id, start_date=start_date, coordinates=loop())
+                                for activity_id, start_date in DATES.items()])
+
+
+async def _database_pages(limit: int, **cursor):
+    pages = []
+    async with AsyncSessionLocal() as session:
+        while True:
+            page = await async_crud.get_routes_page(session, ATHLETE_ID, limit=limit, **cursor)
+            if not page:
+                break
+            pages.append([row.id for row in page])
+            cursor = {'before': page[-1].start_date_local, 'before_id': page[-1].id}
+    await get_async_engine().dispose()
+    return pages
+
+
+async def _store_pages(limit: int, **cursor):
+    async with AsyncSessionLocal() as session:
+        routes = AthleteRoutes.from_rows(await async_crud.get_athlete_routes(session, ATHLETE_ID))
+    await get_async_engine().dispose()
+    pages = []
+    while page := routes.page(limit, **cursor):
+        pages.append([route.id for route in page])
+        cursor = {'before': page[-1].start_date_local, 'before_id': page[-1].id}
+    return pages
+
+
+@pytest.mark.parametrize("pages", [_database_pages, _store_pages])
+def test_pages_do_not_skip_routes_started_at_the_same_time(activities, pages):
+    assert asyncio.run(pages(limit=2)) == [[5, 4], [3, 2], [1]]
+
+
+@pytest.mark.parametrize("pages", [_database_pages, _store_pages])
+def test_date_only_cursor_starts_before_the_date(activities, pages):
+    assert asyncio.run(pages(limit=10, before=DATES[2])) == [[1]]
@@ -0,0 +1,45 @@
+import numpy as np
+
+from geo.simplify import simplify, tolerance_for_zoom
+from factories import loop
+
+
+def _distance_to_segment(point: np.ndarray, start: np.ndarray, end: np.ndarray) -> float:
+    segment = end - start
+    position = np.clip(np.dot(point - start, segment) / max(np.dot(segment, segment), 1e-12), 0, 1)
+    return float(np.hypot(*(point - start - position * segment)))
+
+
+def test_tolerance_halves_with_each_zoom_level():
+    assert tolerance_for_zoom(10) == 2 * tolerance_for_zoom(11)
+    # Half a pixel at zoom 0 is half of 360 / 256 degrees
+    assert tolerance_for_zoom(0) == 0.5 * 360 / 256 * 1e5
+
+
+def test_straight_lines_keep_their_ends():
+    line = np.stack([np.arange(100), 2 * np.arange(100)], axis=1).astype(np.int32)
+
+    assert simplify(line, tolerance=1).tolist() == [[0, 0], [99, 198]]
+
+
+def test_simplified_route_stays_within_the_tolerance():
+    route = loop(points=500, radius=0.05)
+    rng = np.random.default_rng(0)
+    route = route + rng.integers(-20, 20, size=route.shape).astype(np.int32)
+    tolerance = tolerance_for_zoom(10)
+
+    simplified = simplify(route, tolerance)
+
+    assert 2 < len(simplified) < len(route) / 2
+    kept = np.flatnonzero((route[:, None] == simplified[None]).all(axis=2).any(axis=1))
+    for start, end in zip(kept[:-1], kept[1:]):
+        for point in route[start + 1:end]:
+            assert _distance_to_segment(point.astype(float), route[start].astype(float),
+                                        route[end].astype(float)) <= tolerance
+
+
+def test_short_routes_and_zero_tolerance_are_unchanged():
+    route = loop(points=30)
+
+    assert np.array_equal(simplify(route[:2], tolerance=100), route[:2])
+    assert np.array_equal(simplify(route, tolerance=0), route)
@@ -0,0 +1,215 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from strava import api, client
+from strava.api import StravaApi
+from strava.client import (StravaApiError, StravaClient, AsyncStravaClient, StravaRateLimiter, StravaRateLimitError,
+                           SHORT_WINDOW_SECONDS)
+from strava.tokens import token_cache
+from factories import detailed_payload, ATHLETE_ID
+
+QUOTA_HEADERS = {"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "10,50"}
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Time of the rate limiter, moved forward by the asyncio.sleep of the async client instead of waiting. The sync
+    client does not wait between retries.
+    """
+    clock = Clock(1_000 * SHORT_WINDOW_SECONDS + 60)
+    monkeypatch.setattr(client, "time", SimpleNamespace(time=clock.time, perf_counter=time.perf_counter,
+                                                             sleep=lambda seconds: None))
+    monkeypatch.setattr(client, "asyncio", SimpleNamespace(sleep=clock.sleep))
+    monkeypatch.setattr(client, "RETRY_BACKOFF_SECONDS", 0)
+    return clock
+
+
+def _transport(*statuses: int, json=None) -> httpx.MockTransport:
+    """
+    Answers the statuses in turn, then 200
+    """
+    answers = list(statuses)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        status = answers.pop(0) if answers else 200
+        return httpx.Response(status, json=json if status == 200 else {"message": "error"}, headers=QUOTA_HEADERS)
+    return httpx.MockTransport(handler)
+
+
+def test_limiter_counts_the_requests(clock):
+    limiter = StravaRateLimiter(short_limit=10, daily_limit=100)
+
+    for _ in range(3):
+        limiter.acquire()
+
+    assert limiter.headroom == 7
+
+
+def test_limiter_follows_the_usage_reported_by_strava(clock):
+    limiter = StravaRateLimiter(short_limit=200, daily_limit=2000)
+    limiter.acquire()
+
+    limiter.update(QUOTA_HEADERS)
+
+    assert limiter.headroom == 90
+    limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "5,50"})
+    assert limiter.headroom == 90
+
+
+def test_limiter_ignores_malformed_headers(clock):
+    limiter = StravaRateLimiter(short_limit=10, daily_limit=100)
+
+    limiter.update({"X-RateLimit-Limit": "100", "X-RateLimit-Usage": "a,b"})
+
+    assert limiter.headroom == 10
+
+
+def test_limiter_window_resets_on_the_quarter_hour(clock):
+    limiter = StravaRateLimiter(short_limit=10, daily_limit=100)
+    limiter.exhaust()
+    assert limiter.headroom == 0
+
+    clock.now += SHORT_WINDOW_SECONDS
+
+    assert limiter.headroom == 10
+
+
+def test_limiter_waits_for_the_next_window_keeping_the_reserve(clock, caplog):
+    limiter = StravaRateLimiter(short_limit=3, daily_limit=100, reserve=1)
+    start = clock.now
+
+    for _ in range(3):
+        asyncio.run(limiter.acquire_async())
+
+    assert clock.now >= (start // SHORT_WINDOW_SECONDS + 1) * SHORT_WINDOW_SECONDS
+    assert limiter.headroom == 2
+    # The wait is one second at a time on the event loop, logged once
+    assert [record.message for record in caplog.records] == ["Strava rate limit reached, waiting 840s"]
+
+
+def test_client_retries_after_a_429_once_the_window_resets(clock):
+    strava_client = AsyncStravaClient(httpx.AsyncClient(transport=_transport(429)), StravaRateLimiter())
+    start = clock.now
+
+    response = asyncio.run(strava_client.get("https://strava.test/athlete"))
+
+    assert response.status_code == 200
+    assert clock.now // SHORT_WINDOW_SECONDS == start // SHORT_WINDOW_SECONDS + 1
+
+
+def test_client_raises_when_still_rate_limited(clock):
+    strava_client = AsyncStravaClient(httpx.AsyncClient(transport=_transport(429, 429, 429)), StravaRateLimiter())
+
+    with pytest.raises(StravaRateLimitError) as error:
+        asyncio.run(strava_client.get("https://strava.test/athlete"))
+    assert error.value.status_code == 429 and not error.value.permanent
+
+
+def test_client_retries_server_errors(clock):
+    strava_client = StravaClient(httpx.Client(transport=_transport(503, 502)), StravaRateLimiter())
+
+    assert strava_client.get("https://strava.test/athlete").status_code == 200
+
+
+def test_client_returns_the_last_server_error(clock):
+    strava_client = StravaClient(httpx.Client(transport=_transport(500, 500, 500, 500)), StravaRateLimiter())
+
+    assert strava_client.get("https://strava.test/athlete").status_code == 500
+
+
+@pytest.fixture
+def strava(clock, monkeypatch):
+    """
+    StravaApi of the test athlete, answering with a detailed activity unless the activity id is a status code
+    """
+    def handler(request: httpx.Request) -> httpx.Response:
+        activity_id = int(request.url.path.rsplit("/", 1)[-1])
+        if activity_id >= 400:
+            return httpx.Response(activity_id, json={"message": "error"})
+        return httpx.Response(200, json=detailed_payload(activity_id))
+
+    strava_client = StravaClient(httpx.Client(transport=httpx.MockTransport(handler)), StravaRateLimiter(),
+                                 max_retries=0)
+    monkeypatch.setattr(api, "get_strava_client", lambda: strava_client)
+    token_cache.set(ATHLETE_ID, "token", int(time.time()) + 3600)
+    yield StravaApi(db=None, athlete_id=ATHLETE_ID)
+    token_cache.invalidate(ATHLETE_ID)
+
+
+def test_get_strava_raises_a_typed_error(strava):
+    with pytest.raises(StravaApiError) as error:
+        strava.get_strava(f"{api.STRAVA_API_URL}/activities/503")
+
+    assert error.value.status_code == 503 and not error.value.permanent
+
+
+def test_activity_details_leave_out_transient_errors(strava):
+    details = strava.get_activity_details([1, 404, 503])
+
+    assert details[1].id == 1
+    assert details[404] is None
+    assert 503 not in details
+
+
+def _failing_transport(failures: int) -> httpx.MockTransport:
+    """
+    Times out `failures` times, then answers 200
+    """
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        if len(calls) <= failures:
+            raise httpx.ConnectTimeout("timed out", request=request)
+        return httpx.Response(200, json={}, headers=QUOTA_HEADERS)
+    return httpx.MockTransport(handler)
+
+
+def test_client_retries_network_errors(clock):
+    strava_client = StravaClient(httpx.Client(transport=_failing_transport(2)), StravaRateLimiter())
+
+    assert strava_client.get("https://strava.test/athlete").status_code == 200
+
+
+def test_client_raises_a_typed_error_once_unreachable(clock):
+    strava_client = AsyncStravaClient(httpx.AsyncClient(transport=_failing_transport(3)), StravaRateLimiter())
+
+    with pytest.raises(StravaApiError) as error:
+        asyncio.run(strava_client.get("https://strava.test/athlete"))
+    assert error.value.status_code is None and not error.value.permanent
+    assert isinstance(error.value.__cause__, httpx.TimeoutException)
+
+
+def test_oauth_calls_do_not_wait_for_the_quota(clock):
+    limiter = StravaRateLimiter(short_limit=10, daily_limit=100)
+    limiter.exhaust()
+    strava_client = AsyncStravaClient(httpx.AsyncClient(transport=_transport()), limiter)
+    start = clock.now
+
+    response = asyncio.run(strava_client.post("https://strava.test/oauth/token", wait_for_quota=False))
+
+    assert response.status_code == 200 and clock.now == start
+
+
+def test_oauth_calls_raise_at_once_when_rate_limited(clock):
+    strava_client = StravaClient(httpx.Client(transport=_transport(429, 429, 429)), StravaRateLimiter())
+
+    with pytest.raises(StravaRateLimitError) as error:
+        strava_client.post("https://strava.test/oauth/token", wait_for_quota=False)
+    assert 0 < error.value.retry_after <= SHORT_WINDOW_SECONDS
@@ -0,0 +1,107 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+from database.db import SessionLocal
+from models import crud
+from models.athletes import AthleteModel
+from models.auth import LoginDetailsModel
+from strava import api
+from strava.api import StravaApi
+from strava.client import StravaClient, StravaRateLimiter
+from strava.tokens import TokenCache
+from factories import ATHLETE_ID
+
+REFRESH_MARGIN = 300
+
+
+class FakeOAuth:
+    """
+    POST /oauth/token, answering a new access token each time
+    """
+
+    def __init__(self):
+        self.refreshes = 0
+        self.delay = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path.endswith("/oauth/token")
+        self.refreshes += 1
+        time.sleep(self.delay)
+        return httpx.Response(200, json={"token_type": "Bearer", "expires_in": 21600,
+                                         "expires_at": int(time.time()) + 21600,
+                                         "access_token": f"fresh{self.refreshes}", "refresh_token": "refresh"})
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = TokenCache(refresh_margin=REFRESH_MARGIN)
+    monkeypatch.setattr(api, "token_cache", cache)
+    monkeypatch.setattr(crud, "token_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def oauth(monkeypatch, cache):
+    fake = FakeOAuth()
+    strava_client = StravaClient(httpx.Client(transport=httpx.MockTransport(fake)), StravaRateLimiter(),
+                                 max_retries=0)
+    monkeypatch.setattr(api, "get_strava_client", lambda: strava_client)
+    return fake
+
+
+def _login(db, expires_in: int):
+    db.add(AthleteModel(id=ATHLETE_ID))
+    db.add(LoginDetailsModel(athlete_id=ATHLETE_ID, expires_at=int(time.time()) + expires_in,
+                             refresh_token="refresh", access_token="stored"))
+    db.commit()
+
+
+def test_tokens_are_handed_out_until_the_refresh_margin(cache):
+    now = int(time.time())
+
+    cache.set(ATHLETE_ID, "valid", now + REFRESH_MARGIN + 60)
+    assert cache.get(ATHLETE_ID) == "valid"
+
+    cache.set(ATHLETE_ID, "expiring", now + REFRESH_MARGIN - 60)
+    assert cache.get(ATHLETE_ID) is None
+
+
+def test_cached_token_is_reused(db, oauth, monkeypatch):
+    _login(db, expires_in=3600)
+    assert StravaApi(db, ATHLETE_ID).get_token() == "stored"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("read from the database")
+    monkeypatch.setattr(crud, "get_athlete_login", fail)
+
+    assert StravaApi(db, ATHLETE_ID).get_token() == "stored"
+    assert oauth.refreshes == 0
+
+
+def test_token_expiring_within_the_margin_is_refreshed(db, oauth):
+    _login(db, expires_in=REFRESH_MARGIN - 60)
+
+    assert StravaApi(db, ATHLETE_ID).get_token() == "fresh1"
+    assert StravaApi(db, ATHLETE_ID).get_token() == "fresh1"
+
+    db.expire_all()
+    assert oauth.refreshes == 1 and crud.get_athlete_login(db, ATHLETE_ID).access_token == "fresh1"
+
+
+def test_concurrent_callers_trigger_one_refresh(db, oauth):
+    _login(db, expires_in=0)
+    oauth.delay = 0.1
+
+    def get_token(_):
+        session = SessionLocal()
+        try:
+            return StravaApi(session, ATHLETE_ID).get_token()
+        finally:
+            session.close()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tokens = list(executor.map(get_token, range(8)))
+
+    assert tokens == ["fresh1"] * 8 and oauth.refreshes == 1
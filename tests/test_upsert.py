@@ -0,0 +1,122 @@
+from datetime import timedelta
+
+import pytest
+
+from geo.polyline import decode_polyline
+from models import crud
+from migrate import backfill_route_columns
+from models.activities import ActivityModel
+from factories import summary_activity, detailed_activity, loop, ATHLETE_ID, START_DATE
+
+
+def test_upsert_inserts_then_overwrites(db):
+    assert crud.upsert_activities(db, [summary_activity(1, name="Morning"), summary_activity(2)]) == 2
+
+    crud.upsert_activities(db, [summary_activity(1, name="Evening")])
+
+    assert db.query(ActivityModel).count() == 2
+    assert crud.get_activity_by_id(db, 1).name == "Evening"
+
+
+def test_upsert_keeps_the_last_occurrence_of_an_activity(db):
+    crud.upsert_activities(db, [summary_activity(1, name="First"), summary_activity(1, name="Second")])
+
+    assert crud.get_activity_by_id(db, 1).name == "Second"
+
+
+def test_upsert_in_several_chunks(db):
+    activities = [summary_activity(activity_id, start_date=START_DATE + timedelta(hours=activity_id))
+                  for activity_id in range(1, 6)]
+
+    assert crud.upsert_activities(db, activities, chunk_size=2) == 5
+    assert {activity.id for activity in db.query(ActivityModel)} == {1, 2, 3, 4, 5}
+
+
+def test_upsert_stores_the_decoded_route_and_bounding_box(db):
+    route = loop(center=(45.0, 6.0), radius=0.01)
+    crud.upsert_activities(db, [summary_activity(1, coordinates=route)])
+
+    activity = crud.get_activity_by_id(db, 1)
+    assert activity.route is not None and activity.fingerprint is not None
+    bounding_box = (activity.min_lat, activity.min_lng, activity.max_lat, activity.max_lng)
+    assert bounding_box == pytest.approx((44.99, 5.99, 45.01, 6.01), abs=1e-4)
+
+
+def test_migration_fills_the_route_columns_of_older_activities(db, database):
+    crud.upsert_activities(db, [summary_activity(activity_id, start_date=START_DATE + timedelta(hours=activity_id),
+                                                 coordinates=loop(radius=0.01 * activity_id))
+                                for activity_id in (1, 2, 3)] + [summary_activity(4, coordinates=None)])
+    columns = ('route', 'fingerprint', 'min_lat', 'min_lng', 'max_lat', 'max_lng')
+    stored = {activity.id: [getattr(activity, column) for column in columns] for activity in db.query(ActivityModel)}
+    db.query(ActivityModel).update({column: None for column in columns})
+    db.commit()
+
+    assert backfill_route_columns(database, batch_size=2) == 3
+
+    db.expire_all()
+    assert {activity.id: [getattr(activity, column) for column in columns]
+            for activity in db.query(ActivityModel)} == stored
+    assert backfill_route_columns(database) == 0
+
+
+def test_summary_does_not_replace_the_details(db):
+    detailed_route = loop(points=200)
+    crud.upsert_activities(db, [detailed_activity(1, coordinates=detailed_route, gear_id="b1")])
+
+    crud.upsert_activities(db, [summary_activity(1, coordinates=loop(points=20), gear_id="", name="Renamed")])
+
+    activity = crud.get_activity_by_id(db, 1)
+    assert activity.name == "Renamed"
+    assert activity.gear_id == "b1"
+    assert activity.detailed_at is not None
+    assert len(decode_polyline(activity.polyline)) == 200
+
+
+def test_details_replace_the_summary(db):
+    crud.upsert_activities(db, [summary_activity(1, coordinates=loop(points=20))])
+
+    crud.upsert_activities(db, [detailed_activity(1, coordinates=loop(points=200), gear_id="b2")])
+
+    activity = crud.get_activity_by_id(db, 1)
+    assert activity.gear_id == "b2"
+    assert activity.detailed_at is not None
+    assert len(decode_polyline(activity.polyline)) == 200
+
+
+def test_upsert_computes_the_values_of_each_activity_once(db, monkeypatch):
+    calls = []
+    fingerprint = crud.route_fingerprint
+    monkeypatch.setattr(crud, "route_fingerprint", lambda coordinates: calls.append(1) or fingerprint(coordinates))
+
+    crud.upsert_activities(db, [summary_activity(activity_id, coordinates=loop()) for activity_id in range(1, 4)])
+
+    assert len(calls) == 3
+
+
+def test_unchanged_activities_are_not_written_again(db, notifications):
+    crud.upsert_activities(db, [summary_activity(1), summary_activity(2)])
+    notifications.clear()
+
+    assert crud.upsert_activities(db, [summary_activity(1), summary_activity(2, name="Renamed")]) == 1
+    assert notifications == [(ATHLETE_ID, [2])]
+
+
+def test_details_are_written_even_with_the_same_content(db):
+    crud.upsert_activities(db, [summary_activity(1, coordinates=loop())])
+
+    assert crud.upsert_activities(db, [detailed_activity(1, coordinates=loop())]) == 1
+    assert crud.get_activity_by_id(db, 1).detailed_at is not None
+
+
+def test_webhook_updates_without_changes_are_skipped(db, notifications):
+    crud.upsert_activities(db, [summary_activity(1, name="Morning")])
+    notifications.clear()
+
+    crud.update_activity_by_id(db, 1, {"title": "Morning", "type": "Ride"})
+    assert notifications == []
+
+    crud.update_activity_by_id(db, 1, {"title": "Evening"})
+    assert notifications == [(ATHLETE_ID, [1])]
+    # The hash is unknown after a partial update, the next full write goes through
+    assert crud.get_activity_by_id(db, 1).content_hash is None
+    assert crud.upsert_activities(db, [summary_activity(1, name="Evening")]) == 1
@@ -0,0 +1,101 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from database.db import AsyncSessionLocal, get_async_engine
+from models import async_crud, crud
+from models.webhooks import WebhookActivitiesModel
+from schemas.webhooks import WebhookCreate
+from services import webhooks as webhook_service
+from factories import summary_activity, ATHLETE_ID
+
+LEASE = timedelta(minutes=5)
+
+
+def _queue(db, object_id: int, event_time: int, aspect_type: str = "update", **fields) -> int:
+    values = dict(object_type="activity", object_id=object_id, aspect_type=aspect_type, updates={},
+                  owner_id=ATHLETE_ID, subscription_id=1, event_time=event_time, attempts=0,
+                  available_at=datetime.utcnow() - timedelta(seconds=1))
+    webhook = WebhookActivitiesModel(**{**values, **fields})
+    db.add(webhook)
+    db.commit()
+    return webhook.id
+
+
+def test_claim_leases_every_event_of_the_claimed_activities(db):
+    first = _queue(db, object_id=1, event_time=20)
+    _queue(db, object_id=2, event_time=10)
+    second = _queue(db, object_id=1, event_time=10)
+
+    webhooks = crud.claim_webhooks(db, batch_size=1, lease=LEASE)
+
+    assert [webhook.id for webhook in webhooks] == [second, first]
+    assert crud.claim_webhooks(db, batch_size=10, lease=LEASE)[0].object_id == 2
+    assert crud.claim_webhooks(db, batch_size=10, lease=LEASE) == []
+
+
+def test_claimed_events_are_read_without_the_session(db):
+    _queue(db, object_id=1, event_time=10, updates={"title": "Renamed"})
+
+    webhook, = crud.claim_webhooks(db, batch_size=10, lease=LEASE)
+    db.rollback()
+    db.close()
+
+    assert webhook.updates == {"title": "Renamed"} and webhook.aspect_type == "update"
+
+
+def test_retry_queues_the_events_again_after_the_backoff(db):
+    webhook_id = _queue(db, object_id=1, event_time=10)
+    crud.claim_webhooks(db, batch_size=10, lease=LEASE)
+
+    crud.retry_webhooks(db, [webhook_id], error="boom", backoff=timedelta(seconds=-1), max_attempts=3)
+
+    webhook, = crud.claim_webhooks(db, batch_size=10, lease=LEASE)
+    assert webhook.attempts == 1 and webhook.last_error == "boom" and webhook.status == "queued"
+
+
+def test_events_fail_at_the_last_attempt_and_are_pruned_later(db):
+    webhook_id = _queue(db, object_id=1, event_time=10, attempts=2)
+
+    crud.retry_webhooks(db, [webhook_id], error="boom", backoff=timedelta(seconds=-1), max_attempts=3)
+
+    assert crud.claim_webhooks(db, batch_size=10, lease=LEASE) == []
+    webhook = db.get(WebhookActivitiesModel, webhook_id)
+    assert webhook.status == "failed" and webhook.available_at is None and webhook.finished_at is not None
+    assert crud.prune_webhooks(db, status="failed", retention=timedelta(days=1)) == 0
+    assert crud.prune_webhooks(db, status="failed", retention=timedelta(seconds=-1)) == 1
+
+
+def _receive(*events: WebhookCreate):
+    async def receive():
+        async with AsyncSessionLocal() as session:
+            queued = [await async_crud.create_webhook(session, event) for event in events]
+        await get_async_engine().dispose()
+        return queued
+    return asyncio.run(receive())
+
+
+def _event(object_id: int = 1, event_time: int = 10, aspect_type: str = "update") -> WebhookCreate:
+    return WebhookCreate(object_type="activity", object_id=object_id, aspect_type=aspect_type,
+                         updates={"title": "Renamed"}, owner_id=ATHLETE_ID, subscription_id=1, event_time=event_time)
+
+
+def test_redeliveries_are_not_queued_again(db):
+    queued = _receive(_event(), _event(), _event(event_time=11), _event(aspect_type="delete"))
+
+    assert queued == [True, False, True, True]
+    assert db.query(WebhookActivitiesModel).count() == 3
+
+
+def test_applied_events_turn_redeliveries_away_until_pruned(db):
+    crud.upsert_activities(db, [summary_activity(1)])
+    _receive(_event(aspect_type="delete"))
+
+    assert webhook_service.process_webhook_batch() == 1
+
+    webhook, = db.query(WebhookActivitiesModel)
+    assert webhook.status == "done" and webhook.available_at is None and webhook.finished_at is not None
+    assert crud.get_activity_by_id(db, 1) is None
+    assert _receive(_event(aspect_type="delete")) == [False]
+    assert webhook_service.process_webhook_batch() == 0
+    assert crud.prune_webhooks(db, status="done", retention=timedelta(seconds=-1)) == 1
+    assert _receive(_event(aspect_type="delete")) == [True]